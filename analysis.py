@@ -2,7 +2,14 @@ import sqlite3
 import statistics
 import math
 import jdatetime
-from database import get_db_connection, recalculate_portfolio_cash
+from database import (
+    get_db_connection, resolve_inscode, cash_delta, adjust_cash, CASH_DELTA_SQL,
+    transaction_commission, transaction_amount, bump_data_versions,
+)
+from positions import refresh_position, rebuild_positions, EPSILON
+from asset_classifier import get_category
+from sector_exposure import get_sector_exposure
+from order_book import estimate_liquidity
 from flask import current_app
 from datetime import datetime
 
@@ -43,6 +50,12 @@ def calculate_pct_change(current, initial):
 # 1. هسته محاسباتی
 # =========================================================
 
+# سرمایه آورده سبد (واریز منهای برداشت)؛ نقدینگی از دفتر نقدینگی (portfolios.current_cash) خوانده می‌شود
+INVESTED_SQL = f'''
+    SELECT SUM({CASH_DELTA_SQL}) AS invested
+    FROM transactions WHERE portfolio_id = ? AND transaction_type IN ('deposit', 'withdraw')
+'''
+
 def _init_position(t):
     return {
         'qty': 0, 
@@ -57,87 +70,48 @@ def _init_position(t):
 def calculate_positions(portfolio_id):
     """
     محاسبه دقیق دارایی‌ها با استفاده از منطق میانگین موزون (Weighted Average)
+    مانده‌ها از جدول positions (بروز همراه با هر تراکنش) و قیمت لحظه‌ای با یک join خوانده می‌شوند.
     """
     conn = get_db_connection()
-    # جوین کردن با قیمت‌های لحظه‌ای بازار
-    transactions = conn.execute('''
-        SELECT t.symbol, t.transaction_type, t.quantity, t.price, t.commission,
-               m.last_price, m.company_name, m.sector, m.close_price_yesterday
-        FROM transactions t
-        LEFT JOIN market_prices m ON t.symbol = m.symbol
-        WHERE t.portfolio_id = ?
-        ORDER BY t.date ASC, t.id ASC
-    ''', (portfolio_id,)).fetchall()
+    # (جداول پایه به جای view market_prices، تا view برای هر پرس‌وجو کامل ساخته نشود)
+    rows = conn.execute('''
+        SELECT ps.symbol, ps.qty, ps.cost,
+               m.last_price, i.company_name, COALESCE(s.name, i.sector) AS sector
+        FROM positions ps
+        LEFT JOIN instrument_prices m ON m.inscode = ps.inscode
+        LEFT JOIN instruments i ON i.inscode = m.inscode
+        LEFT JOIN sectors s ON s.code = i.sector_code
+        WHERE ps.portfolio_id = ? AND ps.qty > ?
+    ''', (portfolio_id, EPSILON)).fetchall()
+    cash_row = conn.execute("SELECT current_cash FROM portfolios WHERE id = ?", (portfolio_id,)).fetchone()
+    current_cash = (cash_row['current_cash'] if cash_row else 0) or 0
     conn.close()
 
-    current_cash = 0
-    positions = {} # ساختار: symbol: {qty, total_cost, ...}
-
-    for t in transactions:
-        sym = t['symbol']
-        qty = float(t['quantity'] or 0)
-        price = float(t['price'] or 0)
-        comm = float(t['commission'] or 0)
-        t_type = t['transaction_type']
-        
-        # مقداردهی اولیه اگر نماد جدید است
-        if sym and sym not in positions:
-            positions[sym] = {
-                'qty': 0, 'total_cost': 0, 
-                'name': t['company_name'] or sym, 
-                'sector': t['sector'] or 'سایر',
-                'last_price': t['last_price'] or 0,
-                'prev_price': t['close_price_yesterday'] or 0
-            }
-
-        if t_type == 'buy':
-            cost = (qty * price) + comm
-            current_cash -= cost
-            if sym:
-                positions[sym]['qty'] += qty
-                positions[sym]['total_cost'] += cost # افزایش بهای تمام شده
-                
-        elif t_type == 'sell':
-            revenue = (qty * price) - comm
-            current_cash += revenue
-            if sym and positions[sym]['qty'] > 0:
-                # کسر از بهای تمام شده به نسبت تعداد فروش (منطق استاندارد حسابداری)
-                avg_cost = positions[sym]['total_cost'] / positions[sym]['qty']
-                cost_of_sold = qty * avg_cost
-                
-                positions[sym]['qty'] -= qty
-                positions[sym]['total_cost'] -= cost_of_sold
-                
-        elif t_type == 'deposit': current_cash += price
-        elif t_type == 'withdraw': current_cash -= price
-        elif t_type == 'dividend': current_cash += price
-
     # آماده‌سازی خروجی نهایی
     final_holdings = []
     total_stock_value = 0
 
-    for sym, data in positions.items():
-        if data['qty'] > 0.001: # فیلتر کردن مقادیر صفر
-            market_price = data['last_price']
-            # اگر قیمت بازار صفر بود (آپدیت نشده)، از میانگین خرید استفاده کن تا سود/زیان فضایی نشود
-            avg_price = data['total_cost'] / data['qty']
-            if not market_price: market_price = avg_price
-            
-            current_val = data['qty'] * market_price
-            total_stock_value += current_val
-            
-            final_holdings.append({
-                'symbol': sym,
-                'name': data['name'],
-                'sector': data['sector'],
-                'qty': data['qty'],
-                'price': market_price,
-                'avg_buy_price': avg_price,
-                'total_cost': data['total_cost'],
-                'current_value': current_val,
-                'daily_change': 0, # می‌توان محاسبه کرد
-                'weight': 0
-            })
+    for data in rows:
+        market_price = data['last_price'] or 0
+        # اگر قیمت بازار صفر بود (آپدیت نشده)، از میانگین خرید استفاده کن تا سود/زیان فضایی نشود
+        avg_price = data['cost'] / data['qty']
+        if not market_price: market_price = avg_price
+
+        current_val = data['qty'] * market_price
+        total_stock_value += current_val
+
+        final_holdings.append({
+            'symbol': data['symbol'],
+            'name': data['company_name'] or data['symbol'],
+            'sector': data['sector'] or 'سایر',
+            'qty': data['qty'],
+            'price': market_price,
+            'avg_buy_price': avg_price,
+            'total_cost': data['cost'],
+            'current_value': current_val,
+            'daily_change': 0, # می‌توان محاسبه کرد
+            'weight': 0
+        })
 
     return final_holdings, current_cash, total_stock_value
 
@@ -149,56 +123,16 @@ def get_portfolio_details(portfolio_id):
         if not portfolio:
             return None
             
-        # 2. دریافت تراکنش‌ها
-        transactions = conn.execute('''
-            SELECT transaction_type, symbol, quantity, price, commission, amount, date 
-            FROM transactions 
-            WHERE portfolio_id = ? 
-            ORDER BY date ASC, id ASC
-        ''', (portfolio_id,)).fetchall()
-
-        # --- متغیرهای محاسباتی ---
-        real_time_cash = 0.0          
-        net_invested_capital = 0.0    
-        holdings_tracker = {}         
-        
-        # --- پردازش خط به خط تراکنش‌ها ---
-        for t in transactions:
-            t_type = t['transaction_type']
-            qty = float(t['quantity'] or 0)
-            price = float(t['price'] or 0)
-            comm = float(t['commission'] or 0)
-            amount = float(t['amount'] or 0)
-            sym = t['symbol']
-
-            if amount == 0 and t_type in ['deposit', 'withdraw', 'dividend']:
-                amount = price * (qty if qty > 0 else 1)
-
-            if t_type == 'deposit':
-                real_time_cash += amount
-                net_invested_capital += amount
-            elif t_type == 'withdraw':
-                real_time_cash -= amount
-                net_invested_capital -= amount
-            elif t_type == 'dividend':
-                real_time_cash += amount
-            elif t_type == 'buy':
-                cost = (qty * price) + comm
-                real_time_cash -= cost
-                if sym not in holdings_tracker: holdings_tracker[sym] = {'qty': 0.0, 'cost': 0.0}
-                holdings_tracker[sym]['qty'] += qty
-                holdings_tracker[sym]['cost'] += cost
-            elif t_type == 'sell':
-                revenue = (qty * price) - comm
-                real_time_cash += revenue
-                if sym in holdings_tracker and holdings_tracker[sym]['qty'] > 0:
-                    current_avg_cost = holdings_tracker[sym]['cost'] / holdings_tracker[sym]['qty']
-                    cost_of_sold_shares = qty * current_avg_cost
-                    holdings_tracker[sym]['qty'] -= qty
-                    holdings_tracker[sym]['cost'] -= cost_of_sold_shares
-                    if holdings_tracker[sym]['qty'] <= 0:
-                        holdings_tracker[sym]['qty'] = 0
-                        holdings_tracker[sym]['cost'] = 0
+        # 2. نقدینگی (دفتر نقدینگی سبد)، سرمایه آورده و مانده‌ها (جدول positions)
+        real_time_cash = float(portfolio['current_cash'] or 0)
+        net_invested_capital = float(conn.execute(INVESTED_SQL, (portfolio_id,)).fetchone()['invested'] or 0)
+        holdings_tracker = {
+            r['inscode'] or r['symbol']: {'qty': r['qty'], 'cost': r['cost'], 'symbol': r['symbol']}
+            for r in conn.execute(
+                "SELECT symbol, inscode, qty, cost FROM positions WHERE portfolio_id = ? AND qty > ?",
+                (portfolio_id, EPSILON)
+            )
+        }
 
         if net_invested_capital == 0 and portfolio['initial_capital']:
              net_invested_capital = float(portfolio['initial_capital'])
@@ -209,12 +143,29 @@ def get_portfolio_details(portfolio_id):
         holdings_list = []
         sector_map = {'Stock': 0, 'Gold': 0, 'Fixed': 0, 'Cash': 0}
 
-        for symbol, data in holdings_tracker.items():
+        # قیمت تمام دارایی‌ها با یک پرس‌وجو (کلید عددی inscode)
+        held_codes = [k for k, v in holdings_tracker.items() if v['qty'] > 0.001 and isinstance(k, int)]
+        price_rows = {}
+        if held_codes:
+            placeholders = ','.join('?' * len(held_codes))
+            price_rows = {
+                r['inscode']: r for r in conn.execute(
+                    f"SELECT inscode, last_price, company_name, asset_type, sector FROM market_prices WHERE inscode IN ({placeholders})",
+                    held_codes
+                )
+            }
+        liquidity = estimate_liquidity({k: holdings_tracker[k]['qty'] for k in held_codes})
+
+        for key, data in holdings_tracker.items():
             qty = data['qty']
             total_cost = data['cost']
+            symbol = data['symbol']
             
             if qty > 0.001: 
-                price_row = conn.execute("SELECT last_price, company_name, asset_type, sector FROM market_prices WHERE symbol=?", (symbol,)).fetchone()
+                price_row = price_rows.get(key)
+                if price_row is None and isinstance(key, str):
+                    # تراکنش قدیمی بدون inscode
+                    price_row = conn.execute("SELECT last_price, company_name, asset_type, sector FROM market_prices WHERE symbol=?", (symbol,)).fetchone()
                 current_price = float(price_row['last_price']) if price_row and price_row['last_price'] else 0.0
                 name = price_row['company_name'] if price_row and price_row['company_name'] else symbol
                 asset_type = price_row['asset_type'] if price_row and price_row['asset_type'] else 'Stock'
@@ -234,12 +185,11 @@ def get_portfolio_details(portfolio_id):
                     'avg_buy_price': avg_buy_price,
                     'weight': 0,
                     'asset_type': asset_type,
-                    'sector': sector
+                    'sector': sector,
+                    'days_to_exit': liquidity.get(key, {}).get('days_to_exit')
                 })
                 
-                std_type = 'Stock'
-                if 'Gold' in asset_type or 'طلا' in asset_type: std_type = 'Gold'
-                elif 'Fixed' in asset_type or 'ثابت' in asset_type: std_type = 'Fixed'
+                std_type = get_category(asset_type)
                 sector_map[std_type] = sector_map.get(std_type, 0) + market_value
 
         # 4. ارزش کل پرتفوی (NAV)
@@ -265,15 +215,10 @@ def get_portfolio_details(portfolio_id):
             # الف) دریافت شاخص اولیه (زمان افتتاح)
             initial_index = float(portfolio['initial_index']) if portfolio['initial_index'] else 0.0
             
-            # ب) دریافت شاخص لحظه‌ای از جدول market_overview
-            idx_row = conn.execute("SELECT total_index FROM market_overview WHERE id = 1").fetchone()
-            current_index = float(idx_row['total_index']) if idx_row and idx_row['total_index'] else 0.0
-
-            # ج) اگر شاخص لحظه‌ای صفر بود (هنوز آپدیت نشده)، سعی کن آنلاین بگیری
-            if current_index == 0:
-                from tsetmc_service import get_market_index
-                fetched = get_market_index()
-                if fetched: current_index = fetched
+            # ب) دریافت شاخص لحظه‌ای از جدول market_overview (بدون درخواست شبکه)
+            # اگر کهنه/نامشخص باشد، بروزرسانی در پس‌زمینه انجام می‌شود
+            from tsetmc_service import get_cached_market_index
+            current_index, index_status = get_cached_market_index()
 
             # د) محاسبه درصد بازدهی
             index_return_pct = 0.0
@@ -289,6 +234,7 @@ def get_portfolio_details(portfolio_id):
             alpha = 0
             current_index = 0
             initial_index = 0
+            index_status = 'unknown'
 
         # 8. داده‌های خروجی نمودار
         sector_alloc = []
@@ -331,6 +277,7 @@ def get_portfolio_details(portfolio_id):
             'info': dict(portfolio),
             'holdings': holdings_list,
             'sectors': [{'name': k, 'value': v} for k,v in sector_map.items()],
+            'sector_exposure': get_sector_exposure(portfolio_id),
             'total_value': total_portfolio_value,
             'cash_balance': real_time_cash,
             'net_invested': net_invested_capital,
@@ -339,7 +286,8 @@ def get_portfolio_details(portfolio_id):
                 'index_return': round(index_return_pct, 2),
                 'alpha': round(alpha, 2),
                 'current_index': current_index,
-                'initial_index': initial_index
+                'initial_index': initial_index,
+                'index_status': index_status
             },
             'target_config': dict(target_config),
             'target_assets': [dict(t) for t in target_assets],
@@ -448,7 +396,7 @@ def create_new_portfolio(data, initial_stocks, owner_id):
         # 3. ثبت تراکنش‌ها
         transactions_list = []
         if total_capital > 0:
-            transactions_list.append((portfolio_id, 'deposit', 'CASH', 'بانکی', 1, total_capital, total_capital, 0, data['date'], 'Cash'))
+            transactions_list.append((portfolio_id, 'deposit', 'CASH', None, 'بانکی', 1, total_capital, total_capital, 0, data['date'], 'Cash', total_capital))
         
         for stock in initial_stocks:
             try:
@@ -459,15 +407,20 @@ def create_new_portfolio(data, initial_stocks, owner_id):
                     sec = c.execute("SELECT sector, asset_type FROM market_prices WHERE symbol=?", (stock['symbol'],)).fetchone()
                     sector = sec['sector'] if sec else 'سایر'
                     a_type = sec['asset_type'] if sec else 'Stock'
-                    transactions_list.append((portfolio_id, 'buy', stock['symbol'], sector, qty, price, total_val, 0, data['date'], a_type))
+                    inscode = resolve_inscode(conn, stock['symbol'])
+                    transactions_list.append((portfolio_id, 'buy', stock['symbol'], inscode, sector, qty, price, total_val, 0, data['date'], a_type, -total_val))
             except: continue
 
         if transactions_list:
             c.executemany('''
                 INSERT INTO transactions 
-                (portfolio_id, transaction_type, symbol, sector, quantity, price, amount, commission, date, asset_class)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                (portfolio_id, transaction_type, symbol, inscode, sector, quantity, price, amount, commission, date, asset_class, cash_delta)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', transactions_list)
+            rebuild_positions(conn, portfolio_id)
+            # نقدینگی اولیه = جمع اثر نقدی همین تراکنش‌ها (واریز کل سرمایه منهای سهام اولیه)
+            c.execute("UPDATE portfolios SET current_cash = ? WHERE id = ?", (sum(t[-1] for t in transactions_list), portfolio_id))
+            bump_data_versions(conn, 'transactions')
 
         conn.commit()
         return True
@@ -498,43 +451,94 @@ def update_portfolio_info(portfolio_id, data):
         
 def delete_portfolio_full(portfolio_id):
     conn = get_db_connection()
-    for t in ['transactions', 'portfolio_history', 'calendar_events']:
+    for t in ['transactions', 'positions', 'portfolio_history', 'calendar_events']:
         conn.execute(f"DELETE FROM {t} WHERE portfolio_id=?", (portfolio_id,))
     conn.execute("DELETE FROM portfolios WHERE id=?", (portfolio_id,))
+    bump_data_versions(conn, 'transactions')
     conn.commit()
     conn.close()
 
 def delete_transaction(tid):
+    delete_transactions([tid])
+
+def delete_transactions(ids):
+    """
+    حذف یک یا چند تراکنش در یک تراکنش دیتابیس
+    نقدینگی هر سبد یک بار (با جمع اثر نقدی تراکنش‌های حذف شده) و مانده هر نماد درگیر یک بار اصلاح می‌شود.
+    خروجی: تعداد تراکنش‌های حذف شده
+    """
+    ids = [int(i) for i in ids]
+    if not ids:
+        return 0
     conn = get_db_connection()
-    # ابتدا ID پرتفوی را می‌گیریم تا بعدا نقدینگی‌اش را آپدیت کنیم
-    row = conn.execute("SELECT portfolio_id FROM transactions WHERE id=?", (tid,)).fetchone()
-    if row:
-        pid = row['portfolio_id']
-        conn.execute("DELETE FROM transactions WHERE id=?", (tid,))
+    try:
+        placeholders = ','.join('?' * len(ids))
+        rows = conn.execute(f'''
+            SELECT id, portfolio_id, symbol, IFNULL(cash_delta, {CASH_DELTA_SQL}) AS cash_delta
+            FROM transactions WHERE id IN ({placeholders})
+        ''', ids).fetchall()
+        if not rows:
+            return 0
+
+        cash_by_portfolio = {}
+        symbols = set()
+        for r in rows:
+            cash_by_portfolio[r['portfolio_id']] = cash_by_portfolio.get(r['portfolio_id'], 0) + r['cash_delta']
+            if r['symbol']:
+                symbols.add((r['portfolio_id'], r['symbol']))
+
+        conn.execute(f"DELETE FROM transactions WHERE id IN ({placeholders})", ids)
+        for pid, delta in cash_by_portfolio.items():
+            adjust_cash(conn, pid, -delta)
+        # مانده همان نمادها در همین تراکنش دیتابیس بازسازی می‌شود
+        for pid, symbol in symbols:
+            refresh_position(conn, pid, symbol)
+        bump_data_versions(conn, 'transactions')
         conn.commit()
-        conn.close()
-        # محاسبه مجدد نقدینگی
-        recalculate_portfolio_cash(pid)
-    else:
+        return len(rows)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
 
 def update_transaction(tid, ty, q, p, d):
     conn = get_db_connection()
-    row = conn.execute("SELECT portfolio_id FROM transactions WHERE id=?", (tid,)).fetchone()
-    
-    # محاسبه مجدد کارمزد در صورت ویرایش (ساده شده)
-    # برای دقت بیشتر بهتر است مشابه add_new_transaction عمل شود اما فعلا آپدیت دستی کافیست
-    amount = 0
-    if ty == 'buy': amount = (q * p) # تقریبی بدون کارمزد جدید
-    elif ty == 'sell': amount = (q * p)
-    else: amount = p
-
-    conn.execute('UPDATE transactions SET transaction_type=?, quantity=?, price=?, date=?, amount=? WHERE id=?', (ty, q, p, d, amount, tid))
-    conn.commit()
-    conn.close()
-    
-    if row:
-        recalculate_portfolio_cash(row['portfolio_id'])
+    try:
+        row = conn.execute(
+            f"SELECT portfolio_id, symbol, IFNULL(cash_delta, {CASH_DELTA_SQL}) AS cash_delta FROM transactions WHERE id=?",
+            (tid,)
+        ).fetchone()
+        if not row:
+            return
+
+        # محاسبه مجدد کارمزد و مبلغ دقیقا مشابه add_new_transaction
+        commission = 0
+        if ty in ('buy', 'sell'):
+            info = conn.execute(
+                "SELECT asset_type, market_type FROM market_prices WHERE symbol=?", (row['symbol'],)
+            ).fetchone()
+            asset_type = (info['asset_type'] if info else None) or 'Stock'
+            market_type = (info['market_type'] if info else None) or 'TSE'
+            commission = transaction_commission(ty, q, p, asset_type, market_type)
+        amount = transaction_amount(ty, q, p, commission)
+        delta = cash_delta(ty, amount)
+
+        conn.execute(
+            'UPDATE transactions SET transaction_type=?, quantity=?, price=?, date=?, amount=?, commission=?, cash_delta=? WHERE id=?',
+            (ty, q, p, d, amount, commission, delta, tid)
+        )
+        # نقدینگی با تفاضل اثر نقدی جدید و قبلی، و مانده همان نماد در همین تراکنش دیتابیس
+        adjust_cash(conn, row['portfolio_id'], delta - row['cash_delta'])
+        if row['symbol']:
+            refresh_position(conn, row['portfolio_id'], row['symbol'])
+        bump_data_versions(conn, 'transactions')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 # =========================================================
 # 3. توابع ضروری دیگر
@@ -697,18 +701,18 @@ def process_dividend_payment(event_id):
     event = conn.execute("SELECT * FROM calendar_events WHERE id = ?", (event_id,)).fetchone()
     
     if event and event['event_type'] == 'dividend' and event['is_processed'] == 0:
-        # ثبت تراکنش سود نقدی
+        # ثبت تراکنش سود نقدی و آپدیت موجودی نقد در همان تراکنش دیتابیس
+        delta = cash_delta('dividend', event['amount'])
         conn.execute('''
-            INSERT INTO transactions (portfolio_id, symbol, sector, transaction_type, quantity, price, amount, date, commission)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (event['portfolio_id'], 'DPS', 'BANK', 'dividend', 1, event['amount'], event['amount'], event['event_date'], 0))
+            INSERT INTO transactions (portfolio_id, symbol, sector, transaction_type, quantity, price, amount, date, commission, cash_delta)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (event['portfolio_id'], 'DPS', 'BANK', 'dividend', 1, event['amount'], event['amount'], event['event_date'], 0, delta))
+        adjust_cash(conn, event['portfolio_id'], delta)
+        bump_data_versions(conn, 'transactions')
         
         conn.execute("UPDATE calendar_events SET is_processed = 1 WHERE id = ?", (event_id,))
         conn.commit()
         conn.close()
-        
-        # آپدیت موجودی نقد
-        recalculate_portfolio_cash(event['portfolio_id'])
         return True
         
     conn.close()
@@ -913,12 +917,12 @@ def calculate_risk_analysis(portfolio_id):
     """محاسبه شاخص‌های ریسک و هشدارهای سبد"""
     conn = get_db_connection()
     try:
-        # 1. دریافت دارایی‌ها (تعداد سهام)
+        # 1. دریافت دارایی‌ها (مانده از جدول positions و قیمت روز با یک join)
         holdings = conn.execute('''
-            SELECT symbol, 
-                   SUM(CASE WHEN transaction_type='buy' THEN quantity ELSE -quantity END) as qty 
-            FROM transactions WHERE portfolio_id=? GROUP BY symbol
-        ''', (portfolio_id,)).fetchall()
+            SELECT ps.symbol, ps.qty, m.last_price
+            FROM positions ps LEFT JOIN instrument_prices m ON m.inscode = ps.inscode
+            WHERE ps.portfolio_id = ? AND ps.qty > ?
+        ''', (portfolio_id, EPSILON)).fetchall()
         
         total_assets_value = 0
         assets_data = []
@@ -926,8 +930,7 @@ def calculate_risk_analysis(portfolio_id):
         # 2. محاسبه ارزش هر دارایی
         for h in holdings:
             if h['qty'] > 0:
-                price_row = conn.execute("SELECT last_price FROM market_prices WHERE symbol=?", (h['symbol'],)).fetchone()
-                price = float(price_row['last_price']) if price_row and price_row['last_price'] else 0.0
+                price = float(h['last_price']) if h['last_price'] else 0.0
                 val = h['qty'] * price
                 total_assets_value += val
                 assets_data.append({'symbol': h['symbol'], 'value': val})
@@ -1076,9 +1079,7 @@ def perform_stress_test(portfolio_id, scenario):
     for holding in details['holdings']:
         asset_type = holding.get('asset_type', 'Stock')
         
-        category_name_en = 'Stock' # Default
-        if 'Gold' in asset_type or 'طلا' in asset_type: category_name_en = 'Gold'
-        elif 'Fixed' in asset_type or 'ثابت' in asset_type: category_name_en = 'Fixed'
+        category_name_en = get_category(asset_type)
 
         # Look up shock percentage using the Persian name, which matches the form submission.
         shock_pct = float(scenario.get(persian_labels.get(category_name_en, 'سهام'), 0))
@@ -1167,13 +1168,8 @@ def get_model_details():
     }
 
     for profile in profiles:
-        # 1. دریافت وزن‌های کلان + نام نمایشی
-        # نکته: فرض بر این است که ستون display_name را به دیتابیس اضافه کرده‌اید
-        try:
-            config = conn.execute('SELECT * FROM model_configs WHERE profile_name = ?', (profile,)).fetchone()
-        except Exception:
-            # اگر ستون display_name هنوز نباشد، موقتا خطا ندهد (برای اطمینان)
-            config = conn.execute('SELECT profile_name, target_equity, target_gold, target_fixed_income FROM model_configs WHERE profile_name = ?', (profile,)).fetchone()
+        # 1. دریافت وزن‌های کلان + نام نمایشی (ستون display_name: مهاجرت ۲)
+        config = conn.execute('SELECT * FROM model_configs WHERE profile_name = ?', (profile,)).fetchone()
 
         if not config:
             # ساخت رکورد پیش‌فرض در صورت نبودن
@@ -1187,8 +1183,7 @@ def get_model_details():
             config = {'target_equity': 30, 'target_gold': 30, 'target_fixed_income': 40, 'display_name': d_name}
 
         # تعیین نام نمایشی (اگر در دیتابیس null بود، از نام پروفایل استفاده کن)
-        # استفاده از .keys() برای اطمینان از وجود ستون
-        display_name = config['display_name'] if 'display_name' in config.keys() and config['display_name'] else default_names.get(profile, profile)
+        display_name = config['display_name'] or default_names.get(profile, profile)
 
         # 2. دریافت ریز دارایی‌های پیشنهادی
         assets_query = '''
@@ -1234,10 +1229,11 @@ def get_analysis_signals(current_user_id):
         query = '''
             SELECT a.*, 
                    m.last_price, 
-                   m.company_name, 
+                   i.company_name, 
                    u.full_name as analyst_name 
             FROM analysis_signals a 
-            LEFT JOIN market_prices m ON a.symbol = m.symbol 
+            LEFT JOIN instrument_prices m ON m.inscode = a.inscode 
+            LEFT JOIN instruments i ON i.inscode = m.inscode 
             LEFT JOIN users u ON a.owner_id = u.id 
             WHERE a.owner_id = ? 
             ORDER BY a.added_at DESC
@@ -1281,7 +1277,7 @@ def get_shared_signals(current_user_id):
                    u.full_name,
                    u.username
             FROM analysis_signals a 
-            LEFT JOIN market_prices m ON a.symbol = m.symbol 
+            LEFT JOIN instrument_prices m ON m.inscode = a.inscode 
             LEFT JOIN users u ON a.owner_id = u.id 
             WHERE a.is_public = 1
             ORDER BY a.added_at DESC
@@ -1331,10 +1327,10 @@ def add_analysis_signal(data, owner_id):
         
         conn.execute('''
             INSERT INTO analysis_signals 
-            (symbol, target_buy_price, target_sell_price, stop_loss_price, 
+            (symbol, inscode, target_buy_price, target_sell_price, stop_loss_price, 
              analysis_note, target_profile, asset_class, owner_id, is_public, added_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, CURRENT_DATE)
-        ''', (sym, data['buy'], data['sell'], data['stop'], data['note'], data['profile'], data['asset'], uid))
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, CURRENT_DATE)
+        ''', (sym, resolve_inscode(conn, sym), data['buy'], data['sell'], data['stop'], data['note'], data['profile'], data['asset'], uid))
         conn.commit()
     except Exception as e:
         conn.rollback()
@@ -1412,7 +1408,7 @@ def get_watchlist_alerts(user_id):
     query = '''
         SELECT a.*, m.last_price, u.full_name as analyst_name 
         FROM analysis_signals a 
-        LEFT JOIN market_prices m ON a.symbol = m.symbol 
+        LEFT JOIN instrument_prices m ON m.inscode = a.inscode 
         LEFT JOIN users u ON a.owner_id = u.id
         WHERE (a.owner_id = ? OR a.is_public = 1)
     '''
@@ -1463,51 +1459,36 @@ def get_screener_data():
     """دریافت داده‌های غربالگر با محاسبه دقیق نقدینگی از روی تراکنش‌ها (نسخه ایمن شده)"""
     conn = get_db_connection()
     try:
-        portfolios = conn.execute("SELECT id, name, manager_name FROM portfolios").fetchall()
+        portfolios = conn.execute("SELECT id, name, manager_name, current_cash FROM portfolios").fetchall()
         results = []
         
         for p in portfolios:
             try:
                 pid = p['id']
                 
-                # 1. محاسبه دقیق نقدینگی از روی تراکنش‌ها (Real-time Calculation)
+                # 1. نقدینگی: دفتر نقدینگی سبد (همراه با هر تراکنش بروز می‌شود)
                 # فرمول: (واریز + فروش + سود نقدی) - (برداشت + خرید)
-                cash_calc = conn.execute('''
-                    SELECT 
-                        SUM(CASE WHEN transaction_type IN ('deposit', 'sell', 'dividend') THEN amount ELSE 0 END) -
-                        SUM(CASE WHEN transaction_type IN ('withdraw', 'buy') THEN amount ELSE 0 END) as balance
-                    FROM transactions 
-                    WHERE portfolio_id = ?
-                ''', (pid,)).fetchone()
-                
-                # تبدیل ایمن به float (اگر None بود، 0 شود)
-                cash = float(cash_calc['balance']) if cash_calc and cash_calc['balance'] is not None else 0.0
+                cash = float(p['current_cash'] or 0)
                 
                 # 2. محاسبه ارزش روز دارایی‌های سهامی/طلا
+                # مانده هر نماد (جدول positions) و قیمت روز آن با یک join (کلید عددی inscode)
                 holdings = conn.execute('''
-                    SELECT symbol, asset_class 
-                    FROM transactions 
-                    WHERE portfolio_id = ? 
-                    GROUP BY symbol
-                ''', (pid,)).fetchall()
+                    SELECT ps.symbol, i.asset_type AS asset_class, ps.qty AS balance, m.last_price
+                    FROM positions ps
+                    LEFT JOIN instrument_prices m ON m.inscode = ps.inscode
+                    LEFT JOIN instruments i ON i.inscode = ps.inscode
+                    WHERE ps.portfolio_id = ? AND ps.qty > ?
+                ''', (pid, EPSILON)).fetchall()
                 
                 current_holdings_value = 0.0
                 asset_classes = set()
                 symbols_list = []
                 
                 for h in holdings:
-                    # محاسبه تعداد مانده سهم
-                    qty_row = conn.execute('''
-                        SELECT SUM(CASE WHEN transaction_type='buy' THEN quantity ELSE -quantity END) as balance
-                        FROM transactions WHERE portfolio_id = ? AND symbol = ?
-                    ''', (pid, h['symbol'])).fetchone()
-                    
-                    qty = float(qty_row['balance']) if qty_row and qty_row['balance'] is not None else 0.0
+                    qty = float(h['balance']) if h['balance'] is not None else 0.0
                     
                     if qty > 0:
-                        # دریافت قیمت روز
-                        price_row = conn.execute("SELECT last_price FROM market_prices WHERE symbol = ?", (h['symbol'],)).fetchone()
-                        price = float(price_row['last_price']) if price_row and price_row['last_price'] is not None else 0.0
+                        price = float(h['last_price']) if h['last_price'] is not None else 0.0
                         
                         current_holdings_value += (qty * price)
                         if h['asset_class']: asset_classes.add(h['asset_class'])
@@ -1517,12 +1498,9 @@ def get_screener_data():
                 
                 # 3. محاسبه سود/زیان
                 # سرمایه آورده = واریز - برداشت
-                net_invested_row = conn.execute('''
-                    SELECT SUM(CASE WHEN transaction_type='deposit' THEN amount ELSE -amount END) as net
-                    FROM transactions WHERE portfolio_id = ? AND transaction_type IN ('deposit', 'withdraw')
-                ''', (pid,)).fetchone()
+                net_invested_row = conn.execute(INVESTED_SQL, (pid,)).fetchone()
                 
-                invested = float(net_invested_row['net']) if net_invested_row and net_invested_row['net'] is not None else 0.0
+                invested = float(net_invested_row['invested']) if net_invested_row and net_invested_row['invested'] is not None else 0.0
                 
                 # هندل کردن حالت خاص (سرمایه صفر ولی ارزش مثبت - مثلا سود نقدی مانده)
                 if invested <= 0 and total_value > 0:
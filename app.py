@@ -7,7 +7,8 @@ from flask_login import LoginManager, login_user, login_required, logout_user, c
 from flask_mail import Mail, Message
 
 # ایمپورت‌های دیتابیس و تحلیل
-from database import init_db, add_new_transaction, get_all_market_prices, update_stock_price, get_db_connection
+from database import (init_db, add_new_transaction, get_all_market_prices, update_stock_price, get_db_connection,
+                      release_db_connection, get_pool_stats)
 
 from analysis import (
     get_portfolio_summary, get_portfolio_details, calculate_trade_performance, 
@@ -17,13 +18,17 @@ from analysis import (
     get_model_details, add_model_asset, delete_model_asset,
     get_portfolio_events, add_event, process_dividend_payment, delete_event, distribute_corporate_action, 
     perform_stress_test, create_new_portfolio, update_portfolio_info, 
-    delete_portfolio_full, get_transaction_history, delete_transaction, get_symbol_transactions, update_transaction,
+    delete_portfolio_full, get_transaction_history, delete_transaction, delete_transactions, get_symbol_transactions, update_transaction,
     get_all_users, create_new_user, delete_user, update_event, update_user_role,
     get_all_market_events, get_all_dashboard_events, get_watchlist_alerts, get_shared_signals, get_screener_data
 )
 from utils import format_currency, to_jalali, to_persian_num, format_large_number, clean_input_number
 from models import User
 from tsetmc_service import fetch_market_data
+from migrations import migrate
+
+# مهاجرت‌های باقی‌مانده اسکیما (اگر اسکیما به‌روز باشد فقط PRAGMA user_version خوانده می‌شود)
+migrate()
 
 app = Flask(__name__)
 app.secret_key = 'my_super_secret_key_123'
@@ -50,6 +55,9 @@ login_manager.login_view = 'login'
 @login_manager.user_loader
 def load_user(user_id): return User.get(user_id)
 
+# اتصال مشترک دیتابیس هر درخواست در پایان آن بسته می‌شود
+app.teardown_appcontext(release_db_connection)
+
 app.jinja_env.filters['currency'] = format_currency
 app.jinja_env.filters['jalali'] = to_jalali
 app.jinja_env.filters['persian_num'] = to_persian_num
@@ -104,6 +112,7 @@ def dashboard():
     from analysis import get_aggregate_performance
     agg_perf = get_aggregate_performance(current_user.id)
     shared_signals = get_shared_signals(current_user.id)
+    from market_breadth import get_latest_breadth
     
     return render_template('dashboard.html', 
                            portfolios=portfolios, 
@@ -112,6 +121,7 @@ def dashboard():
                            agg_perf=agg_perf,
                            shared_signals=shared_signals,
                            watchlist=watchlist,
+                           breadth=get_latest_breadth(),
                            market_data=get_all_market_prices())
                            
 
@@ -204,7 +214,8 @@ def portfolio_details(portfolio_id):
     if result is None: return "پرتفوی یافت نشد", 404
     chart_data = get_portfolio_chart_data(portfolio_id)
     insights = generate_smart_insights(portfolio_id)
-    return render_template('portfolio_details.html', my_portfolio=result, target_config=result['target_config'], my_alignment_score=result['alignment_score'], current_allocation=result['current_allocation'], chart_data=chart_data, insights=insights, market_data=get_all_market_prices())
+    from order_book import LIQUIDITY_PARTICIPATION
+    return render_template('portfolio_details.html', my_portfolio=result, target_config=result['target_config'], my_alignment_score=result['alignment_score'], current_allocation=result['current_allocation'], chart_data=chart_data, insights=insights, market_data=get_all_market_prices(), liquidity_participation=LIQUIDITY_PARTICIPATION)
 
 # --- روت تقویم و یادداشت ---
 # در app.py جایگزین روت قبلی portfolio_calendar شود
@@ -364,6 +375,28 @@ def api_stress_test(portfolio_id):
     if result: return jsonify(result)
     return {"error": "Failed"}, 400
 
+@app.route('/api/portfolio/<int:portfolio_id>/sector_exposure')
+@login_required
+def api_sector_exposure(portfolio_id):
+    if not check_portfolio_access(portfolio_id): return {"error": "Access Denied"}, 403
+    from sector_exposure import get_sector_exposure
+    return jsonify({"sectors": get_sector_exposure(portfolio_id)})
+
+@app.route('/api/portfolio/<int:portfolio_id>/liquidity')
+@login_required
+def api_portfolio_liquidity(portfolio_id):
+    if not check_portfolio_access(portfolio_id): return {"error": "Access Denied"}, 403
+    from order_book import get_portfolio_liquidity
+    participation = request.args.get('participation', type=float)
+    return jsonify({"liquidity": get_portfolio_liquidity(portfolio_id, participation)})
+
+@app.route('/api/admin/sector-exposure')
+@login_required
+def firm_sector_exposure_api():
+    if current_user.username != 'admin': return "Access Denied", 403
+    from sector_exposure import get_all_sector_exposures
+    return jsonify(get_all_sector_exposures())
+
 @app.route('/transaction/edit', methods=['POST'])
 @login_required
 def edit_transaction_route():
@@ -385,10 +418,7 @@ def delete_transactions_bulk():
     try:
         data = request.json
         ids = data.get('ids', [])
-        count = 0
-        for trans_id in ids:
-            delete_transaction(trans_id)
-            count += 1
+        count = delete_transactions(ids)
         return jsonify({"status": "success", "message": f"{count} تراکنش حذف شد."})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -494,7 +524,7 @@ def edit_model_config():
         flash(f"تنظیمات مدل «{display_name}» با موفقیت بروزرسانی شد.", "success")
     except Exception as e:
         print(f"Update Config Error: {e}")
-        flash("خطا در بروزرسانی تنظیمات. (آیا ستون display_name در دیتابیس موجود است؟)", "error")
+        flash("خطا در بروزرسانی تنظیمات.", "error")
     finally:
         conn.close()
     
@@ -663,22 +693,32 @@ def delete_model_asset_route(id):
 @app.route('/update-prices')
 @login_required
 def update_prices_route(): 
-    # اول قیمت سهام
-    fetch_market_data()
-    
-    # دوم شاخص کل (اضافه شده)
-    from tsetmc_service import get_market_index
-    get_market_index()
-    
-    flash("قیمت‌ها و شاخص بازار با موفقیت به‌روزرسانی شدند.", "success")
+    # بروزرسانی در پس‌زمینه انجام می‌شود؛ درخواست‌های همزمان به یک job واحد می‌رسند
+    from market_refresher import trigger_refresh
+    job_id, created = trigger_refresh('web')
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'job_id': job_id, 'created': created}), 202
+
+    if created:
+        flash(f"بروزرسانی قیمت‌ها و شاخص آغاز شد (شماره {job_id}).", "success")
+    else:
+        flash(f"بروزرسانی در حال انجام است (شماره {job_id}).", "info")
     return redirect(request.referrer or url_for('dashboard'))
 
+@app.route('/api/refresh/<int:job_id>')
+@login_required
+def refresh_status_api(job_id):
+    from market_refresher import get_job_status
+    job = get_job_status(job_id)
+    if not job: return jsonify({'error': 'Not found'}), 404
+    return jsonify(job)
+
 
 @app.route('/api/rates')
 def api_rates():
-    from rates_service import get_latest_rates
-    from tsetmc_service import get_market_index
-    rates = get_latest_rates(); rates['total_index'] = get_market_index() or 0
+    from rates_service import get_cached_rates
+    rates = get_cached_rates(); rates['total_index'] = rates['total_index'] or 0
     return rates
 
 @app.route('/calendar/global', methods=['GET', 'POST'])
@@ -847,6 +887,63 @@ def settings():
     if current_user.username != 'admin': return redirect(url_for('dashboard'))
     return render_template('settings.html')
 
+@app.route('/api/admin/http-stats')
+@login_required
+def http_stats_api():
+    if current_user.username != 'admin': return "Access Denied", 403
+    from http_client import get_host_stats, get_mirror_stats
+    return jsonify({'hosts': get_host_stats(), 'mirrors': get_mirror_stats()})
+
+@app.route('/api/admin/asset-class', methods=['GET', 'POST'])
+@login_required
+def asset_class_api():
+    """مشاهده/ثبت طبقه‌بندی دستی نوع دارایی (symbol یا inscode، asset_class خالی = حذف)"""
+    if current_user.username != 'admin': return "Access Denied", 403
+    import asset_classifier
+    from database import resolve_inscode
+    conn = get_db_connection()
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or request.form
+            inscode = data.get('inscode')
+            if inscode:
+                inscode = int(inscode)
+            else:
+                inscode = resolve_inscode(conn, data.get('symbol', ''), create=False)
+            if inscode is None:
+                return jsonify({'error': 'نماد یافت نشد'}), 404
+            asset_class = data.get('asset_class')
+            try:
+                if asset_class:
+                    asset_classifier.set_override(conn, inscode, asset_class, data.get('market_type'), data.get('note'))
+                else:
+                    asset_classifier.remove_override(conn, inscode)
+                conn.commit()
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+        rows = conn.execute('''
+            SELECT o.inscode, i.symbol, o.asset_class, o.market_type, o.note, o.updated_at
+            FROM asset_class_overrides o LEFT JOIN instruments i ON i.inscode = o.inscode
+            ORDER BY i.symbol
+        ''').fetchall()
+        return jsonify({'classes': list(asset_classifier.ASSET_CLASSES), 'overrides': [dict(r) for r in rows]})
+    finally:
+        conn.close()
+
+@app.route('/api/admin/refresh-runs')
+@login_required
+def refresh_runs_api():
+    if current_user.username != 'admin': return "Access Denied", 403
+    from refresh_metrics import get_recent_runs
+    return jsonify(get_recent_runs(request.args.get('limit', 50, type=int), request.args.get('kind')))
+
+@app.route('/api/admin/db-pool')
+@login_required
+def db_pool_api():
+    if current_user.username != 'admin': return "Access Denied", 403
+    return jsonify(get_pool_stats())
+
 @app.route('/backup/download')
 @login_required
 def download_backup():
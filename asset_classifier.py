@@ -0,0 +1,174 @@
+import re
+
+# =========================================================
+# طبقه‌بندی نوع دارایی نمادها
+# نتیجه یک بار برای هر نماد در instruments.asset_type ذخیره می‌شود و
+# تحلیل‌ها فقط همین مقدار استاندارد را می‌خوانند (بدون جستجوی دوباره در متن).
+# =========================================================
+
+STOCK = 'Stock'
+ETF_GOLD = 'ETF_Gold'
+ETF_FIXED = 'ETF_Fixed'
+ETF_EQUITY = 'ETF_Equity'
+BOND = 'Bond'
+HOUSING = 'Housing'
+RIGHTS = 'Rights'
+
+ASSET_CLASSES = (STOCK, ETF_GOLD, ETF_FIXED, ETF_EQUITY, BOND, HOUSING, RIGHTS)
+
+# دسته تخصیص دارایی (مدل سبد / تست استرس) برای هر نوع
+ASSET_CATEGORY = {
+    ETF_GOLD: 'Gold',
+    ETF_FIXED: 'Fixed',
+}
+
+def get_category(asset_class):
+    """Stock / Gold / Fixed"""
+    return ASSET_CATEGORY.get(asset_class, 'Stock')
+
+GOLD_KEYWORDS = ['طلا', 'زر', 'نابی', 'گنج', 'عیار', 'کهربا', 'آلتون', 'نفیس']
+FIXED_KEYWORDS = ['درآمد ثابت', 'اعتماد', 'آفاق', 'تصمیم', 'کارا', 'افران', 'یاقوت']
+BOND_PREFIXES = ['اخزا', 'اراد', 'گام']
+HOUSING_PREFIXES = ['تسه', 'تملی']
+
+def _keywords(words):
+    return re.compile('|'.join(re.escape(w) for w in words))
+
+def _prefixes(words):
+    return re.compile('(?:' + '|'.join(re.escape(w) for w in words) + ')')
+
+_FUND_RE = _keywords(['صندوق', 'ETF'])
+_GOLD_RE = _keywords(GOLD_KEYWORDS)
+_FIXED_RE = _keywords(FIXED_KEYWORDS)
+_BOND_RE = _prefixes(BOND_PREFIXES)
+_HOUSING_RE = _prefixes(HOUSING_PREFIXES)
+# نام حق تقدم در TSETMC با «ح .» یا «حق تقدم» شروع می‌شود و نماد آن به «ح» ختم می‌شود
+_RIGHTS_RE = re.compile(r'^\s*(?:ح\s*\.|حق\s*تقدم)')
+RIGHTS_SUFFIX = 'ح'
+
+def _fix_chars(text):
+    return (text or '').replace('ي', 'ی').replace('ك', 'ک')
+
+def classify(symbol, name):
+    """تشخیص نوع دارایی و بازار؛ خروجی: (asset_class, market_type)"""
+    symbol = _fix_chars(symbol)
+    name = _fix_chars(name)
+
+    if _FUND_RE.search(name):
+        if _GOLD_RE.search(name):
+            return ETF_GOLD, 'ETF'
+        if _FIXED_RE.search(name):
+            return ETF_FIXED, 'ETF'
+        return ETF_EQUITY, 'ETF'
+    if _BOND_RE.match(symbol):
+        return BOND, 'IFB'
+    if _HOUSING_RE.match(symbol):
+        return HOUSING, 'IFB'
+    if _RIGHTS_RE.match(name) or symbol.strip().endswith(RIGHTS_SUFFIX):
+        return RIGHTS, 'TSE'
+    return STOCK, 'TSE'
+
+# مقادیر قدیمی (فارسی/ترکیبی) ذخیره شده در دیتابیس
+_LEGACY_PATTERNS = (
+    (re.compile('Gold|طلا'), ETF_GOLD),
+    (re.compile('Fixed|ثابت'), ETF_FIXED),
+    (re.compile('Bond|خزانه|اوراق'), BOND),
+    (re.compile('Housing|مسکن'), HOUSING),
+    (re.compile('Rights|حق تقدم'), RIGHTS),
+    # صندوق‌های کالایی (مثل زعفران) در نسخه قبلی «کالایی (Commodity)» ذخیره می‌شدند
+    (re.compile('ETF|صندوق|Fund|Commodity|کالایی'), ETF_EQUITY),
+    (re.compile('Stock|سهام'), STOCK),
+)
+
+def _legacy_asset_class(value):
+    """مقدار استاندارد یک مقدار قدیمی، یا None اگر شناخته نشود"""
+    if value in ASSET_CLASSES:
+        return value
+    value = value or ''
+    for pattern, asset_class in _LEGACY_PATTERNS:
+        if pattern.search(value):
+            return asset_class
+    return None
+
+def normalize_asset_class(value):
+    """تبدیل مقدار قدیمی نوع دارایی به مقدار استاندارد (پیش‌فرض Stock)"""
+    return _legacy_asset_class(value) or STOCK
+
+def normalize_instruments(conn):
+    """
+    استانداردسازی asset_type نمادهای موجود (مهاجرت یک‌باره)؛ خروجی: تعداد ردیف‌های اصلاح شده
+    مقدارهای ناشناخته Stock می‌شوند و برای ثبت طبقه‌بندی دستی (set_override) چاپ می‌شوند.
+    """
+    placeholders = ','.join('?' * len(ASSET_CLASSES))
+    rows = conn.execute(
+        f"SELECT inscode, asset_type FROM instruments WHERE asset_type IS NOT NULL AND asset_type NOT IN ({placeholders})",
+        ASSET_CLASSES
+    ).fetchall()
+    unknown = [r for r in rows if _legacy_asset_class(r[1]) is None]
+    if unknown:
+        print(f"Unknown asset classes set to {STOCK}, review with a manual override: "
+              + ', '.join(f"{r[0]} ({r[1]})" for r in unknown))
+    conn.executemany(
+        "UPDATE instruments SET asset_type = ? WHERE inscode = ?",
+        [(normalize_asset_class(r[1]), r[0]) for r in rows]
+    )
+    return len(rows)
+
+def reclassify_rights(conn):
+    """
+    تشخیص حق تقدم‌های ثبت شده به عنوان سهام (مهاجرت یک‌باره؛ classify فقط برای نمادهای جدید اجرا می‌شود)
+    خروجی: تعداد ردیف‌های اصلاح شده (commit با فراخواننده است)
+    """
+    rows = conn.execute(
+        "SELECT inscode, symbol, company_name FROM instruments WHERE asset_type IS NULL OR asset_type = ?", (STOCK,)
+    ).fetchall()
+    changes = [(RIGHTS, r[0]) for r in rows if classify(r[1], r[2])[0] == RIGHTS]
+    conn.executemany("UPDATE instruments SET asset_type = ? WHERE inscode = ?", changes)
+    return len(changes)
+
+def apply_overrides(conn, inscode=None):
+    """اعمال طبقه‌بندی دستی مدیر روی instruments (commit با فراخواننده است)"""
+    sql = '''
+        UPDATE instruments SET
+            asset_type = (SELECT o.asset_class FROM asset_class_overrides o WHERE o.inscode = instruments.inscode),
+            market_type = COALESCE(
+                (SELECT o.market_type FROM asset_class_overrides o WHERE o.inscode = instruments.inscode),
+                market_type)
+        WHERE inscode IN (SELECT inscode FROM asset_class_overrides)
+    '''
+    params = ()
+    if inscode is not None:
+        sql += " AND inscode = ?"
+        params = (inscode,)
+    return conn.execute(sql, params).rowcount
+
+def _bump_instruments(conn):
+    # database این ماژول را import می‌کند، پس import داخل تابع است
+    from database import bump_data_versions
+    bump_data_versions(conn, 'instruments')
+
+def set_override(conn, inscode, asset_class, market_type=None, note=None):
+    """ثبت طبقه‌بندی دستی برای یک نماد و اعمال فوری آن (commit با فراخواننده است)"""
+    if asset_class not in ASSET_CLASSES:
+        raise ValueError(f"Unknown asset class: {asset_class}")
+    conn.execute('''
+        INSERT INTO asset_class_overrides (inscode, asset_class, market_type, note, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(inscode) DO UPDATE SET
+            asset_class = excluded.asset_class, market_type = excluded.market_type,
+            note = excluded.note, updated_at = CURRENT_TIMESTAMP
+    ''', (inscode, asset_class, market_type, note))
+    apply_overrides(conn, inscode)
+    _bump_instruments(conn)
+
+def remove_override(conn, inscode):
+    """حذف طبقه‌بندی دستی و بازگشت به تشخیص خودکار (commit با فراخواننده است)"""
+    conn.execute("DELETE FROM asset_class_overrides WHERE inscode = ?", (inscode,))
+    row = conn.execute("SELECT symbol, company_name FROM instruments WHERE inscode = ?", (inscode,)).fetchone()
+    if row:
+        asset_class, market_type = classify(row[0], row[1])
+        conn.execute(
+            "UPDATE instruments SET asset_type = ?, market_type = ? WHERE inscode = ?",
+            (asset_class, market_type, inscode)
+        )
+    _bump_instruments(conn)
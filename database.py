@@ -1,10 +1,19 @@
 import sqlite3
 import os
+import sys
+import threading
+import asset_classifier
+import positions
 
 DB_NAME = "portfolio_manager.db"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'portfolio_manager.db')
 
+# اتصال مشترک هر رشته (درخواست وب یا رشته پس‌زمینه)؛ KINKO_DB_POOL=0 یعنی اتصال جدید در هر فراخوانی
+DB_POOL_ENABLED = os.environ.get('KINKO_DB_POOL', '1') == '1'
+DB_CACHE_KB = int(os.environ.get('KINKO_DB_CACHE_KB', 32768))
+DB_MMAP_MB = int(os.environ.get('KINKO_DB_MMAP_MB', 256))
+
 COMMISSION_RATES = {
     'TSE': { # بازار بورس
         'Stock': {'buy': 0.003712, 'sell': 0.0088},
@@ -21,21 +30,235 @@ COMMISSION_RATES = {
     }
 }
 
+# نام گروه‌های صنعت TSETMC (کد ستون ۱۸ دیده‌بان)؛ در init_db به جدول sectors اضافه می‌شود
+# و قابل ویرایش دستی است (نام‌های ویرایش شده بازنویسی نمی‌شوند)
+SECTOR_NAMES = {
+    1: 'زراعت و خدمات وابسته',
+    2: 'جنگلداری و ماهیگیری',
+    10: 'استخراج زغال سنگ',
+    11: 'استخراج نفت گاز و خدمات جنبی',
+    13: 'استخراج کانه‌های فلزی',
+    14: 'استخراج سایر معادن',
+    17: 'منسوجات',
+    19: 'دباغی، پرداخت چرم و ساخت انواع پاپوش',
+    20: 'محصولات چوبی',
+    21: 'محصولات کاغذی',
+    22: 'انتشار، چاپ و تکثیر',
+    23: 'فراورده‌های نفتی، کک و سوخت هسته‌ای',
+    25: 'لاستیک و پلاستیک',
+    27: 'فلزات اساسی',
+    28: 'ساخت محصولات فلزی',
+    29: 'ماشین‌آلات و تجهیزات',
+    31: 'ماشین‌آلات و دستگاه‌های برقی',
+    32: 'ساخت دستگاه‌ها و وسایل ارتباطی',
+    33: 'ابزار پزشکی، اپتیکی و اندازه‌گیری',
+    34: 'خودرو و ساخت قطعات',
+    35: 'سایر تجهیزات حمل و نقل',
+    36: 'مبلمان و مصنوعات دیگر',
+    38: 'قند و شکر',
+    39: 'شرکت‌های چند رشته‌ای صنعتی',
+    40: 'عرضه برق، گاز، بخار و آب گرم',
+    41: 'جمع‌آوری، تصفیه و توزیع آب',
+    42: 'محصولات غذایی و آشامیدنی به جز قند و شکر',
+    43: 'مواد و محصولات دارویی',
+    44: 'محصولات شیمیایی',
+    45: 'پیمانکاری صنعتی',
+    46: 'تجارت عمده فروشی به جز وسایل نقلیه موتوری',
+    47: 'خرده فروشی به استثنای وسایل نقلیه موتوری',
+    49: 'کاشی و سرامیک',
+    50: 'تجارت عمده و خرده فروشی وسایل نقلیه موتوری',
+    51: 'حمل و نقل هوایی',
+    52: 'انبارداری و حمایت از فعالیت‌های حمل و نقل',
+    53: 'سیمان، آهک و گچ',
+    54: 'سایر محصولات کانی غیرفلزی',
+    55: 'هتل و رستوران',
+    56: 'سرمایه‌گذاری‌ها',
+    57: 'بانک‌ها و موسسات اعتباری',
+    58: 'سایر واسطه‌گری‌های مالی',
+    59: 'اوراق حق تقدم استفاده از تسهیلات مسکن',
+    60: 'حمل و نقل، انبارداری و ارتباطات',
+    61: 'حمل و نقل آبی',
+    63: 'فعالیت‌های پشتیبانی و کمکی حمل و نقل',
+    64: 'مخابرات',
+    65: 'واسطه‌گری‌های مالی و پولی',
+    66: 'بیمه و صندوق بازنشستگی به جز تامین اجتماعی',
+    67: 'فعالیت‌های کمکی به نهادهای مالی واسط',
+    68: 'صندوق سرمایه‌گذاری قابل معامله',
+    69: 'اوراق تامین مالی',
+    70: 'انبوه‌سازی، املاک و مستغلات',
+    71: 'فعالیت مهندسی، تجزیه، تحلیل و آزمایش فنی',
+    72: 'رایانه و فعالیت‌های وابسته به آن',
+    73: 'اطلاعات و ارتباطات',
+    74: 'خدمات فنی و مهندسی',
+    76: 'اوراق بهادار مبتنی بر دارایی فکری',
+    77: 'فعالیت‌های اجاره و لیزینگ',
+    82: 'فعالیت‌های پشتیبانی اجرایی اداری',
+    84: 'سلامت انسان و مددکاری اجتماعی',
+    90: 'فعالیت‌های هنری، سرگرمی و خلاقانه',
+    93: 'فعالیت‌های فرهنگی و ورزشی',
+    98: 'گروه اوراق غیرفعال',
+}
+
+# جداولی که تغییرشان کش‌های محاسباتی را باطل می‌کند (شمارنده در data_versions)
+# هر نویسنده پس از یک دسته تغییر یک بار bump_data_versions را صدا می‌زند (نه تریگر سطری)
+VERSIONED_TABLES = {
+    'transactions': 'transactions',
+    'instrument_prices': 'prices',
+    'instruments': 'instruments',
+}
+
 def normalize_text(text):
     if not text: return ""
     return text.replace('ك', 'ک').replace('ي', 'ی').replace('ى', 'ی').strip()
 
-def get_db_connection():
+def normalize_symbol(text):
+    """کلید جستجوی نماد: یکسان‌سازی حروف و حذف فاصله و نیم‌فاصله"""
+    return normalize_text(text).replace('\u200c', '').replace(' ', '')
+
+class PooledConnection(sqlite3.Connection):
+    """
+    اتصال قابل استفاده مجدد یک رشته: هر get_db_connection اتصالی را در اختیار می‌گیرد که در همان لحظه
+    دست فراخوانی دیگری نیست (فراخوانی تو در تو اتصال جدای خود را دارد و commit آن کار بیرونی را commit نمی‌کند).
+    close() مثل بستن واقعی تراکنش commit نشده را لغو می‌کند و اتصال را برای فراخوانی بعدی کنار می‌گذارد.
+    بستن واقعی: release_db_connection (پایان درخواست وب یا هر دور رشته پس‌زمینه)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = args[0] if args else kwargs.get('database')
+        self.in_use = False
+
+    def close(self):
+        if not self.in_use:
+            return
+        self.in_use = False
+        if self.in_transaction:
+            self.rollback()
+        _pool.idle.append(self)
+
+    def release(self):
+        super().close()
+
+_pool = threading.local()
+_pool_lock = threading.Lock()
+_pool_stats = {'hits': 0, 'misses': 0, 'released': 0, 'open': 0}
+
+def _open_connection(factory=sqlite3.Connection):
     # اضافه کردن timeout=20 ثانیه برای حل مشکل locked
-    conn = sqlite3.connect(DB_PATH, timeout=20) 
+    conn = sqlite3.connect(DB_PATH, timeout=20, factory=factory)
     conn.row_factory = sqlite3.Row
-    # فعال کردن حالت WAL برای همزمانی بهتر
-    conn.execute('PRAGMA journal_mode=WAL;') 
+    # فعال کردن حالت WAL برای همزمانی بهتر؛ بقیه تنظیمات فقط یک بار برای هر اتصال
+    conn.execute('PRAGMA journal_mode=WAL;')
+    conn.execute('PRAGMA synchronous=NORMAL;')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_KB};')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_MB * 1024 * 1024};')
+    conn.execute('PRAGMA temp_store=MEMORY;')
+    return conn
+
+def get_db_connection():
+    """اتصال دیتابیس؛ در هر رشته یک اتصال مشترک (با تنظیمات یک باره) بین همه فراخوانی‌ها"""
+    if not DB_POOL_ENABLED:
+        return _open_connection()
+
+    if getattr(_pool, 'conns', None) is None:
+        _pool.conns, _pool.idle = [], []
+    elif _pool.conns and _pool.conns[0].path != DB_PATH:
+        release_db_connection()
+        _pool.conns, _pool.idle = [], []
+    if _pool.idle:
+        conn = _pool.idle.pop()
+        with _pool_lock:
+            _pool_stats['hits'] += 1
+    else:
+        conn = _open_connection(PooledConnection)
+        _pool.conns.append(conn)
+        with _pool_lock:
+            _pool_stats['misses'] += 1
+            _pool_stats['open'] += 1
+    conn.in_use = True
     return conn
 
+def release_db_connection(exc=None):
+    """بستن اتصال‌های رشته فعلی (تراکنش commit نشده لغو می‌شود)؛ برای teardown فلسک و حلقه‌های پس‌زمینه"""
+    conns = getattr(_pool, 'conns', None)
+    if not conns:
+        return
+    _pool.conns, _pool.idle = [], []
+    for conn in conns:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        finally:
+            conn.release()
+            with _pool_lock:
+                _pool_stats['released'] += 1
+                _pool_stats['open'] -= 1
+
+def get_pool_stats():
+    """آمار استفاده مجدد از اتصال‌ها: hits (اتصال موجود)، misses (اتصال جدید)، open (اتصال‌های باز)"""
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / total, 3) if total else None
+    stats['enabled'] = DB_POOL_ENABLED
+    return stats
+
+
+def _add_column(c, table, column, decl):
+    """افزودن ستون به جدول موجود (اگر قبلا اضافه نشده باشد)"""
+    columns = [row[1] for row in c.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _is_table(c, name):
+    row = c.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return bool(row) and row[0] == 'table'
+
+def _split_market_prices(conn):
+    """
+    مهاجرت جدول قدیمی market_prices (کلید: نماد) به instruments + instrument_prices
+    پس از انتقال، جدول حذف و به جای آن view هم‌نام ساخته می‌شود.
+    """
+    _add_column(conn, 'market_prices', 'inscode', 'INTEGER')
+    rows = conn.execute('''
+        SELECT symbol, inscode, company_name, sector, asset_type, market_type,
+               last_price, close_price_yesterday, pe_ratio, updated_at
+        FROM market_prices ORDER BY updated_at
+    ''').fetchall()
+
+    for row in rows:
+        inscode = row['inscode'] or resolve_inscode(conn, row['symbol'])
+        if inscode is None:
+            continue
+        conn.execute('''
+            INSERT INTO instruments
+            (inscode, symbol, symbol_norm, company_name, sector, asset_type, market_type, pe_ratio)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(inscode) DO UPDATE SET
+                company_name = COALESCE(excluded.company_name, company_name),
+                sector = excluded.sector, asset_type = excluded.asset_type,
+                market_type = excluded.market_type, pe_ratio = excluded.pe_ratio
+        ''', (inscode, row['symbol'], normalize_symbol(row['symbol']), row['company_name'], row['sector'],
+              row['asset_type'], row['market_type'], row['pe_ratio']))
+        conn.execute('''
+            INSERT OR REPLACE INTO instrument_prices (inscode, last_price, close_price_yesterday, updated_at)
+            VALUES (?, ?, ?, ?)
+        ''', (inscode, row['last_price'], row['close_price_yesterday'], row['updated_at']))
+
+    conn.execute("DROP TABLE market_prices")
 
 def init_db():
-    conn = get_db_connection()
+    """ساخت/تکمیل کامل اسکیما: اسکیمای پایه از نو (idempotent) و مهاجرت‌های باقی‌مانده (migrations.py)"""
+    import migrations
+    migrations.migrate(force=True)
+    print("دیتابیس کامل ساخته شد.")
+
+def create_schema(conn):
+    """
+    اسکیمای پایه (مهاجرت شماره ۱)؛ همه دستورات idempotent هستند.
+    تغییرات جدید اسکیما به جای این تابع به صورت مهاجرت شماره‌دار در migrations.py اضافه می‌شوند.
+    commit با فراخواننده است.
+    """
     c = conn.cursor()
     
     # 1. کاربران
@@ -96,7 +319,7 @@ def init_db():
         )
     ''')
 
-    # 4. قیمت‌ها
+    # 4. قیمت‌ها (در بخش 17 به instruments + instrument_prices تقسیم و با view جایگزین می‌شود)
     c.execute('''
         CREATE TABLE IF NOT EXISTS market_prices (
             symbol TEXT PRIMARY KEY,
@@ -199,12 +422,349 @@ def init_db():
     ''')
     # ایجاد ردیف اولیه اگر وجود ندارد
     c.execute("INSERT OR IGNORE INTO market_overview (id, total_index) VALUES (1, 0)")
+
+    # 11. صف بروزرسانی قیمت‌ها (برای یکی کردن درخواست‌های همزمان و پیگیری وضعیت)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS refresh_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT DEFAULT 'queued',   -- queued, running, done, failed
+            source TEXT,                    -- web, schedule
+            message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+    # 12. تاریخچه روزانه شاخص کل (کلید: تاریخ میلادی به صورت عدد YYYYMMDD)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS index_history (
+            tarikh INTEGER PRIMARY KEY,
+            index_value REAL
+        )
+    ''')
     
-    # --- پایان تغییرات ---
+    # 13. تاریخچه لحظه‌ای قیمت‌ها (فقط افزودنی؛ ts = زمان یونیکس به ثانیه)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS price_ticks (
+            inscode INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            last_price REAL,
+            close_price REAL,
+            volume REAL,
+            PRIMARY KEY (inscode, ts)
+        ) WITHOUT ROWID
+    ''')
 
-    conn.commit() # ذخیره نهایی
-    conn.close()  # بستن اتصال (این باید آخرین خط باشد)
-    print("دیتابیس کامل ساخته شد.")
+    # 14. قیمت‌های روزانه هر نماد (tarikh: تاریخ میلادی به صورت عدد YYYYMMDD)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_bars (
+            inscode INTEGER NOT NULL,
+            tarikh INTEGER NOT NULL,
+            open_price REAL,
+            high_price REAL,
+            low_price REAL,
+            close_price REAL,
+            last_price REAL,
+            volume REAL,
+            value REAL,
+            trades INTEGER,
+            PRIMARY KEY (inscode, tarikh)
+        ) WITHOUT ROWID
+    ''')
+
+    # 15. وضعیت دریافت تاریخچه روزانه هر نماد (برای ادامه پس از توقف)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS bar_backfill (
+            inscode INTEGER PRIMARY KEY,
+            status TEXT DEFAULT 'pending',  -- pending, done, empty (پاسخ بدون قیمت), failed
+            last_tarikh INTEGER,
+            attempts INTEGER DEFAULT 0,
+            version INTEGER DEFAULT 0,      -- با هر ذخیره یکی زیاد می‌شود (اعتبارسنجی کش)
+            message TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 16. فهرست نمادها با کلید کد TSETMC (inscode)
+    # کدهای منفی موقت‌اند (نمادهای ثبت شده پیش از دریافت کد واقعی) و بعدا جایگزین می‌شوند
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS instruments (
+            inscode INTEGER PRIMARY KEY,
+            symbol TEXT NOT NULL,
+            symbol_norm TEXT NOT NULL,     -- نماد یکسان‌سازی شده برای جستجو
+            company_name TEXT,
+            isin TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_instruments_symbol_norm ON instruments (symbol_norm)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_instruments_name ON instruments (company_name)")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_instruments_symbol ON instruments (symbol)")
+
+    # ستون inscode در جداول قبلی (برای دیتابیس‌های موجود)
+    for table in ('transactions', 'analysis_signals'):
+        _add_column(c, table, 'inscode', 'INTEGER')
+    # ایندکس inscode تراکنش‌ها در مهاجرت ایندکس‌ها (db_indexes) ساخته می‌شود
+    c.execute("CREATE INDEX IF NOT EXISTS idx_signals_inscode ON analysis_signals (inscode)")
+
+    # 17. اطلاعات ثابت نماد در instruments و قیمت‌ها در جدول باریک instrument_prices
+    # (بروزرسانی قیمت دیگر نام، نوع دارایی، صنعت و P/E را بازنویسی نمی‌کند)
+    _add_column(c, 'instruments', 'sector', 'TEXT')
+    _add_column(c, 'instruments', 'asset_type', 'TEXT')
+    _add_column(c, 'instruments', 'market_type', "TEXT DEFAULT 'TSE'")
+    _add_column(c, 'instruments', 'pe_ratio', 'REAL')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS instrument_prices (
+            inscode INTEGER PRIMARY KEY,
+            last_price REAL,
+            close_price_yesterday REAL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    if _is_table(c, 'market_prices'):
+        _split_market_prices(conn)
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS market_prices AS
+        SELECT i.symbol, i.inscode, i.company_name, i.sector, i.asset_type, i.market_type,
+               p.last_price, p.close_price_yesterday, i.pe_ratio, p.updated_at
+        FROM instruments i
+        JOIN instrument_prices p ON p.inscode = i.inscode
+    ''')
+    assign_missing_inscodes(conn)
+
+    # 18. طبقه‌بندی دستی نوع دارایی (اولویت بر تشخیص خودکار)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS asset_class_overrides (
+            inscode INTEGER PRIMARY KEY,
+            asset_class TEXT NOT NULL,     -- Stock, ETF_Gold, ETF_Fixed, ETF_Equity, Bond, Housing, Rights
+            market_type TEXT,
+            note TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # مقادیر قدیمی asset_type (مثل «صندوق طلا (Gold)») به مقدار استاندارد تبدیل می‌شوند
+    asset_classifier.normalize_instruments(conn)
+    asset_classifier.apply_overrides(conn)
+
+    # 19. کد گروه صنعت هر نماد و دیکشنری نام صنایع؛ صنعت market_prices از این دیکشنری خوانده می‌شود
+    # (instruments.sector فقط برای نمادهای بدون کد، مثل نمادهای دستی، استفاده می‌شود)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sectors (
+            code INTEGER PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+    ''')
+    c.executemany("INSERT OR IGNORE INTO sectors (code, name) VALUES (?, ?)", SECTOR_NAMES.items())
+    _add_column(c, 'instruments', 'sector_code', 'INTEGER')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_instruments_sector_code ON instruments (sector_code)")
+    # صنعت ثابت «بازار بورس» که قبلا برای همه نمادها نوشته می‌شد معنایی ندارد
+    c.execute("UPDATE instruments SET sector = NULL WHERE sector = 'بازار بورس'")
+    c.execute("DROP VIEW IF EXISTS market_prices")
+    c.execute('''
+        CREATE VIEW market_prices AS
+        SELECT i.symbol, i.inscode, i.company_name, COALESCE(s.name, i.sector) AS sector, i.sector_code,
+               i.asset_type, i.market_type, p.last_price, p.close_price_yesterday, i.pe_ratio, p.updated_at
+        FROM instruments i
+        JOIN instrument_prices p ON p.inscode = i.inscode
+        LEFT JOIN sectors s ON s.code = i.sector_code
+    ''')
+
+    # 20. شمارنده نسخه داده‌ها برای باطل کردن کش‌ها (مثل وزن صنایع) پس از هر دسته تغییر قیمت یا تراکنش
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for name in VERSIONED_TABLES.values():
+        c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (name,))
+
+    # 21. آمار کلی بازار در هر دور بروزرسانی (یک ردیف در هر دور، ts ثانیه یونیکس)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS market_breadth (
+            ts INTEGER PRIMARY KEY,
+            instruments INTEGER,       -- تعداد نمادهای معامله شده
+            advancers INTEGER,
+            decliners INTEGER,
+            unchanged INTEGER,
+            total_value REAL,          -- ارزش معاملات (ریال)
+            total_volume REAL,
+            total_trades INTEGER,
+            at_upper INTEGER,          -- نمادهای در سقف مجاز روزانه
+            at_lower INTEGER,          -- نمادهای در کف مجاز روزانه
+            limit_fraction REAL,       -- سهم نمادهای در سقف یا کف
+            top_value TEXT,            -- JSON بیشترین ارزش معاملات
+            top_gainers TEXT,          -- JSON بیشترین رشد
+            top_losers TEXT            -- JSON بیشترین افت
+        )
+    ''')
+
+    # 22. آخرین دفتر سفارش (بهترین مظنه‌ها) نمادهای موجود در سبدها
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS order_book (
+            inscode INTEGER PRIMARY KEY,
+            levels TEXT,               -- JSON: [[level, buy_count, buy_volume, buy_price, sell_price, sell_volume, sell_count], ...]
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 23. زمان‌سنجی مراحل هر دور بروزرسانی بازار (refresh_metrics)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS refresh_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,                 -- full / delta
+            started_at REAL,           -- ثانیه یونیکس
+            ok INTEGER,
+            total_ms REAL,
+            stages TEXT,               -- JSON: مرحله -> میلی‌ثانیه
+            counts TEXT,               -- JSON: شمارنده‌ها (rows, bytes, inserted, ...)
+            errors TEXT,               -- JSON: دلیل خطا -> تعداد
+            message TEXT
+        )
+    ''')
+
+    # --- پایان تغییرات (بقیه در migrations.py) ---
+
+def resolve_inscode(conn, symbol, create=True):
+    """
+    کد TSETMC یک نماد نمایشی
+    ترتیب جستجو: ردیف فعلی market_prices، جدول instruments و در نهایت (اگر create)
+    یک کد موقت منفی که پس از دریافت کد واقعی در rekey_synthetic_instruments جایگزین می‌شود.
+    commit با فراخواننده است.
+    """
+    symbol = normalize_text(symbol)
+    if not symbol:
+        return None
+
+    row = conn.execute(
+        "SELECT inscode FROM market_prices WHERE symbol = ? AND inscode IS NOT NULL ORDER BY updated_at DESC LIMIT 1",
+        (symbol,)
+    ).fetchone()
+    if row:
+        return row[0]
+
+    key = normalize_symbol(symbol)
+    row = conn.execute(
+        "SELECT inscode FROM instruments WHERE symbol_norm = ? ORDER BY inscode > 0 DESC, updated_at DESC LIMIT 1",
+        (key,)
+    ).fetchone()
+    if row:
+        return row[0]
+    if not create:
+        return None
+
+    lowest = conn.execute("SELECT IFNULL(MIN(inscode), 0) FROM instruments WHERE inscode < 0").fetchone()[0]
+    conn.execute(
+        "INSERT INTO instruments (inscode, symbol, symbol_norm, company_name) VALUES (?, ?, ?, ?)",
+        (lowest - 1, symbol, key, symbol)
+    )
+    return lowest - 1
+
+def sync_instruments(conn, rows, classify=None):
+    """
+    ثبت/بروزرسانی نمادهای دیده‌بان در instruments (فقط ردیف‌های جدید یا تغییر کرده)
+    rows: رکوردهای دارای inscode, isin, symbol, name, sector_code
+    classify(symbol, name) -> (asset_type, market_type) فقط برای نمادهای جدید (یا بدون نوع) اجرا می‌شود؛
+    صنعت، نوع دارایی و P/E نمادهای موجود دست نمی‌خورند.
+    خروجی: تعداد ردیف‌های نوشته شده (commit با فراخواننده است)
+    """
+    current = {
+        r[0]: (r[1], r[2], r[3], r[4], r[5])
+        for r in conn.execute(
+            "SELECT inscode, symbol, company_name, isin, sector_code, asset_type FROM instruments WHERE inscode > 0"
+        )
+    }
+    new_rows = []
+    changes = []
+    for row in rows:
+        if not row.symbol:
+            continue
+        existing = current.get(row.inscode)
+        if existing is None or existing[4] is None:
+            asset_type, market_type = classify(row.symbol, row.name) if classify else (None, 'TSE')
+            new_rows.append((row.inscode, row.symbol, normalize_symbol(row.symbol), row.name, row.isin,
+                             row.sector_code, asset_type, market_type))
+        elif existing[:4] != (row.symbol, row.name, row.isin, row.sector_code):
+            changes.append((row.symbol, normalize_symbol(row.symbol), row.name, row.isin, row.sector_code, row.inscode))
+
+    if new_rows:
+        conn.executemany('''
+            INSERT INTO instruments
+            (inscode, symbol, symbol_norm, company_name, isin, sector_code, asset_type, market_type, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(inscode) DO UPDATE SET
+                symbol = excluded.symbol, symbol_norm = excluded.symbol_norm,
+                company_name = excluded.company_name, isin = excluded.isin,
+                sector_code = excluded.sector_code,
+                asset_type = excluded.asset_type, market_type = excluded.market_type,
+                updated_at = CURRENT_TIMESTAMP
+        ''', new_rows)
+    if changes:
+        conn.executemany('''
+            UPDATE instruments SET symbol = ?, symbol_norm = ?, company_name = ?, isin = ?, sector_code = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE inscode = ?
+        ''', changes)
+    if new_rows or changes:
+        bump_data_versions(conn, 'instruments')
+    return len(new_rows) + len(changes)
+
+def rekey_synthetic_instruments(conn):
+    """
+    جایگزینی کدهای موقت منفی با کد واقعی نمادی که همان نماد یکسان‌سازی شده را دارد
+    (اولویت با کدی که market_prices برای این نماد نگه می‌دارد)
+    خروجی: تعداد کدهای جایگزین شده (commit با فراخواننده است)
+    """
+    pairs = conn.execute('''
+        SELECT s.inscode,
+               COALESCE(
+                   (SELECT m.inscode FROM market_prices m WHERE m.symbol = s.symbol AND m.inscode > 0),
+                   (SELECT r.inscode FROM instruments r
+                    WHERE r.symbol_norm = s.symbol_norm AND r.inscode > 0
+                    ORDER BY r.updated_at DESC LIMIT 1)
+               )
+        FROM instruments s WHERE s.inscode < 0
+    ''').fetchall()
+
+    count = 0
+    for old, new in pairs:
+        if new is None:
+            continue
+        for table in ('transactions', 'analysis_signals', 'positions'):
+            conn.execute(f"UPDATE {table} SET inscode = ? WHERE inscode = ?", (new, old))
+        # اطلاعات وارد شده دستی (صنعت، P/E، نوع دارایی) از کد موقت به کد واقعی منتقل می‌شود
+        conn.execute('''
+            UPDATE instruments SET
+                sector = COALESCE((SELECT sector FROM instruments WHERE inscode = :old), sector),
+                asset_type = COALESCE((SELECT asset_type FROM instruments WHERE inscode = :old), asset_type),
+                market_type = COALESCE((SELECT market_type FROM instruments WHERE inscode = :old), market_type),
+                pe_ratio = COALESCE((SELECT pe_ratio FROM instruments WHERE inscode = :old), pe_ratio)
+            WHERE inscode = :new
+        ''', {'old': old, 'new': new})
+        # طبقه‌بندی دستی کد موقت هم منتقل می‌شود (مگر اینکه کد واقعی خودش طبقه‌بندی دستی داشته باشد)
+        conn.execute("UPDATE OR IGNORE asset_class_overrides SET inscode = ? WHERE inscode = ?", (new, old))
+        conn.execute("DELETE FROM asset_class_overrides WHERE inscode = ?", (old,))
+        conn.execute("DELETE FROM instrument_prices WHERE inscode = ?", (old,))
+        conn.execute("DELETE FROM instruments WHERE inscode = ?", (old,))
+        count += 1
+    if count:
+        bump_data_versions(conn, 'instruments', 'transactions')
+    return count
+
+def assign_missing_inscodes(conn):
+    """نسبت دادن کد به ردیف‌هایی که فقط نماد دارند (مهاجرت داده‌های قبلی و ورودی‌های بدون کد؛ commit با فراخواننده است)"""
+    sources = (
+        ('transactions', "inscode IS NULL AND transaction_type IN ('buy', 'sell')"),
+        ('analysis_signals', "inscode IS NULL"),
+    )
+    for table, condition in sources:
+        symbols = [r[0] for r in conn.execute(f"SELECT DISTINCT symbol FROM {table} WHERE {condition}")]
+        for symbol in symbols:
+            inscode = resolve_inscode(conn, symbol)
+            if inscode is not None:
+                conn.execute(f"UPDATE {table} SET inscode = ? WHERE symbol = ? AND {condition}", (inscode, symbol))
 
 def get_all_market_prices():
     conn = get_db_connection()
@@ -217,6 +777,38 @@ def get_all_market_prices():
     conn.close()
     return prices
 
+def transaction_commission(t_type, quantity, price, asset_type, market_type):
+    """کارمزد خرید/فروش بر اساس نوع دارایی و بازار (ثبت و ویرایش تراکنش)"""
+    total_val = quantity * price
+
+    # الف) صندوق‌ها (بر اساس نوع استاندارد دارایی)
+    if asset_type == asset_classifier.ETF_GOLD:
+        rate = COMMISSION_RATES['ETF']['Gold'].get(t_type, 0)
+    elif asset_type == asset_classifier.ETF_FIXED:
+        rate = COMMISSION_RATES['ETF']['Fixed'].get(t_type, 0)
+    elif asset_type == asset_classifier.ETF_EQUITY:
+        # صندوق سهامی/مختلط
+        rate = COMMISSION_RATES['ETF']['Equity'].get(t_type, 0)
+
+    # ب) سهام و حق تقدم (بورس یا فرابورس)
+    else:
+        # انتخاب بازار (TSE یا IFB)
+        mkt = market_type if market_type in ['TSE', 'IFB'] else 'TSE'
+        # انتخاب نوع دارایی (سهام یا حق تقدم)
+        kind = 'Rights' if asset_type == asset_classifier.RIGHTS else 'Stock'
+
+        rate = COMMISSION_RATES[mkt][kind].get(t_type, 0)
+
+    return total_val * rate
+
+def transaction_amount(t_type, quantity, price, commission):
+    """مبلغ نهایی تراکنش: خرید با کارمزد، فروش پس از کسر کارمزد و بقیه همان مبلغ وارد شده"""
+    if t_type == 'buy':
+        return (quantity * price) + commission
+    if t_type == 'sell':
+        return (quantity * price) - commission
+    return price
+
 def add_new_transaction(data):
     conn = get_db_connection()
     try:
@@ -241,6 +833,8 @@ def add_new_transaction(data):
                 asset_type = row['asset_type'] or "Stock"
                 market_type = row['market_type'] or "TSE"
 
+        inscode = resolve_inscode(conn, symbol) if t_type in ['buy', 'sell'] else None
+
         if t_type in ['deposit', 'withdraw', 'dividend']:
             sector = "بانکی"
             asset_class_db = "Cash"
@@ -251,55 +845,23 @@ def add_new_transaction(data):
         if 'commission' in data:
             commission = float(data['commission'])
         else:
-            total_val = quantity * price
-            commission = 0
-            
-            # الف) تشخیص نوع صندوق
-            if 'ETF' in asset_type or 'صندوق' in asset_type:
-                # تشخیص نوع ETF
-                if 'Gold' in asset_type or 'طلا' in asset_type:
-                    rate = COMMISSION_RATES['ETF']['Gold'].get(t_type, 0)
-                elif 'Fixed' in asset_type or 'ثابت' in asset_type:
-                    rate = COMMISSION_RATES['ETF']['Fixed'].get(t_type, 0)
-                else:
-                    # فرض بر صندوق سهامی/مختلط
-                    rate = COMMISSION_RATES['ETF']['Equity'].get(t_type, 0)
-            
-            # ب) سهام و حق تقدم (بورس یا فرابورس)
-            else:
-                # انتخاب بازار (TSE یا IFB)
-                mkt = market_type if market_type in ['TSE', 'IFB'] else 'TSE'
-                # انتخاب نوع دارایی (سهام یا حق تقدم)
-                kind = 'Rights' if (symbol and symbol.endswith('ح')) else 'Stock'
-                
-                rate = COMMISSION_RATES[mkt][kind].get(t_type, 0)
-            
-            commission = total_val * rate
+            commission = transaction_commission(t_type, quantity, price, asset_type, market_type)
 
         # 3. محاسبه مبلغ نهایی
-        amount = 0
-        if t_type == 'buy':
-            amount = (quantity * price) + commission
-        elif t_type == 'sell':
-            amount = (quantity * price) - commission
-        else:
-            amount = price
+        amount = transaction_amount(t_type, quantity, price, commission)
 
-        # 4. ثبت
+        # 4. ثبت (همراه با اثر نقدی تراکنش)
+        delta = cash_delta(t_type, amount)
         conn.execute('''
             INSERT INTO transactions 
-            (portfolio_id, transaction_type, symbol, sector, quantity, price, amount, commission, date, asset_class)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (p_id, t_type, symbol, sector, quantity, price, amount, commission, date, asset_class_db))
+            (portfolio_id, transaction_type, symbol, inscode, sector, quantity, price, amount, commission, date, asset_class, cash_delta)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (p_id, t_type, symbol, inscode, sector, quantity, price, amount, commission, date, asset_class_db, delta))
+        positions.apply_transaction(conn, p_id, symbol, inscode, t_type, quantity, price, commission, date)
         
         # 5. آپدیت نقدینگی (بصورت بهینه و مستقیم)
-        cash_impact = 0
-        if t_type in ['deposit', 'sell', 'dividend']:
-            cash_impact = amount
-        elif t_type in ['withdraw', 'buy']:
-            cash_impact = -amount
-
-        conn.execute("UPDATE portfolios SET current_cash = current_cash + ? WHERE id = ?", (cash_impact, p_id))
+        adjust_cash(conn, p_id, delta)
+        bump_data_versions(conn, 'transactions')
         
         conn.commit()
         return True
@@ -315,7 +877,11 @@ def add_new_transaction(data):
 
 def update_stock_price(symbol, new_price):
     conn = get_db_connection()
-    conn.execute('UPDATE market_prices SET last_price=?, updated_at=CURRENT_TIMESTAMP WHERE symbol=?', (new_price, symbol))
+    conn.execute('''
+        UPDATE instrument_prices SET last_price=?, updated_at=CURRENT_TIMESTAMP
+        WHERE inscode IN (SELECT inscode FROM instruments WHERE symbol=?)
+    ''', (new_price, symbol))
+    bump_data_versions(conn, 'prices')
     conn.commit()
     conn.close()
 
@@ -326,31 +892,134 @@ def set_market_index(value):
     conn.commit()
     conn.close()
 
-def recalculate_portfolio_cash(portfolio_id):
+def bump_data_versions(conn, *names):
+    """
+    افزایش نسخه داده‌ها پس از یک دسته تغییر (یک UPDATE برای کل دسته؛ commit با فراخواننده است)
+    names: 'transactions'، 'prices' یا 'instruments' (مقادیر VERSIONED_TABLES)
+    """
+    placeholders = ','.join('?' * len(names))
+    conn.execute(f"UPDATE data_versions SET version = version + 1 WHERE name IN ({placeholders})", names)
+
+def get_data_versions(conn, names=None):
     """
-    محاسبه مجدد و دقیق مانده نقدینگی بر اساس تمام تراکنش‌های ثبت شده.
-    این تابع تضمین می‌کند که عدد نقدینگی همیشه با تراکنش‌ها همخوانی دارد.
+    نسخه فعلی داده‌ها (تراکنش‌ها، قیمت‌ها، نمادها) برای اعتبارسنجی کش‌ها
+    names: فقط نسخه همین داده‌ها (کشی که به قیمت‌ها وابسته نیست با هر بروزرسانی قیمت باطل نشود)
     """
+    if names is None:
+        rows = conn.execute("SELECT name, version FROM data_versions ORDER BY name")
+    else:
+        placeholders = ','.join('?' * len(names))
+        rows = conn.execute(
+            f"SELECT name, version FROM data_versions WHERE name IN ({placeholders}) ORDER BY name", tuple(names)
+        )
+    return tuple(tuple(r) for r in rows)
+
+def get_stored_market_index():
+    """آخرین شاخص ذخیره شده در market_overview بدون هیچ درخواست شبکه؛ خروجی: (مقدار، زمان بروزرسانی)"""
     conn = get_db_connection()
     try:
-        # فرمول: (واریز + فروش + سود نقدی) - (برداشت + خرید)
-        calc = conn.execute('''
-            SELECT 
-                (SELECT IFNULL(SUM(amount), 0) FROM transactions WHERE portfolio_id = ? AND transaction_type IN ('deposit', 'sell', 'dividend')) 
-                - 
-                (SELECT IFNULL(SUM(amount), 0) FROM transactions WHERE portfolio_id = ? AND transaction_type IN ('withdraw', 'buy'))
-            as final_cash
-        ''', (portfolio_id, portfolio_id)).fetchone()
-        
-        real_cash = calc['final_cash'] if calc else 0
-        
-        # آپدیت عدد در جدول سبدها
-        conn.execute("UPDATE portfolios SET current_cash = ? WHERE id = ?", (real_cash, portfolio_id))
-        conn.commit()
-    except Exception as e:
-        print(f"Cash Recalc Error: {e}")
+        row = conn.execute("SELECT total_index, updated_at FROM market_overview WHERE id = 1").fetchone()
+    finally:
+        conn.close()
+    if not row or not row['total_index']:
+        return None, None
+    return float(row['total_index']), row['updated_at']
+
+# =========================================================
+# دفتر نقدینگی: هر تراکنش اثر نقدی خود (cash_delta) را دارد و current_cash سبد
+# با ثبت/ویرایش/حذف همان تراکنش و در همان تراکنش دیتابیس جمع زده می‌شود.
+# فرمول: (واریز + فروش + سود نقدی) - (برداشت + خرید)
+# =========================================================
+
+# محاسبه کامل از روی مبلغ ثبت شده تراکنش (همان مبنای محاسبه قبلی نقدینگی)؛
+# مبلغ صفر در واریز/برداشت/سود نقدی (داده‌های قدیمی) = قیمت × تعداد
+CASH_DELTA_SQL = '''
+    CASE
+        WHEN transaction_type = 'buy' THEN -IFNULL(amount, 0)
+        WHEN transaction_type = 'sell' THEN IFNULL(amount, 0)
+        WHEN transaction_type IN ('deposit', 'withdraw', 'dividend') THEN
+            (CASE WHEN transaction_type = 'withdraw' THEN -1 ELSE 1 END) *
+            (CASE WHEN IFNULL(amount, 0) = 0
+                  THEN IFNULL(price, 0) * (CASE WHEN quantity > 0 THEN quantity ELSE 1 END)
+                  ELSE amount END)
+        ELSE 0 END
+'''
+
+# مبلغ مورد انتظار خرید/فروش از روی تعداد، قیمت و کارمزد (فقط برای گزارش مبلغ‌های ناهمخوان)
+TRADE_AMOUNT_SQL = '''
+    CASE transaction_type
+        WHEN 'buy' THEN IFNULL(quantity, 0) * IFNULL(price, 0) + IFNULL(commission, 0)
+        ELSE IFNULL(quantity, 0) * IFNULL(price, 0) - IFNULL(commission, 0) END
+'''
+
+def cash_delta(t_type, amount):
+    """اثر یک تراکنش بر نقدینگی سبد"""
+    if t_type in ('deposit', 'sell', 'dividend'):
+        return float(amount or 0)
+    if t_type in ('withdraw', 'buy'):
+        return -float(amount or 0)
+    return 0.0
+
+def adjust_cash(conn, portfolio_id, delta):
+    """اعمال تغییر نقدینگی سبد (commit با فراخواننده است)"""
+    if delta:
+        conn.execute("UPDATE portfolios SET current_cash = IFNULL(current_cash, 0) + ? WHERE id = ?", (delta, portfolio_id))
+
+def verify_portfolio_cash(fix=False, tolerance=0.5):
+    """
+    مقایسه نقدینگی ذخیره شده هر سبد با محاسبه کامل از روی مبلغ تراکنش‌ها (بررسی دوره‌ای، فقط گزارش)
+    fix: فقط برای اجرای دستی مدیر؛ cash_delta تراکنش‌ها و نقدینگی سبدهای ناهمخوان از نو نوشته می‌شود
+    (مبلغ تراکنش‌ها هرگز تغییر نمی‌کند)
+    خروجی: لیست (portfolio_id, نقدینگی ذخیره شده، جمع cash_delta، محاسبه کامل)
+    """
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(f'''
+            SELECT p.id, IFNULL(p.current_cash, 0) AS stored,
+                   IFNULL(SUM(t.cash_delta), 0) AS ledger,
+                   IFNULL(SUM({CASH_DELTA_SQL}), 0) AS expected,
+                   SUM(t.id IS NOT NULL AND t.cash_delta IS NULL) AS missing
+            FROM portfolios p LEFT JOIN transactions t ON t.portfolio_id = p.id
+            GROUP BY p.id
+        ''').fetchall()
+        mismatches = [
+            (r['id'], r['stored'], r['ledger'], r['expected']) for r in rows
+            if r['missing'] or abs(r['stored'] - r['expected']) > tolerance or abs(r['ledger'] - r['expected']) > tolerance
+        ]
+        if fix and mismatches:
+            for pid, _, _, expected in mismatches:
+                conn.execute(f"UPDATE transactions SET cash_delta = {CASH_DELTA_SQL} WHERE portfolio_id = ?", (pid,))
+                conn.execute("UPDATE portfolios SET current_cash = ? WHERE id = ?", (expected, pid))
+            bump_data_versions(conn, 'transactions')
+            conn.commit()
+        return mismatches
+    finally:
+        conn.close()
+
+def find_amount_mismatches(tolerance=0.5):
+    """
+    خرید/فروش‌هایی که مبلغ ثبت شده‌شان با تعداد × قیمت ± کارمزد نمی‌خواند (فقط گزارش، بدون تغییر داده)
+    خروجی: لیست (transaction_id, portfolio_id, مبلغ ثبت شده، مبلغ مورد انتظار)
+    """
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(f'''
+            SELECT id, portfolio_id, IFNULL(amount, 0) AS amount, {TRADE_AMOUNT_SQL} AS expected
+            FROM transactions
+            WHERE transaction_type IN ('buy', 'sell') AND ABS(IFNULL(amount, 0) - ({TRADE_AMOUNT_SQL})) > ?
+            ORDER BY portfolio_id, id
+        ''', (tolerance,)).fetchall()
+        return [(r['id'], r['portfolio_id'], r['amount'], r['expected']) for r in rows]
     finally:
         conn.close()
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    # python database.py                   ساخت/به‌روزرسانی اسکیما
+    # python database.py verify-cash [--fix]  بررسی دفتر نقدینگی (--fix: بازنویسی cash_delta و نقدینگی سبدها)
+    if sys.argv[1:2] == ['verify-cash']:
+        for pid, stored, ledger, expected in verify_portfolio_cash(fix='--fix' in sys.argv):
+            print(f"portfolio {pid}: stored={stored} ledger={ledger} expected={expected}")
+        for tid, pid, amount, expected in find_amount_mismatches():
+            print(f"transaction {tid} (portfolio {pid}): amount={amount} qty*price+-commission={expected}")
+    else:
+        init_db()
\ No newline at end of file
@@ -0,0 +1,179 @@
+import sys
+
+# =========================================================
+# ایندکس‌های مدیریت شده برای مسیرهای پرکاربرد (تراکنش‌ها، تقویم، تحلیل‌ها)
+# مهاجرت‌های ۴ و ۷ (migrations.py) آن‌ها را می‌سازند؛ تغییر INDEXES یک مهاجرت جدید لازم دارد
+# (ensure_indexes ایندکسی را که تعریفش عوض شده از نو می‌سازد).
+#   python db_indexes.py            ساخت ایندکس‌ها، ANALYZE / PRAGMA optimize و نمایش پلن
+#   python db_indexes.py --explain  فقط نمایش EXPLAIN QUERY PLAN پرس‌وجوهای پرکاربرد
+# =========================================================
+
+# نام -> (جدول، ستون‌ها)؛ ستون‌های انتهایی برای پوشش کامل پرس‌وجو (بدون مراجعه به جدول) آمده‌اند
+INDEXES = {
+    # بازپخش تراکنش‌های یک سبد به ترتیب تاریخ (rowid همان id است و ترتیب ORDER BY date, id را کامل می‌کند)
+    'idx_transactions_portfolio_date': ('transactions', ('portfolio_id', 'date')),
+    # مانده هر نماد یک سبد (GROUP BY symbol) و مانده در یک تاریخ
+    'idx_transactions_portfolio_symbol': ('transactions', ('portfolio_id', 'symbol', 'date', 'transaction_type', 'quantity')),
+    # جمع واریز/برداشت/خرید/فروش برای محاسبه نقدینگی
+    'idx_transactions_portfolio_type': ('transactions', ('portfolio_id', 'transaction_type', 'amount')),
+    # مانده نمادها در همه سبدها (وزن صنایع، دفتر سفارش نمادهای موجود)
+    'idx_transactions_inscode': ('transactions', ('inscode', 'transaction_type', 'portfolio_id', 'quantity')),
+    # نمادهای دارای مانده در همه سبدها (وزن صنایع، دفتر سفارش)؛ مانده هر سبد از کلید اصلی positions
+    'idx_positions_inscode': ('positions', ('inscode', 'qty', 'portfolio_id')),
+    'idx_calendar_events_date': ('calendar_events', ('event_date',)),
+    'idx_calendar_events_portfolio_date': ('calendar_events', ('portfolio_id', 'event_date')),
+    'idx_signals_owner': ('analysis_signals', ('owner_id', 'added_at')),
+    'idx_signals_public': ('analysis_signals', ('is_public', 'added_at')),
+}
+
+# پرس‌وجوهای پرکاربرد برای بررسی پلن (پارامترها فقط برای EXPLAIN)
+HOT_QUERIES = {
+    # مانده‌ها و قیمت روز (calculate_positions، تحلیل ریسک و غربالگر)
+    'positions': ('''
+        SELECT ps.symbol, ps.qty, ps.cost,
+               m.last_price, i.company_name, COALESCE(s.name, i.sector) AS sector
+        FROM positions ps
+        LEFT JOIN instrument_prices m ON m.inscode = ps.inscode
+        LEFT JOIN instruments i ON i.inscode = m.inscode
+        LEFT JOIN sectors s ON s.code = i.sector_code
+        WHERE ps.portfolio_id = ? AND ps.qty > ?
+    ''', (1, 0.001)),
+    'screener_holdings': ('''
+        SELECT ps.symbol, i.asset_type AS asset_class, ps.qty AS balance, m.last_price
+        FROM positions ps
+        LEFT JOIN instrument_prices m ON m.inscode = ps.inscode
+        LEFT JOIN instruments i ON i.inscode = ps.inscode
+        WHERE ps.portfolio_id = ? AND ps.qty > ?
+    ''', (1, 0.001)),
+    'sector_exposure': ('''
+        SELECT pos.portfolio_id, i.sector_code, COALESCE(s.name, i.sector, 'سایر') AS sector,
+               SUM(pos.qty * IFNULL(p.last_price, 0)) AS value
+        FROM positions pos
+        JOIN instruments i ON i.inscode = pos.inscode
+        LEFT JOIN instrument_prices p ON p.inscode = pos.inscode
+        LEFT JOIN sectors s ON s.code = i.sector_code
+        WHERE pos.inscode IS NOT NULL AND pos.qty > 0.001
+        GROUP BY pos.portfolio_id, 3
+    ''', ()),
+    'held_inscodes': (
+        "SELECT DISTINCT inscode FROM positions WHERE inscode IS NOT NULL AND qty > 0.001", ()),
+    'portfolio_liquidity': (
+        "SELECT inscode, qty FROM positions WHERE portfolio_id = ? AND inscode IS NOT NULL AND qty > 0.001", (1,)),
+    'transaction_history': (
+        "SELECT * FROM transactions WHERE portfolio_id = ? ORDER BY date DESC, id DESC", (1,)),
+    'symbol_transactions': (
+        "SELECT * FROM transactions WHERE portfolio_id = ? AND symbol = ? ORDER BY date DESC, id DESC", (1, '')),
+    # بازسازی مانده یک نماد (positions.refresh_position)
+    'symbol_trades': ('''
+        SELECT portfolio_id, symbol, inscode, transaction_type, quantity, price, commission, date
+        FROM transactions
+        WHERE transaction_type IN ('buy', 'sell') AND symbol IS NOT NULL AND symbol != ''
+          AND portfolio_id = ? AND symbol = ? ORDER BY date, id
+    ''', (1, '')),
+    'holding_at_date': (
+        "SELECT transaction_type, quantity FROM transactions WHERE portfolio_id = ? AND symbol = ? AND date <= ?",
+        (1, '', '')),
+    'invested_capital': ('''
+        SELECT transaction_type, amount, price, quantity FROM transactions
+        WHERE portfolio_id = ? AND transaction_type IN ('deposit', 'withdraw')
+    ''', (1,)),
+    'portfolio_events': (
+        "SELECT * FROM calendar_events WHERE portfolio_id = ? ORDER BY event_date DESC", (1,)),
+    'dashboard_events': ('''
+        SELECT e.id, e.title, e.event_date, p.name FROM calendar_events e
+        LEFT JOIN portfolios p ON e.portfolio_id = p.id
+        WHERE e.event_date >= date('now') ORDER BY e.event_date ASC LIMIT 8
+    ''', ()),
+    'my_signals': ('''
+        SELECT a.*, m.last_price, i.company_name FROM analysis_signals a
+        LEFT JOIN instrument_prices m ON m.inscode = a.inscode
+        LEFT JOIN instruments i ON i.inscode = m.inscode
+        WHERE a.owner_id = ? ORDER BY a.added_at DESC
+    ''', (1,)),
+    'shared_signals': ('''
+        SELECT a.*, m.last_price FROM analysis_signals a
+        LEFT JOIN instrument_prices m ON m.inscode = a.inscode
+        WHERE a.is_public = 1 ORDER BY a.added_at DESC
+    ''', ()),
+}
+
+def _index_sql(name, table, columns):
+    return f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"
+
+def ensure_indexes(conn):
+    """
+    ساخت ایندکس‌های INDEXES؛ ایندکس هم‌نامی که تعریف دیگری دارد حذف و از نو ساخته می‌شود
+    ایندکس جدولی که هنوز ساخته نشده (مهاجرت بعدی) رد می‌شود و مهاجرت ایندکس بعدی آن را می‌سازد.
+    خروجی: لیست نام ایندکس‌های ساخته شده (commit با فراخواننده است)
+    """
+    existing = {
+        r[0]: r[1] for r in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")
+    }
+    tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    created = []
+    for name, (table, columns) in INDEXES.items():
+        if table not in tables:
+            continue
+        sql = _index_sql(name, table, columns)
+        current = existing.get(name)
+        if current is not None and ' '.join(current.split()).replace(' IF NOT EXISTS', '') == sql:
+            continue
+        if current is not None:
+            conn.execute(f"DROP INDEX {name}")
+        conn.execute(sql)
+        created.append(name)
+    return created
+
+def optimize(conn):
+    """بروزرسانی آمار برنامه‌ریز (ANALYZE) و PRAGMA optimize"""
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    conn.commit()
+
+def is_full_scan(detail):
+    """پیمایش کامل جدول: SCAN بدون ایندکس (پیمایش ایندکس پوششی یا view قابل قبول است)"""
+    return detail.startswith('SCAN ') and ' USING ' not in detail and not detail.startswith('SCAN CONSTANT')
+
+def explain(conn):
+    """
+    EXPLAIN QUERY PLAN پرس‌وجوهای HOT_QUERIES
+    خروجی: دیکشنری نام -> {'plan': [سطرهای پلن], 'full_scans': [...], 'temp_sort': bool}
+    """
+    result = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        result[name] = {
+            'plan': plan,
+            'full_scans': [d for d in plan if is_full_scan(d)],
+            'temp_sort': any('USE TEMP B-TREE' in d for d in plan),
+        }
+    return result
+
+def main(argv):
+    from database import get_db_connection
+
+    conn = get_db_connection()
+    try:
+        if '--explain' not in argv:
+            created = ensure_indexes(conn)
+            conn.commit()
+            print(f"Indexes created: {', '.join(created) or 'none (all up to date)'}")
+            optimize(conn)
+            print("ANALYZE / PRAGMA optimize done.")
+
+        plans = explain(conn)
+    finally:
+        conn.close()
+
+    bad = 0
+    for name, info in plans.items():
+        flag = 'FULL SCAN' if info['full_scans'] else ('TEMP SORT' if info['temp_sort'] else 'ok')
+        bad += bool(info['full_scans'])
+        print(f"\n[{flag}] {name}")
+        for detail in info['plan']:
+            print(f"    {detail}")
+    print(f"\n{len(plans) - bad}/{len(plans)} hot queries use indexes.")
+    return 1 if bad else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
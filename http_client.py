@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# =========================================================
+# کلاینت HTTP مشترک برای تمام درخواست‌های بیرونی (TSETMC و TGJU)
+# برای هر هاست یک Session با اتصالات keep-alive نگه داشته می‌شود
+# تا هر درخواست هزینه دست‌دهی TCP/TLS جدید نپردازد.
+# =========================================================
+
+# تنظیمات قابل تغییر از طریق متغیرهای محیطی
+POOL_MAXSIZE = int(os.environ.get('KINKO_HTTP_POOL_MAXSIZE', 4))        # حداکثر اتصال همزمان به هر هاست
+RETRY_TOTAL = int(os.environ.get('KINKO_HTTP_RETRIES', 2))
+RETRY_BACKOFF = float(os.environ.get('KINKO_HTTP_BACKOFF', 0.5))         # 0.5, 1, 2 ... ثانیه
+CONNECT_TIMEOUT = float(os.environ.get('KINKO_HTTP_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('KINKO_HTTP_READ_TIMEOUT', 20))
+
+# درخواست موازی (Hedged): اگر آینه اول تا این مدت جواب نداد، آینه بعدی هم درخواست می‌شود
+HEDGE_DELAY = float(os.environ.get('KINKO_HTTP_HEDGE_DELAY', 3))
+HEDGE_WORKERS = int(os.environ.get('KINKO_HTTP_HEDGE_WORKERS', 8))
+
+# قطع‌کننده مدار (Circuit Breaker): پس از چند شکست پیاپی، درخواست به آن هاست
+# تا پایان زمان استراحت بلافاصله رد می‌شود تا سرور از کار افتاده زیر فشار نرود
+BREAKER_THRESHOLD = int(os.environ.get('KINKO_HTTP_BREAKER_THRESHOLD', 3))
+BREAKER_COOLDOWN = float(os.environ.get('KINKO_HTTP_BREAKER_COOLDOWN', 60))
+
+# ضبط و بازپخش (Record/Replay) برای اجرای آفلاین (بنچمارک و تست):
+# KINKO_HTTP_CAPTURE: پوشه‌ای که پاسخ خام همه درخواست‌ها در آن ذخیره می‌شود
+# KINKO_HTTP_STUB: آدرس سرور استاب (stub_server.py)؛ همه درخواست‌ها به جای هاست اصلی به آن فرستاده می‌شوند
+CAPTURE_DIR = os.environ.get('KINKO_HTTP_CAPTURE') or None
+STUB_URL = os.environ.get('KINKO_HTTP_STUB') or None
+
+# محدودیت اختصاصی اتصال برای برخی هاست‌ها
+HOST_POOL_LIMITS = {
+    'www.tgju.org': 2,
+}
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """درخواست به دلیل باز بودن مدار هاست ارسال نشد"""
+
+_lock = threading.Lock()
+_sessions = {}
+_breakers = {}       # host -> {'failures', 'open_until'}
+_host_stats = {}
+_mirror_order = {}   # group -> لیست هاست‌ها (برنده آخر اول)
+_mirror_wins = {}    # group -> {host: تعداد برد}
+_capture_seq = {}    # digest -> شماره آخرین پاسخ ضبط شده
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+
+def _build_session(host):
+    retry = Retry(
+        total=RETRY_TOTAL,
+        connect=RETRY_TOTAL,
+        read=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False
+    )
+    pool_size = HOST_POOL_LIMITS.get(host, POOL_MAXSIZE)
+    # pool_block=True یعنی بیش از pool_size اتصال همزمان به این هاست باز نمی‌شود
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_session(url):
+    """Session اختصاصی هاست آدرس (ساخته می‌شود اگر وجود ندارد)"""
+    host = urlsplit(url).netloc
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = _build_session(host)
+            _sessions[host] = session
+    return session
+
+def _record(host, elapsed_ms, status_code=None, error=None):
+    with _lock:
+        stats = _host_stats.setdefault(host, {
+            'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0,
+            'last_status': None, 'last_error': None
+        })
+        stats['requests'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['last_ms'] = elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        if status_code is not None:
+            stats['last_status'] = status_code
+        if error is not None or (status_code is not None and status_code >= 400):
+            stats['errors'] += 1
+            stats['last_error'] = str(error) if error is not None else f"HTTP {status_code}"
+
+def _breaker_check(host):
+    with _lock:
+        breaker = _breakers.get(host)
+        if breaker and breaker['open_until'] > time.time():
+            raise CircuitOpenError(f"Circuit open for {host}")
+
+def _breaker_record(host, success):
+    with _lock:
+        breaker = _breakers.setdefault(host, {'failures': 0, 'open_until': 0.0})
+        if success:
+            breaker['failures'] = 0
+            breaker['open_until'] = 0.0
+        else:
+            breaker['failures'] += 1
+            if breaker['failures'] >= BREAKER_THRESHOLD:
+                # پس از پایان استراحت یک درخواست آزمایشی عبور می‌کند؛ شکست دوباره مدار را باز می‌کند
+                breaker['open_until'] = time.time() + BREAKER_COOLDOWN
+
+def is_circuit_open(url):
+    host = urlsplit(url).netloc
+    with _lock:
+        breaker = _breakers.get(host)
+        return bool(breaker and breaker['open_until'] > time.time())
+
+def capture_key(url):
+    """کلید ضبط/بازپخش یک آدرس: هاست + مسیر + کوئری (بدون scheme)"""
+    parts = urlsplit(url)
+    return parts.netloc + parts.path + ('?' + parts.query if parts.query else '')
+
+def set_capture_dir(path):
+    """فعال (یا با None غیرفعال) کردن ضبط پاسخ‌ها در زمان اجرا"""
+    global CAPTURE_DIR
+    CAPTURE_DIR = path
+
+def set_stub_url(url):
+    """هدایت (یا با None توقف هدایت) همه درخواست‌ها به سرور استاب"""
+    global STUB_URL
+    STUB_URL = url
+
+def _capture(url, response):
+    """ذخیره پاسخ خام: <digest>-<seq>.json (مشخصات) و <digest>-<seq>.body (بدنه)"""
+    key = capture_key(url)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    directory = CAPTURE_DIR
+    with _lock:
+        seq = _capture_seq.get(digest)
+        if seq is None:
+            os.makedirs(directory, exist_ok=True)
+            seq = len([f for f in os.listdir(directory) if f.startswith(digest) and f.endswith('.json')])
+        _capture_seq[digest] = seq + 1
+    name = os.path.join(directory, f"{digest}-{seq:05d}")
+    with open(name + '.body', 'wb') as f:
+        f.write(response.content)
+    meta = {
+        'url': url,
+        'key': key,
+        'status': response.status_code,
+        'content_type': response.headers.get('Content-Type'),
+        'captured_at': time.time(),
+    }
+    with open(name + '.json', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+def _maybe_capture(url, response):
+    if CAPTURE_DIR:
+        try:
+            _capture(url, response)
+        except OSError as e:
+            print(f"HTTP capture failed for {url}: {e}")
+
+def get(url, headers=None, timeout=None, capture=True, **kwargs):
+    """
+    درخواست GET از طریق Session مشترک هاست
+    timeout پیش‌فرض: (اتصال، خواندن) از تنظیمات بالا؛ عدد تکی هم پذیرفته می‌شود.
+    capture: ضبط پاسخ در KINKO_HTTP_CAPTURE (درخواست‌های موازی فقط پاسخ برنده را ضبط می‌کنند)
+    قطع‌کننده مدار و آمار بر اساس هاست اصلی است، حتی وقتی درخواست به سرور استاب می‌رود.
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    original_url = url
+    if STUB_URL:
+        url = STUB_URL.rstrip('/') + '/' + capture_key(url)
+    host = urlsplit(original_url).netloc
+    _breaker_check(host)
+    session = get_session(url)
+
+    started = time.perf_counter()
+    try:
+        response = session.get(url, headers=headers, timeout=timeout, **kwargs)
+    except Exception as e:
+        _record(host, (time.perf_counter() - started) * 1000, error=e)
+        _breaker_record(host, success=False)
+        raise
+    _record(host, (time.perf_counter() - started) * 1000, status_code=response.status_code)
+    _breaker_record(host, success=response.status_code < 500)
+    if capture:
+        _maybe_capture(original_url, response)
+    return response
+
+def get_host_stats():
+    """شمارنده‌های تاخیر هر هاست (میلی‌ثانیه)"""
+    with _lock:
+        result = {}
+        for host, stats in _host_stats.items():
+            item = dict(stats)
+            item['avg_ms'] = round(stats['total_ms'] / stats['requests'], 1) if stats['requests'] else 0.0
+            breaker = _breakers.get(host)
+            item['circuit_open'] = bool(breaker and breaker['open_until'] > time.time())
+            result[host] = item
+        return result
+
+def reset_host_stats():
+    with _lock:
+        _host_stats.clear()
+
+def _ordered_urls(group, urls):
+    """مرتب‌سازی آینه‌ها: هاست آخرین برنده این گروه اول امتحان می‌شود"""
+    with _lock:
+        preferred = _mirror_order.get(group, [])
+    rank = {host: i for i, host in enumerate(preferred)}
+    return sorted(urls, key=lambda u: (rank.get(urlsplit(u).netloc, len(rank)), urls.index(u)))
+
+def _record_winner(group, url):
+    host = urlsplit(url).netloc
+    with _lock:
+        _mirror_order[group] = [host] + [h for h in _mirror_order.get(group, []) if h != host]
+        wins = _mirror_wins.setdefault(group, {})
+        wins[host] = wins.get(host, 0) + 1
+
+def _hedge_attempt(url, parse, cancel, headers, timeout, kwargs):
+    """
+    یک تلاش: فقط هدرها دریافت می‌شود و اگر تلاش دیگری برنده شده بود، بدنه خوانده نمی‌شود
+    خروجی: (مقدار معتبر، پاسخ) یا None؛ ضبط پاسخ با hedged_fetch و فقط برای برنده است
+    """
+    try:
+        response = get(url, headers=headers, timeout=timeout, stream=True, capture=False, **kwargs)
+    except Exception:
+        return None
+    try:
+        if cancel.is_set():
+            return None
+        value = parse(response)
+        return (value, response) if value is not None else None
+    except Exception:
+        return None
+    finally:
+        response.close()
+
+def hedged_fetch(group, candidates, delay=None, headers=None, timeout=None, **kwargs):
+    """
+    دریافت موازی از چند آینه و برگرداندن اولین پاسخ معتبر
+    candidates: لیست (url, parse) که parse(response) مقدار معتبر یا None برمی‌گرداند.
+    آینه بعدی پس از delay ثانیه (یا بلافاصله پس از شکست قبلی) درخواست می‌شود.
+    خروجی: (value, url برنده) یا (None, None)
+    """
+    if delay is None:
+        delay = HEDGE_DELAY
+    parsers = dict(candidates)
+    urls = [url for url, _ in candidates]
+    order = _ordered_urls(group, urls)
+
+    cancel = threading.Event()
+    active = {}
+    next_index = 0
+
+    def launch():
+        nonlocal next_index
+        url = order[next_index]
+        next_index += 1
+        future = _hedge_executor.submit(_hedge_attempt, url, parsers[url], cancel, headers, timeout, kwargs)
+        active[future] = url
+
+    launch()
+    try:
+        while active:
+            remaining = next_index < len(order)
+            done, _ = wait(list(active), timeout=delay if remaining else None, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                url = active.pop(future)
+                result = future.result()
+                if result is not None:
+                    value, response = result
+                    _record_winner(group, url)
+                    _maybe_capture(url, response)
+                    return value, url
+
+            # یا زمان انتظار تمام شد (hedge) یا تلاش قبلی شکست خورد
+            if next_index < len(order):
+                launch()
+        return None, None
+    finally:
+        # لغو بازنده‌ها: تلاش‌های شروع نشده لغو و تلاش‌های در جریان پس از دریافت هدر رها می‌شوند
+        cancel.set()
+        for future in active:
+            future.cancel()
+
+def get_mirror_stats():
+    """ترتیب فعلی آینه‌ها و تعداد برد هر کدام به تفکیک گروه"""
+    with _lock:
+        return {
+            group: {'order': list(_mirror_order.get(group, [])), 'wins': dict(wins)}
+            for group, wins in _mirror_wins.items()
+        }
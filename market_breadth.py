@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import heapq
+
+from database import get_db_connection
+
+# =========================================================
+# آمار کلی بازار (Market Breadth) در هر دور بروزرسانی
+# همزمان با ذخیره دیده‌بان، تعداد نمادهای مثبت/منفی، ارزش معاملات، بیشترین
+# ارزش/تغییر و سهم نمادهای در سقف/کف محاسبه و در یک ردیف market_breadth ذخیره می‌شود
+# تا داشبورد به جای محاسبه روی کل market_prices فقط یک ردیف بخواند.
+# =========================================================
+
+# تعداد نمادهای برتر ذخیره شده در هر فهرست
+TOP_MOVERS = 5
+# ردیف‌های قدیمی‌تر از این تعداد روز در نگهداری روزانه حذف می‌شوند
+BREADTH_RETENTION_DAYS = int(os.environ.get('KINKO_BREADTH_RETENTION_DAYS', 90))
+
+def _mover(row, change):
+    return {'inscode': row.inscode, 'symbol': row.symbol, 'change': round(change, 2), 'value': row.value}
+
+def compute_breadth(rows, top=TOP_MOVERS):
+    """
+    محاسبه آمار بازار از ردیف‌های کامل دیده‌بان (فقط نمادهای معامله شده امروز)
+    درصد تغییر: قیمت پایانی نسبت به قیمت دیروز
+    """
+    stats = {
+        'instruments': 0, 'advancers': 0, 'decliners': 0, 'unchanged': 0,
+        'total_value': 0.0, 'total_volume': 0.0, 'total_trades': 0,
+        'at_upper': 0, 'at_lower': 0,
+    }
+    movers = []
+    for row in rows:
+        if row.trades <= 0 and row.volume <= 0:
+            continue
+        stats['instruments'] += 1
+        stats['total_value'] += row.value
+        stats['total_volume'] += row.volume
+        stats['total_trades'] += row.trades
+
+        change = (row.close - row.yesterday) / row.yesterday * 100 if row.yesterday > 0 and row.close > 0 else 0.0
+        if change > 0:
+            stats['advancers'] += 1
+        elif change < 0:
+            stats['decliners'] += 1
+        else:
+            stats['unchanged'] += 1
+
+        if row.upper_limit > 0 and row.last >= row.upper_limit:
+            stats['at_upper'] += 1
+        elif row.lower_limit > 0 and 0 < row.last <= row.lower_limit:
+            stats['at_lower'] += 1
+        movers.append((row, change))
+
+    count = stats['instruments']
+    stats['limit_fraction'] = round((stats['at_upper'] + stats['at_lower']) / count, 4) if count else 0.0
+    stats['top_value'] = [_mover(r, c) for r, c in heapq.nlargest(top, movers, key=lambda m: m[0].value)]
+    stats['top_gainers'] = [_mover(r, c) for r, c in heapq.nlargest(top, movers, key=lambda m: m[1]) if c > 0]
+    stats['top_losers'] = [_mover(r, c) for r, c in heapq.nsmallest(top, movers, key=lambda m: m[1]) if c < 0]
+    return stats
+
+def record_breadth(conn, rows, ts=None):
+    """
+    محاسبه و ذخیره آمار بازار یک دور بروزرسانی (commit با فراخواننده است)
+    خروجی: دیکشنری آمار (بدون ذخیره اگر نمادی معامله نشده)
+    """
+    stats = compute_breadth(rows)
+    if not stats['instruments']:
+        return stats
+    ts = int(ts if ts is not None else time.time())
+    conn.execute('''
+        INSERT OR REPLACE INTO market_breadth
+        (ts, instruments, advancers, decliners, unchanged, total_value, total_volume, total_trades,
+         at_upper, at_lower, limit_fraction, top_value, top_gainers, top_losers)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        ts, stats['instruments'], stats['advancers'], stats['decliners'], stats['unchanged'],
+        stats['total_value'], stats['total_volume'], stats['total_trades'],
+        stats['at_upper'], stats['at_lower'], stats['limit_fraction'],
+        json.dumps(stats['top_value'], ensure_ascii=False),
+        json.dumps(stats['top_gainers'], ensure_ascii=False),
+        json.dumps(stats['top_losers'], ensure_ascii=False),
+    ))
+    return stats
+
+def get_latest_breadth():
+    """آخرین ردیف آمار بازار (یا None)"""
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT * FROM market_breadth ORDER BY ts DESC LIMIT 1").fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    result = dict(row)
+    for key in ('top_value', 'top_gainers', 'top_losers'):
+        result[key] = json.loads(result[key] or '[]')
+    return result
+
+def get_breadth_series(start, end):
+    """سری زمانی آمار بازار بین start و end (ثانیه یونیکس)، بدون فهرست نمادهای برتر"""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('''
+            SELECT ts, instruments, advancers, decliners, unchanged, total_value, limit_fraction
+            FROM market_breadth WHERE ts BETWEEN ? AND ? ORDER BY ts
+        ''', (int(start), int(end))).fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
+
+def trim_breadth(now=None):
+    """حذف ردیف‌های قدیمی‌تر از BREADTH_RETENTION_DAYS؛ خروجی: تعداد حذف شده"""
+    now = int(now if now is not None else time.time())
+    conn = get_db_connection()
+    try:
+        removed = conn.execute(
+            "DELETE FROM market_breadth WHERE ts < ?", (now - BREADTH_RETENTION_DAYS * 86400,)
+        ).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return removed
@@ -1,27 +1,36 @@
-import sqlite3
-import requests
-from database import DB_NAME
+import os
+import http_client
+import tsetmc_parser
+import market_snapshot
+from database import get_db_connection, normalize_symbol, resolve_inscode, bump_data_versions
+from asset_classifier import classify, normalize_asset_class
 
-def get_asset_type(symbol, name, sector):
-    """تشخیص هوشمند نوع دارایی بر اساس نام و نماد"""
-    if 'صندوق' in name or 'ETF' in sector:
-        if 'طلا' in name or 'gold' in sector.lower() or symbol in ['طلا', 'عیار', 'زر', 'نابی', 'گنج', 'کهربا']:
-            return 'صندوق طلا (Gold)'
-        elif 'درآمد ثابت' in name or 'fixed' in sector.lower() or symbol in ['یاقوت', 'افران', 'اعتماد', 'آفاق']:
-            return 'درآمد ثابت (Fixed Income)'
-        elif 'زعفران' in name:
-            return 'کالایی (Commodity)'
-        elif 'مختلط' in name:
-            return 'صندوق مختلط (Mixed)'
-        else:
-            return 'صندوق سهامی (Equity Fund)'
-    elif 'اخزا' in symbol or 'اراد' in symbol:
-        return 'اوراق خزانه (Bonds)'
-    else:
-        return 'سهام (Stock)'
+# نقشه ستون‌های مورد استفاده این لودر در ردیف‌های MarketWatchPlus
+LOADER_COLUMNS = {'inscode': 0, 'symbol': 2, 'name': 3, 'close': 5, 'last': 6, 'sector_code': 18}
+LOADER_MIN_COLUMNS = 21
+
+def save_quotes(c, quotes):
+    """
+    ثبت یکجای نمادها و قیمت‌ها (executemany)؛ صنعت/نوع/P/E فقط جای خالی را پر می‌کند تا مقادیر دستی حفظ شوند
+    quotes: لیست (inscode, symbol, name, sector, asset_type, last_price, close_price, pe_ratio, sector_code)
+    """
+    c.executemany('''
+        INSERT INTO instruments (inscode, symbol, symbol_norm, company_name, sector, sector_code, asset_type, pe_ratio)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(inscode) DO UPDATE SET
+            symbol = excluded.symbol, symbol_norm = excluded.symbol_norm, company_name = excluded.company_name,
+            sector_code = COALESCE(excluded.sector_code, sector_code),
+            sector = COALESCE(sector, excluded.sector), asset_type = COALESCE(asset_type, excluded.asset_type),
+            pe_ratio = COALESCE(pe_ratio, excluded.pe_ratio)
+    ''', [(q[0], q[1], normalize_symbol(q[1]), q[2], q[3], q[8], q[4], q[7]) for q in quotes])
+    c.executemany('''
+        INSERT OR REPLACE INTO instrument_prices (inscode, last_price, close_price_yesterday, updated_at)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    ''', [(q[0], q[5], q[6]) for q in quotes])
+    bump_data_versions(c.connection, 'instruments', 'prices')
 
 def fetch_and_update_market():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     
     print("--- در حال اتصال به سرور TSETMC ... ---")
@@ -30,48 +39,40 @@ def fetch_and_update_market():
         # دریافت اطلاعات دیده‌بان بازار (روش سریع)
         # این آدرس دیتای خام و سبک دیده‌بان را برمی‌گرداند
         url = "http://old.tsetmc.com/tsev2/data/MarketWatchPlus.aspx?h=0&r=0"
-        response = requests.get(url, timeout=10)
+        response = http_client.get(url, timeout=10)
         content = response.text
         
-        # پارس کردن دیتای عجیب TSETMC
-        # فرمت: بخش‌ها با @ و ردیف‌ها با ; جدا می‌شوند
-        sections = content.split('@')
-        if len(sections) > 2:
-            raw_data = sections[2] # بخش سوم شامل اطلاعات نمادهاست
-            rows = raw_data.split(';')
+        # پارس کردن دیتای عجیب TSETMC با پارسر مشترک (ستون‌های قیمت این لودر: ۵ و ۶)
+        if tsetmc_parser.has_section(content, tsetmc_parser.SECTION_INSTRUMENTS):
+            quotes = []
+            for row in tsetmc_parser.iter_market_rows(content, columns=LOADER_COLUMNS, min_columns=LOADER_MIN_COLUMNS):
+                symbol = row.symbol        # نماد (مثلا فولاد)
+                name = row.name            # نام شرکت
+                close_price = row.close    # قیمت پایانی
+                last_price = row.last      # آخرین معامله
+                # TSETMC صنعت را کد عددی می‌دهد؛ نام آن از جدول sectors خوانده می‌شود
+                
+                asset_type, _ = classify(symbol, name)
+                
+                # محاسبه نسبت P/E (اگر موجود باشد در ستون‌های جلوتر است، فعلا صفر)
+                pe = 0 
+                
+                quotes.append((row.inscode, symbol, name, None, asset_type, last_price, close_price, pe, row.sector_code))
             
-            count = 0
-            for row in rows:
-                cols = row.split(',')
-                if len(cols) > 20:
-                    # استخراج ستون‌های مهم
-                    symbol = cols[2]        # نماد (مثلا فولاد)
-                    name = cols[3]          # نام شرکت
-                    close_price = float(cols[5]) # قیمت پایانی
-                    last_price = float(cols[6])  # آخرین معامله
-                    # TSETMC صنعت را کد عددی می‌دهد، فعلا اسمش را کلی می‌گذاریم مگر اینکه لیست کدها را داشته باشیم
-                    # برای سادگی فعلا صنعت را جنرال می‌زنیم و نوع را تشخیص می‌دهیم
-                    sector_name = "بازار بورس" 
-                    
-                    asset_type = get_asset_type(symbol, name, sector_name)
-                    
-                    # محاسبه نسبت P/E (اگر موجود باشد در ستون‌های جلوتر است، فعلا صفر)
-                    pe = 0 
-                    
-                    c.execute('''
-                        INSERT OR REPLACE INTO market_prices 
-                        (symbol, company_name, sector, asset_type, last_price, close_price_yesterday, pe_ratio)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ''', (symbol, name, sector_name, asset_type, last_price, close_price, pe))
-                    
-                    count += 1
-            
-            print(f"✅ موفقیت! {count} نماد از TSETMC دریافت و ذخیره شد.")
+            save_quotes(c, quotes)
+            print(f"✅ موفقیت! {len(quotes)} نماد از TSETMC دریافت و ذخیره شد.")
 
     except Exception as e:
         print(f"⚠️ خط در ارتباط با TSETMC: {e}")
-        print("🔄 در حال بارگذاری لیست آفلاین (پشتیبان)...")
-        load_offline_backup(c)
+        conn.rollback()
+        if os.path.exists(market_snapshot.SNAPSHOT_PATH):
+            # فایل snapshot کامل بازار (market_snapshot.py export) به لیست دستی ترجیح دارد
+            print(f"🔄 در حال بارگذاری snapshot بازار از {market_snapshot.SNAPSHOT_PATH} ...")
+            counts = market_snapshot.import_snapshot(market_snapshot.SNAPSHOT_PATH, conn=conn)
+            print(f"✅ {counts['instruments']} نماد از snapshot بارگذاری شد ({counts['elapsed']} ثانیه).")
+        else:
+            print("🔄 در حال بارگذاری لیست آفلاین (پشتیبان)...")
+            load_offline_backup(c)
 
     conn.commit()
     conn.close()
@@ -104,12 +105,12 @@ def load_offline_backup(c):
         ('اطلس', 'صندوق اطلس مفید', 'ETF سهامی', 'صندوق سهامی', 15500),
     ]
     
+    quotes = []
     for item in backup_data:
-        c.execute('''
-            INSERT OR REPLACE INTO market_prices 
-            (symbol, company_name, sector, asset_type, last_price, close_price_yesterday, pe_ratio)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (item[0], item[1], item[2], item[3], item[4], item[4], 6.0))
+        # نمادهای بدون کد TSETMC کد موقت می‌گیرند تا بعدا با کد واقعی جایگزین شوند
+        inscode = resolve_inscode(c, item[0])
+        quotes.append((inscode, item[0], item[1], item[2], normalize_asset_class(item[3]), item[4], item[4], 6.0, None))
+    save_quotes(c, quotes)
         
     print("✅ لیست آفلاین شامل صندوق‌ها و سهام بزرگ بارگذاری شد.")
 
@@ -0,0 +1,231 @@
+import os
+import sys
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+
+from database import get_db_connection, release_db_connection, verify_portfolio_cash, find_amount_mismatches
+import db_indexes
+from tsetmc_service import fetch_market_data, poll_market_delta, get_market_index, refresh_index_history, log_debug
+from tick_store import compact_ticks
+from refresh_metrics import RefreshRun
+from market_breadth import trim_breadth
+from ohlcv_store import update_daily_bars
+
+# =========================================================
+# بروزرسانی پس‌زمینه قیمت‌ها و شاخص
+# اجرای مستقل:  python market_refresher.py   (یا --once برای یک بار)
+# روت /update-prices فقط یک job در صف می‌گذارد و بلافاصله برمی‌گردد.
+# =========================================================
+
+TEHRAN_TZ = timezone(timedelta(hours=3, minutes=30))
+
+# روزهای معاملاتی: شنبه تا چهارشنبه (weekday پایتون: دوشنبه=0 ... شنبه=5، یکشنبه=6)
+TRADING_DAYS = {5, 6, 0, 1, 2}
+TRADING_START = os.environ.get('KINKO_TRADING_START', '08:45')
+TRADING_END = os.environ.get('KINKO_TRADING_END', '12:45')
+
+REFRESH_INTERVAL = int(os.environ.get('KINKO_REFRESH_INTERVAL', 60))        # ثانیه، در ساعات معاملاتی
+IDLE_INTERVAL = int(os.environ.get('KINKO_REFRESH_IDLE_INTERVAL', 900))     # ثانیه، خارج از ساعات معاملاتی
+QUEUE_POLL_INTERVAL = 5
+
+# اگر پروسه worker جداگانه اجرا می‌شود (worker در procfile)، این متغیر را برای وب روی 1 بگذارید
+# تا وب فقط job را در صف بگذارد و اجرا به worker سپرده شود
+RUN_IN_WORKER = os.environ.get('KINKO_REFRESH_IN_WORKER') == '1'
+
+# jobی که بیش از این مدت در حال اجرا مانده، رها شده فرض می‌شود
+STALE_JOB_MINUTES = 15
+KEEP_JOBS = 200
+
+def is_trading_hours(now=None):
+    now = now or datetime.now(TEHRAN_TZ)
+    if now.weekday() not in TRADING_DAYS:
+        return False
+    hhmm = now.strftime('%H:%M')
+    return TRADING_START <= hhmm <= TRADING_END
+
+def trigger_refresh(source='web', start_thread=True):
+    """
+    ثبت درخواست بروزرسانی؛ اگر jobی در صف یا در حال اجراست همان برگردانده می‌شود.
+    خروجی: (job_id, created)
+    """
+    conn = get_db_connection()
+    try:
+        # BEGIN IMMEDIATE قفل نوشتن را می‌گیرد تا دو درخواست همزمان هر دو job نسازند
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(f'''
+            UPDATE refresh_jobs SET status = 'failed', message = 'stale', finished_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND started_at < datetime('now', '-{STALE_JOB_MINUTES} minutes')
+        ''')
+        row = conn.execute(
+            "SELECT id FROM refresh_jobs WHERE status IN ('queued', 'running') ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row:
+            conn.commit()
+            return row['id'], False
+
+        cur = conn.execute("INSERT INTO refresh_jobs (status, source) VALUES ('queued', ?)", (source,))
+        job_id = cur.lastrowid
+        conn.execute(
+            "DELETE FROM refresh_jobs WHERE id <= (SELECT MAX(id) FROM refresh_jobs) - ?", (KEEP_JOBS,)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if start_thread and not RUN_IN_WORKER:
+        threading.Thread(target=run_refresh_job, args=(job_id,), daemon=True).start()
+    return job_id, True
+
+def get_job_status(job_id):
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT * FROM refresh_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+def _claim_job(job_id):
+    conn = get_db_connection()
+    try:
+        cur = conn.execute('''
+            UPDATE refresh_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'queued'
+        ''', (job_id,))
+        conn.commit()
+        return cur.rowcount == 1
+    finally:
+        conn.close()
+
+def _finish_job(job_id, ok, message):
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            UPDATE refresh_jobs SET status = ?, message = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', ('done' if ok else 'failed', message, job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def run_refresh_job(job_id, mode='full'):
+    """
+    اجرای یک job (اگر قبلا توسط پروسه دیگری برداشته نشده باشد)
+    full: کل بازار + شاخص ؛ delta: فقط تغییرات با poller ماندگار + شاخص
+    """
+    if not _claim_job(job_id):
+        release_db_connection()
+        return
+    try:
+        if mode == 'delta':
+            run = RefreshRun('delta')
+            try:
+                stats = poll_market_delta(run)
+                with run.stage('index'):
+                    index_val = get_market_index()
+            except Exception as e:
+                run.error(type(e).__name__)
+                run.save(False, str(e))
+                raise
+            ok = stats is not None
+            if ok:
+                message = f"{stats['mode']}: {stats['inserted'] + stats['updated']} changed, index={index_val or '-'}"
+            else:
+                message = "خطای اتصال به سرور بورس"
+            run.save(ok, message)
+        else:
+            # fetch_market_data خودش شاخص را هم بروزرسانی می‌کند
+            ok, message = fetch_market_data()
+    except Exception as e:
+        ok, message = False, str(e)
+    _finish_job(job_id, ok, message)
+    # اتصال مشترک این رشته (رشته job یا حلقه زمان‌بندی) پس از هر job بسته می‌شود
+    release_db_connection()
+    log_debug(f"Refresh job {job_id} ({mode}) finished: {message}")
+
+def _next_queued_job():
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT id FROM refresh_jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+        return row['id'] if row else None
+    finally:
+        conn.close()
+
+def run_daily_maintenance():
+    """فشرده‌سازی تاریخچه لحظه‌ای، حذف آمار قدیمی بازار، افزودن قیمت روزانه نمادهای دارای تاریخچه، ANALYZE و کنترل دفتر نقدینگی"""
+    try:
+        compacted, removed = compact_ticks()
+        log_debug(f"Tick store compacted: {compacted} merged, {removed} expired")
+    except Exception as e:
+        log_debug(f"Tick compaction failed: {e}")
+    try:
+        trim_breadth()
+    except Exception as e:
+        log_debug(f"Breadth trim failed: {e}")
+    try:
+        update_daily_bars()
+    except Exception as e:
+        log_debug(f"Daily bars update failed: {e}")
+    try:
+        conn = get_db_connection()
+        try:
+            db_indexes.optimize(conn)
+        finally:
+            conn.close()
+    except Exception as e:
+        log_debug(f"Database optimize failed: {e}")
+    try:
+        # فقط گزارش؛ اصلاح با اجرای دستی python database.py verify-cash --fix
+        for pid, stored, ledger, expected in verify_portfolio_cash():
+            log_debug(f"Cash ledger mismatch for portfolio {pid}: stored={stored} ledger={ledger} expected={expected}")
+        for tid, pid, amount, expected in find_amount_mismatches():
+            log_debug(f"Transaction {tid} amount mismatch (portfolio {pid}): amount={amount} expected={expected}")
+    except Exception as e:
+        log_debug(f"Cash ledger check failed: {e}")
+
+def run_scheduler():
+    """حلقه زمان‌بندی: در ساعات معاملاتی بروزرسانی تدریجی، خارج از آن با فاصله طولانی"""
+    log_debug(f"Market refresher started (trading {TRADING_START}-{TRADING_END}, every {REFRESH_INTERVAL}s)")
+    next_run = 0
+    history_day = None
+    maintenance_day = None
+    while True:
+        # تاریخچه شاخص و کارهای نگهداری روزانه، یک بار پس از پایان معاملات
+        tehran_now = datetime.now(TEHRAN_TZ)
+        today = tehran_now.date()
+        after_close = tehran_now.strftime('%H:%M') > TRADING_END
+        if history_day != today and after_close:
+            if refresh_index_history() is not None:
+                history_day = today
+        if maintenance_day != today and after_close:
+            maintenance_day = today
+            run_daily_maintenance()
+
+        # jobهای درخواست شده از وب (در حالت RUN_IN_WORKER)
+        queued = _next_queued_job()
+        if queued:
+            run_refresh_job(queued)
+
+        now = time.time()
+        if now >= next_run:
+            trading = is_trading_hours()
+            job_id, created = trigger_refresh('schedule', start_thread=False)
+            if created:
+                run_refresh_job(job_id, mode='delta' if trading else 'full')
+            next_run = now + (REFRESH_INTERVAL if trading else IDLE_INTERVAL)
+
+        release_db_connection()
+        time.sleep(QUEUE_POLL_INTERVAL)
+
+if __name__ == "__main__":
+    from migrations import migrate
+    migrate()
+    if '--once' in sys.argv:
+        job_id, created = trigger_refresh('schedule', start_thread=False)
+        if created:
+            run_refresh_job(job_id)
+        print(get_job_status(job_id))
+    else:
+        run_scheduler()
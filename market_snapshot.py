@@ -0,0 +1,150 @@
+import os
+import sys
+import gzip
+import json
+import time
+
+import asset_classifier
+from database import BASE_DIR, get_db_connection, rekey_synthetic_instruments, bump_data_versions
+
+# =========================================================
+# فایل Snapshot بازار (نمادها، قیمت‌ها و دیکشنری صنایع)
+# خروجی گرفتن از دیتابیس فعلی و بارگذاری آن در یک تراکنش واحد؛
+# برای راه‌اندازی محیط جدید، دیتابیس تست و پشتیبان آفلاین market_loader.
+#   python market_snapshot.py export market_snapshot.json.gz
+#   python market_snapshot.py import market_snapshot.json.gz
+# =========================================================
+
+SNAPSHOT_FORMAT = 'kinko-market-snapshot'
+SNAPSHOT_VERSION = 1
+# فایل پیش‌فرض (پشتیبان آفلاین market_loader)
+SNAPSHOT_PATH = os.environ.get('KINKO_MARKET_SNAPSHOT', os.path.join(BASE_DIR, 'market_snapshot.json.gz'))
+
+# ستون‌های هر جدول به همان ترتیبی که در فایل ذخیره می‌شوند
+SNAPSHOT_TABLES = {
+    'sectors': ('code', 'name'),
+    'instruments': ('inscode', 'symbol', 'symbol_norm', 'company_name', 'isin', 'sector', 'sector_code',
+                    'asset_type', 'market_type', 'pe_ratio', 'updated_at'),
+    'instrument_prices': ('inscode', 'last_price', 'close_price_yesterday', 'updated_at'),
+}
+
+# بارگذاری: نام/نماد/کد صنعت از فایل، اطلاعات دستی موجود (صنعت، نوع، P/E) حفظ می‌شود
+# و قیمت فقط وقتی جایگزین می‌شود که قیمت فایل جدیدتر باشد.
+IMPORT_SQL = {
+    'sectors': '''
+        INSERT INTO sectors (code, name) VALUES (:code, :name)
+        ON CONFLICT(code) DO NOTHING
+    ''',
+    'instruments': '''
+        INSERT INTO instruments
+        (inscode, symbol, symbol_norm, company_name, isin, sector, sector_code, asset_type, market_type, pe_ratio, updated_at)
+        VALUES (:inscode, :symbol, :symbol_norm, :company_name, :isin, :sector, :sector_code,
+                :asset_type, :market_type, :pe_ratio, :updated_at)
+        ON CONFLICT(inscode) DO UPDATE SET
+            symbol = excluded.symbol, symbol_norm = excluded.symbol_norm,
+            company_name = excluded.company_name, isin = COALESCE(excluded.isin, isin),
+            sector_code = COALESCE(excluded.sector_code, sector_code),
+            sector = COALESCE(sector, excluded.sector),
+            asset_type = COALESCE(asset_type, excluded.asset_type),
+            market_type = COALESCE(market_type, excluded.market_type),
+            pe_ratio = COALESCE(pe_ratio, excluded.pe_ratio)
+    ''',
+    'instrument_prices': '''
+        INSERT INTO instrument_prices (inscode, last_price, close_price_yesterday, updated_at)
+        VALUES (:inscode, :last_price, :close_price_yesterday, :updated_at)
+        ON CONFLICT(inscode) DO UPDATE SET
+            last_price = excluded.last_price,
+            close_price_yesterday = excluded.close_price_yesterday,
+            updated_at = excluded.updated_at
+        WHERE excluded.updated_at > IFNULL(instrument_prices.updated_at, '')
+    ''',
+}
+
+def export_snapshot(path=None):
+    """ذخیره نمادها (فقط کدهای واقعی)، قیمت‌ها و صنایع در فایل gzip؛ خروجی: تعداد ردیف هر جدول"""
+    path = path or SNAPSHOT_PATH
+    snapshot = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created_at': time.time(),
+        'columns': {table: list(columns) for table, columns in SNAPSHOT_TABLES.items()},
+        'tables': {},
+    }
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.row_factory = None
+        for table, columns in SNAPSHOT_TABLES.items():
+            key = columns[0]
+            where = f" WHERE {key} > 0" if key == 'inscode' else ''
+            snapshot['tables'][table] = cur.execute(
+                f"SELECT {', '.join(columns)} FROM {table}{where} ORDER BY {key}"
+            ).fetchall()
+    finally:
+        conn.close()
+
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+    return {table: len(rows) for table, rows in snapshot['tables'].items()}
+
+def read_snapshot(path=None):
+    """خواندن و اعتبارسنجی فایل؛ خروجی: دیکشنری snapshot"""
+    path = path or SNAPSHOT_PATH
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    if snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} is not a market snapshot")
+    if snapshot.get('version', 0) > SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {snapshot.get('version')} (max {SNAPSHOT_VERSION})")
+    return snapshot
+
+def import_snapshot(path=None, conn=None):
+    """
+    بارگذاری فایل snapshot در یک تراکنش (همه یا هیچ)
+    ستون‌ها بر اساس نام خوانده می‌شوند؛ ستون‌های ناموجود در فایل NULL فرض می‌شوند.
+    خروجی: تعداد ردیف هر جدول
+    """
+    started = time.perf_counter()
+    snapshot = read_snapshot(path)
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+
+    counts = {}
+    try:
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        for table, columns in SNAPSHOT_TABLES.items():
+            file_columns = snapshot['columns'].get(table)
+            rows = snapshot['tables'].get(table) or []
+            if not file_columns or not rows:
+                counts[table] = 0
+                continue
+            params = (dict.fromkeys(columns) | dict(zip(file_columns, row)) for row in rows)
+            conn.executemany(IMPORT_SQL[table], params)
+            counts[table] = len(rows)
+        # نوع دارایی مقادیر قدیمی و طبقه‌بندی دستی، مثل دریافت عادی دیده‌بان
+        asset_classifier.normalize_instruments(conn)
+        rekey_synthetic_instruments(conn)
+        asset_classifier.apply_overrides(conn)
+        bump_data_versions(conn, 'instruments', 'prices')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if own_conn:
+            conn.close()
+
+    counts['elapsed'] = round(time.perf_counter() - started, 3)
+    return counts
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ('export', 'import'):
+        print("Usage: python market_snapshot.py export|import [file]")
+        sys.exit(1)
+    target = sys.argv[2] if len(sys.argv) > 2 else None
+    if sys.argv[1] == 'export':
+        print(export_snapshot(target))
+    else:
+        print(import_snapshot(target))
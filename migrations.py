@@ -0,0 +1,131 @@
+import sys
+import threading
+
+import asset_classifier
+import db_indexes
+import positions
+from database import get_db_connection, create_schema, _add_column, CASH_DELTA_SQL, VERSIONED_TABLES, bump_data_versions
+
+# =========================================================
+# مهاجرت‌های شماره‌دار اسکیما
+# نسخه فعلی اسکیما در PRAGMA user_version دیتابیس ذخیره می‌شود؛ در شروع برنامه
+# مهاجرت‌های باقی‌مانده به ترتیب و در یک تراکنش اجرا می‌شوند (اگر اسکیما به‌روز باشد
+# فقط یک PRAGMA خوانده می‌شود). مهاجرت جدید = افزودن یک ردیف به انتهای MIGRATIONS.
+#   python migrations.py          اجرای مهاجرت‌های باقی‌مانده
+#   python migrations.py status   نمایش نسخه فعلی
+# =========================================================
+
+def _model_display_name(conn):
+    # نام نمایشی قابل ویرایش مدل‌ها (فرم تنظیمات مدل و get_model_details)
+    _add_column(conn, 'model_configs', 'display_name', 'TEXT')
+
+def _calendar_event_fields(conn):
+    # تاریخ مجمع، لینک وبینار و اولویت یادداشت‌های تقویم
+    _add_column(conn, 'calendar_events', 'record_date', 'TEXT')
+    _add_column(conn, 'calendar_events', 'url', 'TEXT')
+    _add_column(conn, 'calendar_events', 'priority', "TEXT DEFAULT 'medium'")
+
+def _positions_table(conn):
+    # مانده هر نماد هر سبد (positions.py)؛ مقدار اولیه از بازپخش تاریخچه
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS positions (
+            portfolio_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            inscode INTEGER,
+            qty REAL NOT NULL DEFAULT 0,
+            cost REAL NOT NULL DEFAULT 0,          -- بهای تمام شده مانده (میانگین موزون با کارمزد)
+            realized_pnl REAL NOT NULL DEFAULT 0,
+            last_trade_date TEXT,
+            PRIMARY KEY (portfolio_id, symbol)
+        )
+    ''')
+    positions.rebuild_positions(conn)
+
+def _cash_ledger(conn):
+    # اثر نقدی هر تراکنش و نقدینگی سبدها به عنوان جمع همین اثرها
+    _add_column(conn, 'transactions', 'cash_delta', 'REAL')
+    conn.execute(f"UPDATE transactions SET cash_delta = {CASH_DELTA_SQL}")
+    conn.execute('''
+        UPDATE portfolios SET current_cash =
+            (SELECT IFNULL(SUM(t.cash_delta), 0) FROM transactions t WHERE t.portfolio_id = portfolios.id)
+    ''')
+
+def _drop_version_triggers(conn):
+    # تریگرهای سطری data_versions (هر ردیف قیمت یک UPDATE اضافه)؛ نسخه‌ها اکنون یک بار در هر دسته بالا می‌روند
+    for table in VERSIONED_TABLES:
+        for op in ('insert', 'update', 'delete'):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_{table}_{op}_version")
+
+def _reclassify_rights(conn):
+    # حق تقدم‌هایی که پیش از تشخیص خودکار به عنوان سهام ثبت شده‌اند (کارمزد Rights)؛ طبقه‌بندی دستی اولویت دارد
+    asset_classifier.reclassify_rights(conn)
+    asset_classifier.apply_overrides(conn)
+
+# (نسخه، توضیح، تابع)؛ ترتیب و شماره‌ها نباید تغییر کنند
+MIGRATIONS = [
+    (1, 'base schema', create_schema),
+    (2, 'model_configs.display_name', _model_display_name),
+    (3, 'calendar_events record_date/url/priority', _calendar_event_fields),
+    (4, 'covering indexes', db_indexes.ensure_indexes),
+    (5, 'positions table', _positions_table),
+    (6, 'transactions.cash_delta ledger', _cash_ledger),
+    (7, 'positions index', db_indexes.ensure_indexes),
+    (8, 'drop row-level data_versions triggers', _drop_version_triggers),
+    (9, 'reclassify rights instruments', _reclassify_rights),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+_lock = threading.Lock()
+_current = {'done': False}
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(force=False):
+    """
+    اجرای مهاجرت‌های باقی‌مانده در یک تراکنش (همه یا هیچ)
+    force: اسکیمای پایه (مهاجرت ۱) حتی در دیتابیس به‌روز هم دوباره اجرا شود (init_db)
+    خروجی: لیست شماره مهاجرت‌های اجرا شده
+    """
+    if _current['done'] and not force:
+        return []
+
+    with _lock:
+        conn = get_db_connection()
+        try:
+            if get_schema_version(conn) >= SCHEMA_VERSION and not force:
+                _current['done'] = True
+                return []
+
+            # قفل نوشتن پیش از خواندن دوباره نسخه، تا دو پروسه یک مهاجرت را دو بار اجرا نکنند
+            conn.execute("BEGIN IMMEDIATE")
+            version = get_schema_version(conn)
+            applied = []
+            for number, description, func in MIGRATIONS:
+                if number > version or (force and number == 1):
+                    func(conn)
+                    applied.append(number)
+                    print(f"Migration {number}: {description}")
+            if version < SCHEMA_VERSION:
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            # مهاجرت‌ها ممکن است داده را تغییر داده باشند؛ کش‌های پروسه‌های دیگر باطل می‌شوند
+            bump_data_versions(conn, *VERSIONED_TABLES.values())
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        _current['done'] = True
+        return applied
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['status']:
+        conn = get_db_connection()
+        try:
+            print(f"Schema version {get_schema_version(conn)} (latest {SCHEMA_VERSION})")
+        finally:
+            conn.close()
+    else:
+        print(f"Applied: {migrate() or 'nothing (schema is current)'}")
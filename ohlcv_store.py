@@ -0,0 +1,276 @@
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+
+import http_client
+import tsetmc_parser
+from database import get_db_connection
+from tsetmc_service import CDN_BASE_URL, GLOBAL_HEADERS, download_market_watch, log_debug
+
+# =========================================================
+# تاریخچه قیمت روزانه (OHLCV) هر نماد
+# دریافت اولیه (backfill) با تعداد محدود درخواست همزمان انجام می‌شود و
+# وضعیت هر نماد در bar_backfill ثبت می‌شود تا پس از توقف از همان‌جا ادامه یابد.
+# اجرا:  python ohlcv_store.py --backfill [--workers 4] [inscode ...]
+# =========================================================
+
+DAILY_BARS_URL = CDN_BASE_URL + "/api/ClosingPrice/GetClosingPriceDailyList/{inscode}/{days}"
+
+BACKFILL_WORKERS = int(os.environ.get('KINKO_BACKFILL_WORKERS', 4))
+# نمادهایی که بیش از این تعداد بار شکست خورده‌اند در دورهای بعدی رد می‌شوند
+BACKFILL_MAX_ATTEMPTS = 5
+# نمادی که تاریخچه‌اش خالی برگشته (status = 'empty') تا این تعداد روز دوباره درخواست نمی‌شود
+BACKFILL_EMPTY_RETRY_DAYS = int(os.environ.get('KINKO_BACKFILL_EMPTY_RETRY_DAYS', 7))
+
+# نگاشت فیلدهای پاسخ API به ستون‌های daily_bars
+BAR_FIELDS = (
+    ('priceFirst', 'open_price'),
+    ('priceMax', 'high_price'),
+    ('priceMin', 'low_price'),
+    ('pClosing', 'close_price'),
+    ('pDrCotVal', 'last_price'),
+    ('qTotTran5J', 'volume'),
+    ('qTotCap', 'value'),
+    ('zTotTran', 'trades'),
+)
+BAR_COLUMNS = tuple(column for _, column in BAR_FIELDS)
+
+_series_lock = threading.Lock()
+_series_cache = {}   # (inscode, field) -> (version, آرایه تاریخ‌ها، آرایه مقادیر)
+
+def fetch_daily_bars(inscode, days=0):
+    """
+    دریافت قیمت‌های روزانه یک نماد از TSETMC (days=0 یعنی کل تاریخچه)
+    خروجی: لیست (tarikh, open, high, low, close, last, volume, value, trades)
+    """
+    headers = GLOBAL_HEADERS.copy()
+    headers['Referer'] = 'http://cdn.tsetmc.com'
+    resp = http_client.get(DAILY_BARS_URL.format(inscode=inscode, days=days), headers=headers, timeout=20, verify=False)
+    if resp.status_code != 200:
+        raise ValueError(f"HTTP {resp.status_code}")
+
+    bars = []
+    for day in resp.json().get('closingPriceDaily') or []:
+        if not day.get('dEven'):
+            continue
+        bars.append((int(day['dEven']),) + tuple(float(day.get(field) or 0) for field, _ in BAR_FIELDS))
+    return bars
+
+def _store_bars(conn, inscode, bars):
+    """
+    ذخیره قیمت‌ها و علامت‌گذاری نماد به عنوان کامل شده در یک تراکنش
+    نمادی که هنوز هیچ قیمتی ندارد و پاسخش خالی است با وضعیت 'empty' ثبت می‌شود
+    (نه 'done' بدون last_tarikh که در هر دور دوباره کل تاریخچه‌اش درخواست شود).
+    """
+    last_tarikh = max((b[0] for b in bars), default=None)
+    conn.executemany(f'''
+        INSERT OR REPLACE INTO daily_bars (inscode, tarikh, {', '.join(BAR_COLUMNS)})
+        VALUES (?, ?, {', '.join('?' * len(BAR_COLUMNS))})
+    ''', [(inscode,) + bar for bar in bars])
+    conn.execute('''
+        INSERT INTO bar_backfill (inscode, status, last_tarikh, attempts, message, updated_at)
+        VALUES (?, CASE WHEN ? IS NULL THEN 'empty' ELSE 'done' END, ?, 0, NULL, CURRENT_TIMESTAMP)
+        ON CONFLICT(inscode) DO UPDATE SET
+            status = CASE WHEN COALESCE(excluded.last_tarikh, last_tarikh) IS NULL THEN 'empty' ELSE 'done' END,
+            last_tarikh = COALESCE(MAX(excluded.last_tarikh, COALESCE(last_tarikh, 0)), last_tarikh),
+            attempts = 0, version = version + 1, message = NULL, updated_at = CURRENT_TIMESTAMP
+    ''', (inscode, last_tarikh, last_tarikh))
+    conn.commit()
+
+def _mark_failed(conn, inscode, message):
+    conn.execute('''
+        INSERT INTO bar_backfill (inscode, status, attempts, message, updated_at)
+        VALUES (?, 'failed', 1, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(inscode) DO UPDATE SET
+            status = CASE WHEN status = 'done' THEN 'done' ELSE 'failed' END,
+            attempts = attempts + 1, message = excluded.message, updated_at = CURRENT_TIMESTAMP
+    ''', (inscode, message[:200]))
+    conn.commit()
+
+def _market_inscodes():
+    """کد تمام نمادهای فعلی دیده‌بان بازار"""
+    content = download_market_watch()
+    if not content:
+        return []
+    return [row.inscode for row in tsetmc_parser.iter_market_rows(content, columns={'inscode': 0})]
+
+def _plan_requests(conn, inscodes):
+    """
+    تعیین تعداد روز لازم برای هر نماد:
+    نمادهای کامل شده فقط روزهای پس از آخرین تاریخ ذخیره شده، نمادهای با پاسخ خالی
+    هر BACKFILL_EMPTY_RETRY_DAYS روز یک بار، بقیه کل تاریخچه (0)
+    """
+    state = {
+        row['inscode']: row
+        for row in conn.execute('''
+            SELECT inscode, status, last_tarikh, attempts,
+                   julianday('now') - julianday(updated_at) AS age_days
+            FROM bar_backfill
+        ''')
+    }
+    today = datetime.now().date()
+    plan = []
+    for inscode in inscodes:
+        row = state.get(inscode)
+        if row is not None and row['status'] == 'empty':
+            if (row['age_days'] or 0) >= BACKFILL_EMPTY_RETRY_DAYS:
+                plan.append((inscode, 0))
+            continue
+        if row is None or row['status'] != 'done' or not row['last_tarikh']:
+            if row is not None and row['attempts'] >= BACKFILL_MAX_ATTEMPTS:
+                continue
+            plan.append((inscode, 0))
+            continue
+        gap = (today - datetime.strptime(str(row['last_tarikh']), '%Y%m%d').date()).days
+        if gap > 0:
+            # تعداد روزهای معاملاتی کمتر از روزهای تقویمی است؛ چند روز اضافه برای اطمینان
+            plan.append((inscode, gap + 5))
+    return plan
+
+def backfill_daily_bars(inscodes=None, workers=None):
+    """
+    دریافت/بروزرسانی تاریخچه روزانه نمادها با حداکثر workers درخواست همزمان
+    inscodes: پیش‌فرض تمام نمادهای دیده‌بان بازار
+    فقط یک رشته (همین رشته) در دیتابیس می‌نویسد؛ هر نماد جداگانه commit می‌شود
+    تا توقف در میانه کار، نمادهای کامل شده را از دست ندهد.
+    خروجی: دیکشنری آمار
+    """
+    workers = workers or BACKFILL_WORKERS
+    started = time.perf_counter()
+    if inscodes is None:
+        inscodes = _market_inscodes()
+
+    conn = get_db_connection()
+    try:
+        plan = _plan_requests(conn, [int(i) for i in inscodes])
+        stats = {'planned': len(plan), 'done': 0, 'failed': 0, 'bars': 0}
+        log_debug(f"Daily bars backfill: {len(plan)} instruments, {workers} workers")
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backfill') as executor:
+            futures = {executor.submit(fetch_daily_bars, inscode, days): inscode for inscode, days in plan}
+            for future in as_completed(futures):
+                inscode = futures[future]
+                try:
+                    bars = future.result()
+                except Exception as e:
+                    _mark_failed(conn, inscode, str(e))
+                    stats['failed'] += 1
+                    continue
+                _store_bars(conn, inscode, bars)
+                stats['done'] += 1
+                stats['bars'] += len(bars)
+    finally:
+        conn.close()
+
+    stats['elapsed'] = round(time.perf_counter() - started, 2)
+    log_debug(
+        f"Daily bars backfill finished: {stats['done']} done, {stats['failed']} failed, "
+        f"{stats['bars']} bars in {stats['elapsed']}s"
+    )
+    return stats
+
+def update_daily_bars(workers=None):
+    """بروزرسانی روزانه فقط برای نمادهایی که قبلا تاریخچه‌شان دریافت شده است"""
+    conn = get_db_connection()
+    try:
+        inscodes = [row[0] for row in conn.execute("SELECT inscode FROM bar_backfill")]
+    finally:
+        conn.close()
+    if not inscodes:
+        return None
+    return backfill_daily_bars(inscodes, workers=workers)
+
+def _load_series(conn, inscodes, field):
+    """
+    سری (تاریخ‌ها، مقادیر) هر نماد از کش حافظه؛ فقط نمادهایی که نسخه‌شان در bar_backfill
+    عوض شده (یا هنوز خوانده نشده‌اند) دوباره از دیتابیس خوانده می‌شوند.
+    """
+    placeholders = ','.join('?' * len(inscodes))
+    versions = dict(conn.execute(
+        f"SELECT inscode, version FROM bar_backfill WHERE inscode IN ({placeholders})", inscodes
+    ).fetchall())
+
+    result = {}
+    with _series_lock:
+        stale = []
+        for inscode in inscodes:
+            cached = _series_cache.get((inscode, field))
+            if cached is not None and cached[0] == versions.get(inscode):
+                result[inscode] = cached[1:]
+            else:
+                stale.append(inscode)
+
+    for inscode in stale:
+        cur = conn.cursor()
+        cur.row_factory = None
+        rows = cur.execute(
+            f"SELECT tarikh, {field} FROM daily_bars WHERE inscode = ? ORDER BY tarikh", (inscode,)
+        ).fetchall()
+        data = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        series = (data[:, 0].astype(np.int64), data[:, 1])
+        with _series_lock:
+            _series_cache[(inscode, field)] = (versions.get(inscode),) + series
+        result[inscode] = series
+    return result
+
+def get_close_matrix(inscodes, start=None, end=None, field='close_price', ffill=True):
+    """
+    ماتریس قیمت (تاریخ × نماد) برای محاسبات برداری
+    start/end: تاریخ میلادی به صورت عدد YYYYMMDD (اختیاری)
+    ردیف‌ها اجتماع روزهای معاملاتی نمادهاست؛ جای خالی NaN است یا با ffill از روز قبل پر می‌شود.
+    خروجی: (آرایه تاریخ‌ها، لیست inscode ها، ماتریس float64 به ابعاد روز × نماد)
+    """
+    if field not in BAR_COLUMNS:
+        raise ValueError(f"Unknown field: {field}")
+    inscodes = [int(i) for i in inscodes]
+    if not inscodes:
+        return np.empty(0, dtype=np.int64), inscodes, np.empty((0, 0))
+
+    conn = get_db_connection()
+    try:
+        series = _load_series(conn, inscodes, field)
+    finally:
+        conn.close()
+
+    # برش بازه زمانی هر سری با جستجوی دودویی
+    sliced = []
+    for inscode in inscodes:
+        dates, values = series[inscode]
+        lo = 0 if start is None else np.searchsorted(dates, int(start), side='left')
+        hi = len(dates) if end is None else np.searchsorted(dates, int(end), side='right')
+        sliced.append((dates[lo:hi], values[lo:hi]))
+
+    all_dates = np.unique(np.concatenate([d for d, _ in sliced])) if sliced else np.empty(0, dtype=np.int64)
+    matrix = np.full((len(all_dates), len(inscodes)), np.nan)
+    for col, (dates, values) in enumerate(sliced):
+        if len(dates):
+            matrix[np.searchsorted(all_dates, dates), col] = values
+
+    if ffill and len(all_dates):
+        # پر کردن روزهای بدون معامله با آخرین قیمت قبلی هر نماد
+        valid = ~np.isnan(matrix)
+        last_valid = np.where(valid, np.arange(len(all_dates))[:, None], 0)
+        np.maximum.accumulate(last_valid, axis=0, out=last_valid)
+        filled = matrix[last_valid, np.arange(len(inscodes))]
+        # قبل از اولین معامله هر نماد NaN باقی می‌ماند
+        seen = np.maximum.accumulate(valid, axis=0)
+        matrix = np.where(seen, filled, np.nan)
+
+    return all_dates, inscodes, matrix
+
+if __name__ == "__main__":
+    if '--backfill' in sys.argv:
+        args = sys.argv[sys.argv.index('--backfill') + 1:]
+        workers = None
+        if '--workers' in args:
+            pos = args.index('--workers')
+            workers = int(args[pos + 1])
+            del args[pos:pos + 2]
+        print(backfill_daily_bars([int(a) for a in args] or None, workers=workers))
+    elif '--update' in sys.argv:
+        print(update_daily_bars())
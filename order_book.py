@@ -0,0 +1,180 @@
+import os
+import json
+import threading
+
+import tsetmc_parser
+from database import get_db_connection, get_data_versions
+
+# =========================================================
+# بهترین مظنه‌ها (Order Book) و تخمین نقدشوندگی دارایی‌ها
+# بخش Best Limits پاسخ MarketWatchPlus در هر دور بروزرسانی در حافظه ادغام می‌شود
+# (inscode -> سطح -> مظنه) و فقط دفتر نمادهای موجود در سبدها در order_book ذخیره می‌شود.
+# =========================================================
+
+ORDER_BOOK_ENABLED = os.environ.get('KINKO_ORDER_BOOK', '1') == '1'
+# سهم قابل معامله از میانگین حجم روزانه در تخمین روزهای لازم برای خروج
+LIQUIDITY_PARTICIPATION = float(os.environ.get('KINKO_LIQUIDITY_PARTICIPATION', 0.1))
+# تعداد روزهای معاملاتی اخیر برای میانگین حجم
+LIQUIDITY_LOOKBACK_DAYS = 20
+
+# ترتیب مقادیر هر سطح در حافظه و در JSON ذخیره شده
+LEVEL_FIELDS = ('buy_count', 'buy_volume', 'buy_price', 'sell_price', 'sell_volume', 'sell_count')
+
+_lock = threading.Lock()
+_books = {}         # inscode -> {level: tuple(LEVEL_FIELDS)}
+_held = {'versions': None, 'inscodes': frozenset()}
+
+HELD_SQL = "SELECT DISTINCT inscode FROM positions WHERE inscode IS NOT NULL AND qty > 0.001"
+
+def _held_inscodes(conn):
+    """نمادهای دارای مانده در هر سبد؛ تا تغییر بعدی تراکنش‌ها در حافظه می‌ماند (بروزرسانی قیمت آن را باطل نمی‌کند)"""
+    versions = get_data_versions(conn, ('transactions',))
+    with _lock:
+        if _held['versions'] == versions:
+            return _held['inscodes']
+    inscodes = frozenset(r[0] for r in conn.execute(HELD_SQL))
+    with _lock:
+        _held['versions'] = versions
+        _held['inscodes'] = inscodes
+    return inscodes
+
+def ingest_best_limits(conn, content, full=False):
+    """
+    ادغام بخش بهترین مظنه‌ها در دفتر حافظه و ذخیره دفتر نمادهای موجود در سبدها
+    full: پاسخ کامل (غیر تدریجی)؛ دفتر نمادهای حاضر در پاسخ از نو ساخته می‌شود
+    خروجی: تعداد نمادهایی که دفترشان تغییر کرد (commit با فراخواننده است)
+    """
+    if not ORDER_BOOK_ENABLED:
+        return 0
+
+    levels = tsetmc_parser.iter_market_rows(
+        content,
+        columns=tsetmc_parser.BEST_LIMIT_COLUMNS,
+        min_columns=tsetmc_parser.BEST_LIMIT_MIN_COLUMNS,
+        section=tsetmc_parser.SECTION_BEST_LIMITS
+    )
+    changed = set()
+    with _lock:
+        rebuilt = set()
+        for row in levels:
+            book = _books.get(row.inscode)
+            if book is None or (full and row.inscode not in rebuilt):
+                book = _books[row.inscode] = {}
+                rebuilt.add(row.inscode)
+            values = (row.buy_count, row.buy_volume, row.buy_price, row.sell_price, row.sell_volume, row.sell_count)
+            if book.get(row.level) != values:
+                book[row.level] = values
+                changed.add(row.inscode)
+        if full:
+            # نمادهایی که در پاسخ کامل مظنه‌ای ندارند، صفشان خالی است
+            for inscode in [i for i in _books if i not in rebuilt]:
+                del _books[inscode]
+                changed.add(inscode)
+
+    if changed:
+        held = changed & _held_inscodes(conn)
+        if held:
+            _persist(conn, held)
+    return len(changed)
+
+def _persist(conn, inscodes):
+    with _lock:
+        rows = []
+        for inscode in inscodes:
+            levels = sorted(_books.get(inscode, {}).items())
+            rows.append((inscode, json.dumps([[level] + list(values) for level, values in levels])))
+    conn.executemany('''
+        INSERT OR REPLACE INTO order_book (inscode, levels, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+    ''', rows)
+
+def get_order_book(inscode):
+    """
+    سطوح صف خرید/فروش یک نماد (از حافظه، یا آخرین دفتر ذخیره شده)
+    خروجی: لیست دیکشنری‌های {'level', 'buy_count', 'buy_volume', ...} به ترتیب سطح
+    """
+    inscode = int(inscode)
+    conn = get_db_connection()
+    try:
+        book = _load_books(conn, [inscode])[inscode]
+    finally:
+        conn.close()
+    return _levels(book)
+
+def _levels(book):
+    return [dict(zip(('level',) + LEVEL_FIELDS, (level,) + values)) for level, values in sorted(book.items())]
+
+def _load_books(conn, inscodes):
+    """
+    دفتر چند نماد: از حافظه، و برای بقیه آخرین دفتر ذخیره شده با یک پرس‌وجو
+    (در پروسه وب دفتر حافظه خالی است)؛ خروجی: inscode -> {سطح: مقادیر}
+    """
+    with _lock:
+        books = {i: dict(_books.get(i) or {}) for i in inscodes}
+    missing = [i for i, book in books.items() if not book]
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        for row in conn.execute(f"SELECT inscode, levels FROM order_book WHERE inscode IN ({placeholders})", missing):
+            books[row['inscode']] = {item[0]: tuple(item[1:]) for item in json.loads(row['levels'])}
+    return books
+
+def _average_volumes(conn, inscodes):
+    """میانگین حجم روزانه LIQUIDITY_LOOKBACK_DAYS روز معاملاتی اخیر هر نماد (از daily_bars)"""
+    placeholders = ','.join('?' * len(inscodes))
+    rows = conn.execute(f'''
+        SELECT inscode, AVG(volume) FROM (
+            SELECT inscode, volume,
+                   ROW_NUMBER() OVER (PARTITION BY inscode ORDER BY tarikh DESC) AS rn
+            FROM daily_bars WHERE inscode IN ({placeholders}) AND volume > 0
+        ) WHERE rn <= ? GROUP BY inscode
+    ''', list(inscodes) + [LIQUIDITY_LOOKBACK_DAYS]).fetchall()
+    return {r[0]: r[1] for r in rows}
+
+def estimate_liquidity(positions, participation=None):
+    """
+    تخمین نقدشوندگی دارایی‌ها
+    positions: دیکشنری inscode -> تعداد
+    days_to_exit: تعداد روز لازم برای فروش کامل با participation (مثلا ۱۰٪) از میانگین حجم روزانه
+    bid_depth: حجم صف خرید فعلی (قابل فروش فوری) و spread_pct: فاصله بهترین خرید و فروش
+    خروجی: دیکشنری inscode -> دیکشنری تخمین‌ها (مقدار None یعنی داده کافی نیست)
+    """
+    participation = participation or LIQUIDITY_PARTICIPATION
+    positions = {int(k): float(v) for k, v in positions.items() if v and v > 0}
+    if not positions:
+        return {}
+
+    conn = get_db_connection()
+    try:
+        avg_volumes = _average_volumes(conn, positions)
+        books = _load_books(conn, list(positions))
+    finally:
+        conn.close()
+
+    result = {}
+    for inscode, qty in positions.items():
+        avg_volume = avg_volumes.get(inscode)
+        levels = _levels(books[inscode])
+        bid_depth = sum(l['buy_volume'] for l in levels)
+        top = levels[0] if levels else None
+        spread_pct = None
+        if top and top['buy_price'] > 0 and top['sell_price'] > 0:
+            spread_pct = round((top['sell_price'] - top['buy_price']) / top['buy_price'] * 100, 2)
+        result[inscode] = {
+            'qty': qty,
+            'avg_volume': avg_volume,
+            'days_to_exit': round(qty / (avg_volume * participation), 1) if avg_volume else None,
+            'bid_depth': bid_depth,
+            'spread_pct': spread_pct,
+        }
+    return result
+
+def get_portfolio_liquidity(portfolio_id, participation=None):
+    """تخمین نقدشوندگی دارایی‌های یک سبد (کلید: inscode؛ مانده از جدول positions)"""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(
+            "SELECT inscode, qty FROM positions WHERE portfolio_id = ? AND inscode IS NOT NULL AND qty > 0.001",
+            (portfolio_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return estimate_liquidity({r['inscode']: r['qty'] for r in rows}, participation)
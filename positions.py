@@ -0,0 +1,145 @@
+import sys
+
+# =========================================================
+# مانده دارایی‌ها (positions): تعداد، بهای تمام شده، سود/زیان تحقق یافته و تاریخ آخرین معامله
+# هر نماد هر سبد. همراه با ثبت/ویرایش/حذف تراکنش و در همان تراکنش دیتابیس بروزرسانی می‌شود،
+# پس ارزش‌گذاری سبد فقط یک join با قیمت‌هاست (بدون بازپخش کل تاریخچه).
+#   python positions.py verify    مقایسه جدول با بازپخش کامل تاریخچه (بدون تغییر)
+#   python positions.py rebuild   بازسازی کامل جدول از روی تاریخچه
+# =========================================================
+
+# مانده کمتر از این مقدار صفر حساب می‌شود (مثل محاسبات قبلی)
+EPSILON = 0.001
+
+TRADES_SQL = '''
+    SELECT portfolio_id, symbol, inscode, transaction_type, quantity, price, commission, date
+    FROM transactions
+    WHERE transaction_type IN ('buy', 'sell') AND symbol IS NOT NULL AND symbol != ''
+'''
+
+def apply_trade(pos, t_type, qty, price, commission):
+    """
+    اعمال یک خرید/فروش روی مانده با منطق میانگین موزون
+    pos: لیست [qty, cost, realized_pnl] (درجا تغییر می‌کند)
+    فروش بدون مانده نادیده گرفته می‌شود و فروش بیش از مانده، مانده را صفر می‌کند.
+    """
+    qty = float(qty or 0)
+    price = float(price or 0)
+    commission = float(commission or 0)
+    if t_type == 'buy':
+        pos[0] += qty
+        pos[1] += qty * price + commission
+    elif t_type == 'sell' and pos[0] > 0:
+        avg_cost = pos[1] / pos[0]
+        pos[2] += qty * price - commission - qty * avg_cost
+        pos[0] -= qty
+        pos[1] -= qty * avg_cost
+        if pos[0] <= 0:
+            pos[0] = 0.0
+            pos[1] = 0.0
+
+def replay(rows):
+    """
+    بازپخش تراکنش‌های خرید/فروش (به ترتیب تاریخ و id)
+    خروجی: دیکشنری (portfolio_id, symbol) -> [qty, cost, realized_pnl, inscode, last_trade_date]
+    """
+    result = {}
+    for r in rows:
+        key = (r['portfolio_id'], r['symbol'])
+        pos = result.get(key)
+        if pos is None:
+            pos = result[key] = [0.0, 0.0, 0.0, None, None]
+        apply_trade(pos, r['transaction_type'], r['quantity'], r['price'], r['commission'])
+        pos[3] = r['inscode'] or pos[3]
+        pos[4] = r['date']
+    return result
+
+def _save(conn, positions):
+    conn.executemany('''
+        INSERT INTO positions (portfolio_id, symbol, inscode, qty, cost, realized_pnl, last_trade_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(portfolio_id, symbol) DO UPDATE SET
+            inscode = excluded.inscode, qty = excluded.qty, cost = excluded.cost,
+            realized_pnl = excluded.realized_pnl, last_trade_date = excluded.last_trade_date
+    ''', [(pid, symbol, p[3], p[0], p[1], p[2], p[4]) for (pid, symbol), p in positions.items()])
+
+def refresh_position(conn, portfolio_id, symbol):
+    """بازسازی مانده یک نماد یک سبد از تراکنش‌های همان نماد (پس از ویرایش/حذف یا تراکنش با تاریخ گذشته)"""
+    rows = conn.execute(
+        TRADES_SQL + " AND portfolio_id = ? AND symbol = ? ORDER BY date, id", (portfolio_id, symbol)
+    ).fetchall()
+    positions = replay(rows)
+    if positions:
+        _save(conn, positions)
+    else:
+        conn.execute("DELETE FROM positions WHERE portfolio_id = ? AND symbol = ?", (portfolio_id, symbol))
+
+def apply_transaction(conn, portfolio_id, symbol, inscode, t_type, qty, price, commission, date):
+    """
+    بروزرسانی مانده پس از ثبت یک تراکنش جدید (commit با فراخواننده است)
+    اگر تاریخ تراکنش از آخرین معامله نماد عقب‌تر نباشد فقط همین ردیف اعمال می‌شود،
+    وگرنه (ترتیب میانگین موزون عوض شده) مانده همان نماد بازسازی می‌شود.
+    """
+    if t_type not in ('buy', 'sell') or not symbol:
+        return
+    row = conn.execute('''
+        SELECT qty, cost, realized_pnl, inscode, last_trade_date FROM positions
+        WHERE portfolio_id = ? AND symbol = ?
+    ''', (portfolio_id, symbol)).fetchone()
+    if row is not None and row['last_trade_date'] and date < row['last_trade_date']:
+        refresh_position(conn, portfolio_id, symbol)
+        return
+
+    pos = [row['qty'], row['cost'], row['realized_pnl']] if row else [0.0, 0.0, 0.0]
+    apply_trade(pos, t_type, qty, price, commission)
+    pos += [inscode or (row['inscode'] if row else None), date]
+    _save(conn, {(portfolio_id, symbol): pos})
+
+def rebuild_positions(conn, portfolio_id=None):
+    """بازسازی کامل جدول (یا فقط یک سبد) از روی تاریخچه؛ خروجی: تعداد ردیف‌ها (commit با فراخواننده است)"""
+    if portfolio_id is None:
+        conn.execute("DELETE FROM positions")
+        rows = conn.execute(TRADES_SQL + " ORDER BY date, id").fetchall()
+    else:
+        conn.execute("DELETE FROM positions WHERE portfolio_id = ?", (portfolio_id,))
+        rows = conn.execute(TRADES_SQL + " AND portfolio_id = ? ORDER BY date, id", (portfolio_id,)).fetchall()
+    positions = replay(rows)
+    _save(conn, positions)
+    return len(positions)
+
+def verify_positions(conn, tolerance=0.01):
+    """
+    مقایسه جدول positions با بازپخش کامل تاریخچه
+    خروجی: لیست اختلاف‌ها (portfolio_id, symbol, مقدار جدول, مقدار بازپخش)
+    """
+    expected = replay(conn.execute(TRADES_SQL + " ORDER BY date, id").fetchall())
+    stored = {
+        (r['portfolio_id'], r['symbol']): (r['qty'], r['cost'], r['realized_pnl'])
+        for r in conn.execute("SELECT portfolio_id, symbol, qty, cost, realized_pnl FROM positions")
+    }
+    mismatches = []
+    for key in expected.keys() | stored.keys():
+        want = tuple(expected[key][:3]) if key in expected else None
+        have = stored.get(key)
+        if want is None or have is None or any(abs(a - b) > tolerance for a, b in zip(have, want)):
+            mismatches.append((key[0], key[1], have, want))
+    return mismatches
+
+if __name__ == "__main__":
+    from database import get_db_connection
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('verify', 'rebuild'):
+        print("Usage: python positions.py verify|rebuild")
+        sys.exit(1)
+    conn = get_db_connection()
+    try:
+        if sys.argv[1] == 'rebuild':
+            print(f"Rebuilt {rebuild_positions(conn)} positions.")
+            conn.commit()
+        mismatches = verify_positions(conn)
+    finally:
+        conn.close()
+    for pid, symbol, have, want in mismatches:
+        print(f"portfolio {pid} {symbol}: table={have} replay={want}")
+    print(f"{len(mismatches)} mismatches.")
+    sys.exit(1 if mismatches else 0)
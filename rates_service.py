@@ -1,7 +1,22 @@
-import requests
+import os
 import re
+import http_client
 import time
 import random
+import threading
+
+# =========================================================
+# کش نرخ‌ها (TTL + stale-while-revalidate)
+# آخرین مقادیر معتبر فوراً برگردانده می‌شوند و در صورت کهنه بودن،
+# بروزرسانی در پس‌زمینه انجام می‌شود. خطای منبع هرگز مقدار قبلی را پاک نمی‌کند.
+# =========================================================
+
+RATES_TTL = int(os.environ.get('KINKO_RATES_TTL', 120))   # ثانیه
+
+_rates_lock = threading.Lock()
+_rates_cache = {'dollar': None, 'gold_ounce': None, 'total_index': None}
+_rates_fetched_at = None
+_rates_refreshing = False
 
 def get_latest_rates():
     """
@@ -33,7 +48,7 @@ def get_latest_rates():
         # اضافه کردن پارامتر تصادفی برای جلوگیری از کش شدن سمت سرور/کلاینت
         url = f"https://www.tgju.org/?_={int(time.time())}"
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = http_client.get(url, headers=headers, timeout=10)
         
         if response.status_code == 200:
             html = response.text
@@ -60,6 +75,54 @@ def get_latest_rates():
         
     return rates
 
+def _refresh_rates_cache():
+    global _rates_fetched_at, _rates_refreshing
+    try:
+        from tsetmc_service import get_market_index
+        fresh = get_latest_rates()
+        fresh['total_index'] = get_market_index()
+
+        with _rates_lock:
+            for key, value in fresh.items():
+                if value:
+                    _rates_cache[key] = value
+            # حتی در صورت شکست، تا TTL بعدی دوباره تلاش نمی‌شود تا منبع زیر فشار نرود
+            _rates_fetched_at = time.time()
+    except Exception as e:
+        print(f"Rates cache refresh error: {e}")
+    finally:
+        from database import release_db_connection
+        release_db_connection()
+        with _rates_lock:
+            _rates_refreshing = False
+
+def get_cached_rates():
+    """
+    نرخ‌های دلار، انس و شاخص از کش به همراه سن داده (ثانیه)
+    اگر کش کهنه باشد، فقط یک بروزرسانی پس‌زمینه شروع می‌شود و درخواست منتظر نمی‌ماند.
+    """
+    global _rates_refreshing
+    now = time.time()
+    with _rates_lock:
+        result = dict(_rates_cache)
+        fetched_at = _rates_fetched_at
+        stale = fetched_at is None or (now - fetched_at) > RATES_TTL
+        start_refresh = stale and not _rates_refreshing
+        if start_refresh:
+            _rates_refreshing = True
+
+    if start_refresh:
+        threading.Thread(target=_refresh_rates_cache, daemon=True).start()
+
+    # شروع سرد: شاخص ذخیره شده در دیتابیس تا رسیدن مقدار تازه
+    if not result['total_index']:
+        from database import get_stored_market_index
+        result['total_index'], _ = get_stored_market_index()
+
+    result['age_seconds'] = int(now - fetched_at) if fetched_at else None
+    result['stale'] = stale
+    return result
+
 if __name__ == "__main__":
     # تست تابع هنگام اجرای مستقیم
     print(get_latest_rates())
\ No newline at end of file
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import contextmanager, nullcontext
+
+from database import get_db_connection
+
+# =========================================================
+# زمان‌سنجی مراحل هر دور بروزرسانی بازار
+# هر دور (full/delta) زمان مراحل (شبکه، پارس، طبقه‌بندی، نوشتن، commit، شاخص ...)،
+# شمارنده‌ها و خطاها به تفکیک دلیل را جمع می‌کند و در refresh_runs ذخیره می‌شود
+# (فقط KEEP_RUNS دور آخر نگه داشته می‌شود).
+# =========================================================
+
+KEEP_RUNS = int(os.environ.get('KINKO_REFRESH_KEEP_RUNS', 200))
+
+class RefreshRun:
+    """
+    آمار یک دور بروزرسانی
+    زمان هر مرحله انحصاری است: زمان مراحل تو در تو از مرحله بیرونی کم می‌شود
+    (مثلا classify داخل db_write جداگانه شمرده می‌شود).
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._stack = []
+        self.stages = {}     # نام مرحله -> میلی‌ثانیه
+        self.counts = {}
+        self.errors = {}     # دلیل -> تعداد
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            children = self._stack.pop()
+            elapsed = time.perf_counter() - started
+            self.stages[name] = self.stages.get(name, 0.0) + (elapsed - children) * 1000
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def timed(self, func, name):
+        """نسخه زمان‌سنجی شده یک تابع (برای callback هایی مثل classify)"""
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def error(self, reason, value=1):
+        self.errors[reason] = self.errors.get(reason, 0) + value
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'started_at': self.started_at,
+            'total_ms': round((time.perf_counter() - self._started) * 1000, 1),
+            'stages': {k: round(v, 1) for k, v in self.stages.items()},
+            'counts': dict(self.counts),
+            'errors': dict(self.errors),
+        }
+
+    def save(self, ok, message=None):
+        """ذخیره دور در refresh_runs و حذف دورهای قدیمی‌تر از KEEP_RUNS (خطای ذخیره، بروزرسانی را متوقف نمی‌کند)"""
+        data = self.as_dict()
+        conn = get_db_connection()
+        try:
+            conn.execute('''
+                INSERT INTO refresh_runs (kind, started_at, ok, total_ms, stages, counts, errors, message)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                self.kind, self.started_at, 1 if ok else 0, data['total_ms'],
+                json.dumps(data['stages']), json.dumps(data['counts']), json.dumps(data['errors']),
+                message
+            ))
+            conn.execute("DELETE FROM refresh_runs WHERE id <= (SELECT MAX(id) FROM refresh_runs) - ?", (KEEP_RUNS,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Refresh metrics not saved: {e}")
+        finally:
+            conn.close()
+        return data
+
+def stage(run, name):
+    """run.stage(name) یا در صورت نبودن run، بدون زمان‌سنجی"""
+    return run.stage(name) if run is not None else nullcontext()
+
+def get_recent_runs(limit=50, kind=None):
+    """
+    آخرین دورهای بروزرسانی (جدیدترین اول) به همراه میانگین زمان هر مرحله
+    خروجی: {'runs': [...], 'avg_stages': {...}, 'errors': {...}}
+    """
+    sql = "SELECT * FROM refresh_runs"
+    params = []
+    if kind:
+        sql += " WHERE kind = ?"
+        params.append(kind)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(int(limit))
+
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+    runs = []
+    totals = {}
+    errors = {}
+    for row in rows:
+        run = dict(row)
+        for key in ('stages', 'counts', 'errors'):
+            run[key] = json.loads(run[key] or '{}')
+        run['ok'] = bool(run['ok'])
+        for name, ms in run['stages'].items():
+            totals[name] = totals.get(name, 0.0) + ms
+        for reason, value in run['errors'].items():
+            errors[reason] = errors.get(reason, 0) + value
+        runs.append(run)
+
+    avg_stages = {name: round(ms / len(runs), 1) for name, ms in totals.items()} if runs else {}
+    return {'runs': runs, 'avg_stages': avg_stages, 'errors': errors}
@@ -0,0 +1,77 @@
+import threading
+
+from database import get_db_connection, get_data_versions
+
+# =========================================================
+# وزن صنایع (Sector Exposure) هر سبد و کل شرکت
+# مانده هر نماد (جدول positions) و ارزش روز آن با یک پرس‌وجوی گروه‌بندی شده برای همه سبدها
+# محاسبه می‌شود و تا تغییر بعدی قیمت، تراکنش یا نمادها (data_versions) در حافظه می‌ماند.
+# =========================================================
+
+EXPOSURE_SQL = '''
+    SELECT pos.portfolio_id, i.sector_code,
+           COALESCE(s.name, i.sector, 'سایر') AS sector,
+           SUM(pos.qty * IFNULL(p.last_price, 0)) AS value
+    FROM positions pos
+    JOIN instruments i ON i.inscode = pos.inscode
+    LEFT JOIN instrument_prices p ON p.inscode = pos.inscode
+    LEFT JOIN sectors s ON s.code = i.sector_code
+    WHERE pos.inscode IS NOT NULL AND pos.qty > 0.001
+    GROUP BY pos.portfolio_id, 3
+'''
+
+_lock = threading.Lock()
+_cache = {'versions': None, 'rows': []}
+
+def _load_rows():
+    """ردیف‌های (portfolio_id, sector_code, sector, value) از کش یا دیتابیس"""
+    conn = get_db_connection()
+    try:
+        versions = get_data_versions(conn)
+        with _lock:
+            if _cache['versions'] == versions:
+                return _cache['rows']
+        cur = conn.cursor()
+        cur.row_factory = None
+        rows = cur.execute(EXPOSURE_SQL).fetchall()
+    finally:
+        conn.close()
+
+    with _lock:
+        _cache['versions'] = versions
+        _cache['rows'] = rows
+    return rows
+
+def _summarize(rows):
+    """تجمیع بر اساس صنعت و محاسبه وزن (درصد) هر صنعت"""
+    sectors = {}
+    for _, code, name, value in rows:
+        item = sectors.setdefault(name, {'sector': name, 'code': code, 'value': 0.0})
+        item['value'] += value or 0
+    total = sum(item['value'] for item in sectors.values())
+    result = sorted(sectors.values(), key=lambda item: item['value'], reverse=True)
+    for item in result:
+        item['weight'] = round(item['value'] / total * 100, 2) if total > 0 else 0.0
+    return result
+
+def get_sector_exposure(portfolio_id=None):
+    """
+    وزن صنایع یک سبد (یا کل شرکت اگر portfolio_id ارسال نشود)
+    خروجی: لیست {'sector', 'code', 'value', 'weight'} به ترتیب ارزش (نزولی)
+    """
+    rows = _load_rows()
+    if portfolio_id is not None:
+        portfolio_id = int(portfolio_id)
+        rows = [r for r in rows if r[0] == portfolio_id]
+    return _summarize(rows)
+
+def get_all_sector_exposures():
+    """وزن صنایع همه سبدها به همراه کل شرکت: {'firm': [...], 'portfolios': {id: [...]}}"""
+    rows = _load_rows()
+    by_portfolio = {}
+    for row in rows:
+        by_portfolio.setdefault(row[0], []).append(row)
+    return {
+        'firm': _summarize(rows),
+        'portfolios': {pid: _summarize(items) for pid, items in by_portfolio.items()},
+    }
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# =========================================================
+# سرور استاب آفلاین برای TSETMC و TGJU
+# پاسخ‌های ضبط شده با KINKO_HTTP_CAPTURE را با تاخیر و خطای قابل تنظیم بازپخش می‌کند.
+#   ضبط:    python stub_server.py record captures/
+#   بازپخش: python stub_server.py serve captures/ --port 8765 --latency 300 --fail-rate 0.1
+#   اجرا:   KINKO_HTTP_STUB=http://127.0.0.1:8765 python market_refresher.py --once
+# آدرس درخواست‌ها به شکل /<هاست اصلی>/<مسیر>?<کوئری> است (http_client.capture_key).
+# =========================================================
+
+# مسیرهایی که آخرین بخششان پارامتر است (مثل تعداد روزهای تاریخچه شاخص یا قیمت‌های روزانه یک نماد)؛
+# در بازپخش هر مقداری از این بخش با پاسخ ضبط شده همان مسیر جواب داده می‌شود
+VARIABLE_TAIL_PATHS = (
+    '/api/MarketData/GetOverallIndexHistory/',
+    '/api/ClosingPrice/GetClosingPriceDailyList/',
+)
+
+def _normalize(key):
+    return unquote(key)
+
+def _family(path):
+    """مسیر بدون بخش پارامتری انتهایی (یا None اگر مسیر در VARIABLE_TAIL_PATHS نباشد)"""
+    if any(prefix in path for prefix in VARIABLE_TAIL_PATHS):
+        return path.rsplit('/', 1)[0] + '/'
+    return None
+
+def load_captures(directory):
+    """
+    بارگذاری پاسخ‌های ضبط شده
+    خروجی: (کلید کامل -> لیست پاسخ‌ها، هاست+مسیر -> لیست پاسخ‌ها، مسیر بدون پارامتر انتهایی -> لیست پاسخ‌ها)
+    به ترتیب ضبط؛ هر پاسخ: (captured_at, status, content_type, body)
+    """
+    by_key = {}
+    by_path = {}
+    by_family = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        base = os.path.join(directory, name[:-5])
+        with open(base + '.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(base + '.body', 'rb') as f:
+            body = f.read()
+        item = (meta.get('captured_at', 0), meta['status'], meta.get('content_type'), body)
+        key = _normalize(meta['key'])
+        by_key.setdefault(key, []).append(item)
+        path = key.split('?', 1)[0]
+        by_path.setdefault(path, []).append(item)
+        family = _family(path)
+        if family:
+            by_family.setdefault(family, []).append(item)
+    for table in (by_key, by_path, by_family):
+        for items in table.values():
+            items.sort(key=lambda item: item[0])
+    return by_key, by_path, by_family
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, captures, latency=0.0, jitter=0.0, fail_rate=0.0, fail_status=503,
+                 hang_rate=0.0, hang_seconds=30.0, loop=False, seed=None):
+        super().__init__(address, StubHandler)
+        self.by_key, self.by_path, self.by_family = captures
+        self.latency = latency            # ثانیه
+        self.jitter = jitter              # ثانیه (تصادفی بین 0 و jitter اضافه می‌شود)
+        self.fail_rate = fail_rate        # احتمال پاسخ fail_status
+        self.fail_status = fail_status
+        self.hang_rate = hang_rate        # احتمال معطل ماندن (برای تست timeout)
+        self.hang_seconds = hang_seconds
+        self.loop = loop                  # پس از آخرین پاسخ ضبط شده، از اول تکرار شود
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.positions = {}
+        self.stats = {'requests': 0, 'served': 0, 'failed': 0, 'hung': 0, 'missing': 0}
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def next_response(self, key):
+        """پاسخ بعدی یک کلید (ابتدا کلید کامل، سپس همان مسیر با هر کوئری، سپس همان مسیر با هر پارامتر انتهایی)"""
+        items = self.by_key.get(key)
+        table_key = ('key', key)
+        path = key.split('?', 1)[0]
+        if not items:
+            items = self.by_path.get(path)
+            table_key = ('path', path)
+        if not items:
+            family = _family(path)
+            items = self.by_family.get(family) if family else None
+            table_key = ('family', family)
+        if not items:
+            return None
+        with self.lock:
+            pos = self.positions.get(table_key, 0)
+            self.positions[table_key] = pos + 1
+        if self.loop:
+            return items[pos % len(items)]
+        return items[min(pos, len(items) - 1)]
+
+    def count(self, field):
+        with self.lock:
+            self.stats[field] += 1
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = 'KinkoStub/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        path = self.path.lstrip('/')
+
+        if path == '_stub/stats':
+            with server.lock:
+                self._send(200, 'application/json', json.dumps(server.stats).encode('utf-8'))
+            return
+
+        with server.lock:
+            delay = server.latency + server.random.uniform(0, server.jitter)
+            roll = server.random.random()
+        if roll < server.hang_rate:
+            server.count('hung')
+            time.sleep(server.hang_seconds)
+        elif delay:
+            time.sleep(delay)
+
+        if roll >= server.hang_rate and roll < server.hang_rate + server.fail_rate:
+            server.count('failed')
+            self._send(server.fail_status, 'text/plain', b'injected failure')
+            return
+
+        item = server.next_response(_normalize(path))
+        if item is None:
+            server.count('missing')
+            self._send(404, 'text/plain', b'no capture')
+            return
+        _, status, content_type, body = item
+        server.count('served')
+        self._send(status, content_type, body)
+
+    def _send(self, status, content_type, body):
+        try:
+            self.send_response(status)
+            if content_type:
+                self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # کلاینت (مثلا بازنده درخواست موازی) زودتر اتصال را بسته است
+            pass
+
+def write_capture(directory, url, body, status=200, content_type='text/plain; charset=utf-8', captured_at=None):
+    """
+    افزودن یک پاسخ ساختگی به پوشه ضبط با همان قالب http_client (برای تست‌ها)
+    body: متن یا bytes؛ پاسخ‌های یک کلید به ترتیب captured_at بازپخش می‌شوند
+    """
+    import http_client
+    key = http_client.capture_key(url)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"{len(os.listdir(directory)) // 2:05d}")
+    with open(base + '.body', 'wb') as f:
+        f.write(body)
+    meta = {'url': url, 'key': key, 'status': status, 'content_type': content_type,
+            'captured_at': time.time() if captured_at is None else captured_at}
+    with open(base + '.json', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+def start(directory, host='127.0.0.1', port=0, **options):
+    """اجرای سرور استاب در یک رشته پس‌زمینه؛ خروجی: سرور (آدرس در server.url، توقف با server.shutdown())"""
+    server = StubServer((host, port), load_captures(directory), **options)
+    threading.Thread(target=server.serve_forever, daemon=True, name='stub-server').start()
+    return server
+
+def record(directory):
+    """ضبط پاسخ‌های فعلی دیده‌بان، شاخص، تاریخچه شاخص و نرخ‌های TGJU در directory"""
+    import http_client
+    from tsetmc_service import (download_market_watch, get_market_index, GLOBAL_HEADERS,
+                                INDEX_HISTORY_URL, INDEX_HISTORY_BACKFILL_DAYS)
+    from rates_service import get_latest_rates
+
+    http_client.set_capture_dir(directory)
+    try:
+        download_market_watch()
+        get_market_index()
+        # تاریخچه شاخص مستقیم با اندازه backfill کامل (نه از جدول محلی index_history)
+        headers = dict(GLOBAL_HEADERS, Referer='http://cdn.tsetmc.com')
+        http_client.get(INDEX_HISTORY_URL.format(days=INDEX_HISTORY_BACKFILL_DAYS),
+                        headers=headers, timeout=15, verify=False)
+        get_latest_rates()
+    finally:
+        http_client.set_capture_dir(None)
+    print(f"Captured {len([f for f in os.listdir(directory) if f.endswith('.json')])} responses in {directory}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record/replay stub for TSETMC and TGJU')
+    parser.add_argument('mode', choices=['record', 'serve'])
+    parser.add_argument('directory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds')
+    parser.add_argument('--jitter', type=float, default=0, help='milliseconds')
+    parser.add_argument('--fail-rate', type=float, default=0)
+    parser.add_argument('--fail-status', type=int, default=503)
+    parser.add_argument('--hang-rate', type=float, default=0)
+    parser.add_argument('--hang-seconds', type=float, default=30)
+    parser.add_argument('--loop', action='store_true')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    if args.mode == 'record':
+        record(args.directory)
+        sys.exit(0)
+
+    server = StubServer(
+        (args.host, args.port), load_captures(args.directory),
+        latency=args.latency / 1000, jitter=args.jitter / 1000,
+        fail_rate=args.fail_rate, fail_status=args.fail_status,
+        hang_rate=args.hang_rate, hang_seconds=args.hang_seconds,
+        loop=args.loop, seed=args.seed
+    )
+    print(f"Stub server on {server.url} ({sum(len(v) for v in server.by_key.values())} responses)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
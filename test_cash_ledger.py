@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import database
+import analysis
+
+# =========================================================
+# تست دفتر نقدینگی: cash_delta هر تراکنش و current_cash سبد در ثبت، ویرایش و حذف گروهی
+# و بررسی دوره‌ای verify_portfolio_cash (فقط گزارش؛ --fix مبلغ تراکنش‌ها را تغییر نمی‌دهد)
+#   python -m unittest test_cash_ledger
+# =========================================================
+
+class CashLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = database.DB_PATH
+        database.DB_PATH = os.path.join(self.tmp, 'test.db')
+        database.init_db()
+        conn = database.get_db_connection()
+        try:
+            self.pid = conn.execute("INSERT INTO portfolios (name, current_cash) VALUES ('test', 0)").lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+
+    def tearDown(self):
+        database.release_db_connection()
+        database.DB_PATH = self.db_path
+        shutil.rmtree(self.tmp)
+
+    def _add(self, t_type, price, qty=None, commission=None, date='2024-01-10'):
+        data = {'portfolio_id': self.pid, 'type': t_type, 'symbol': 'فولاد' if qty else None,
+                'price': price, 'date': date}
+        if qty:
+            data['quantity'] = qty
+        if commission is not None:
+            data['commission'] = commission
+        database.add_new_transaction(data)
+        conn = database.get_db_connection()
+        try:
+            return conn.execute("SELECT MAX(id) FROM transactions").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _cash(self):
+        conn = database.get_db_connection()
+        try:
+            stored = conn.execute("SELECT current_cash FROM portfolios WHERE id = ?", (self.pid,)).fetchone()[0]
+            ledger = conn.execute(
+                "SELECT IFNULL(SUM(cash_delta), 0) FROM transactions WHERE portfolio_id = ?", (self.pid,)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        self.assertAlmostEqual(stored, ledger, places=4)
+        return stored
+
+    def test_insert(self):
+        self._add('deposit', 1000000)
+        self._add('buy', 1000, qty=100, commission=500)
+        self._add('sell', 1200, qty=50, commission=300)
+        self._add('withdraw', 10000)
+        self.assertAlmostEqual(self._cash(), 1000000 - 100500 + 59700 - 10000)
+        self.assertEqual(database.verify_portfolio_cash(), [])
+
+    def test_update_recomputes_amount_and_cash(self):
+        self._add('deposit', 1000000)
+        tid = self._add('buy', 1000, qty=100, commission=500)
+        analysis.update_transaction(tid, 'buy', 200, 1000, '2024-01-10')
+
+        conn = database.get_db_connection()
+        try:
+            row = conn.execute("SELECT amount, commission, cash_delta FROM transactions WHERE id = ?", (tid,)).fetchone()
+        finally:
+            conn.close()
+        self.assertAlmostEqual(row['amount'], 200 * 1000 + row['commission'])
+        self.assertAlmostEqual(row['cash_delta'], -row['amount'])
+        self.assertAlmostEqual(self._cash(), 1000000 - row['amount'])
+        self.assertEqual(database.verify_portfolio_cash(), [])
+        self.assertEqual(database.find_amount_mismatches(), [])
+
+    def test_bulk_delete(self):
+        self._add('deposit', 1000000)
+        ids = [self._add('buy', 1000, qty=100, commission=500), self._add('sell', 1200, qty=50, commission=300)]
+        self.assertEqual(analysis.delete_transactions(ids), 2)
+        self.assertAlmostEqual(self._cash(), 1000000)
+        self.assertEqual(database.verify_portfolio_cash(), [])
+
+    def test_verify_reports_and_fix_keeps_amount(self):
+        self._add('deposit', 1000000)
+        tid = self._add('buy', 1000, qty=100, commission=500)
+        conn = database.get_db_connection()
+        try:
+            # مبلغ قدیمی/دستی متفاوت با تعداد × قیمت + کارمزد، و نقدینگی ذخیره شده خراب
+            conn.execute("UPDATE transactions SET amount = 100000 WHERE id = ?", (tid,))
+            conn.execute("UPDATE portfolios SET current_cash = 1 WHERE id = ?", (self.pid,))
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.assertEqual(database.find_amount_mismatches(), [(tid, self.pid, 100000, 100500)])
+        [(pid, stored, ledger, expected)] = database.verify_portfolio_cash()
+        self.assertEqual((pid, stored, ledger, expected), (self.pid, 1, 1000000 - 100500, 1000000 - 100000))
+        # بدون fix چیزی تغییر نمی‌کند
+        self.assertEqual(len(database.verify_portfolio_cash()), 1)
+
+        database.verify_portfolio_cash(fix=True)
+        self.assertEqual(database.verify_portfolio_cash(), [])
+        self.assertAlmostEqual(self._cash(), 1000000 - 100000)
+        conn = database.get_db_connection()
+        try:
+            self.assertEqual(conn.execute("SELECT amount FROM transactions WHERE id = ?", (tid,)).fetchone()[0], 100000)
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import database
+import market_breadth
+import asset_classifier
+import tsetmc_parser
+import tsetmc_service
+
+# =========================================================
+# تست اتصال‌های قابل استفاده مجدد (get_db_connection) و جایگزینی کدهای موقت نمادها
+# هر فراخوانی اتصال جدای خود را دارد و helper هایی که conn می‌گیرند commit نمی‌کنند،
+# پس rollback فراخواننده همه نوشته‌های همان تراکنش را لغو می‌کند.
+#   python -m unittest test_database
+# =========================================================
+
+INSCODE = 111
+
+def _row(**values):
+    row_type = tsetmc_parser.get_row_type(tsetmc_parser.FULL_ROW_COLUMNS)
+    row = row_type(**{f: 0 for f in tsetmc_parser.FULL_ROW_COLUMNS})
+    return row._replace(inscode=INSCODE, symbol='فولاد', **values)
+
+class PooledConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = database.DB_PATH
+        database.DB_PATH = os.path.join(self.tmp, 'test.db')
+        database.init_db()
+        conn = database.get_db_connection()
+        try:
+            conn.execute(
+                "INSERT INTO instruments (inscode, symbol, symbol_norm, company_name, asset_type) "
+                "VALUES (?, 'فولاد', 'فولاد', 'فولاد مبارکه', 'Stock')",
+                (INSCODE,)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def tearDown(self):
+        database.release_db_connection()
+        database.DB_PATH = self.db_path
+        shutil.rmtree(self.tmp)
+
+    def _count(self, sql, params=()):
+        conn = database.get_db_connection()
+        try:
+            return conn.execute(sql, params).fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_nested_helpers_roll_back_with_caller(self):
+        conn = database.get_db_connection()
+        try:
+            conn.execute("INSERT INTO sectors (code, name) VALUES (9999, 'test')")
+            market_breadth.record_breadth(conn, [_row(trades=10, volume=1000, value=1e6, close=110, last=110, yesterday=100)])
+            asset_classifier.set_override(conn, INSCODE, asset_classifier.ETF_GOLD)
+
+            # فراخوانی تو در تو اتصال جدا دارد: نوشته‌های commit نشده را نمی‌بیند و بستنش آن‌ها را لغو نمی‌کند
+            inner = database.get_db_connection()
+            self.assertIsNot(inner, conn)
+            self.assertEqual(inner.execute("SELECT COUNT(*) FROM sectors WHERE code = 9999").fetchone()[0], 0)
+            inner.close()
+            self.assertTrue(conn.in_transaction)
+
+            conn.rollback()
+        finally:
+            conn.close()
+
+        self.assertEqual(self._count("SELECT COUNT(*) FROM sectors WHERE code = 9999"), 0)
+        self.assertEqual(self._count("SELECT COUNT(*) FROM market_breadth"), 0)
+        self.assertEqual(self._count("SELECT COUNT(*) FROM asset_class_overrides"), 0)
+        self.assertEqual(self._count("SELECT asset_type FROM instruments WHERE inscode = ?", (INSCODE,)), 'Stock')
+
+    def test_close_discards_uncommitted_writes(self):
+        conn = database.get_db_connection()
+        conn.execute("INSERT INTO sectors (code, name) VALUES (9999, 'test')")
+        conn.close()
+
+        again = database.get_db_connection()
+        try:
+            self.assertIs(again, conn)   # همان اتصال دوباره استفاده می‌شود
+            self.assertEqual(again.execute("SELECT COUNT(*) FROM sectors WHERE code = 9999").fetchone()[0], 0)
+        finally:
+            again.close()
+
+    def test_release_closes_every_connection(self):
+        outer = database.get_db_connection()
+        inner = database.get_db_connection()
+        inner.close()
+        outer.close()
+        self.assertIsNot(inner, outer)
+        database.release_db_connection()
+        with self.assertRaises(Exception):
+            outer.execute("SELECT 1")
+
+class ProvisionalInscodeTest(unittest.TestCase):
+    """نمادی که پیش از دیده شدن در دیده‌بان معامله شده کد موقت منفی می‌گیرد و بعدا با کد واقعی جایگزین می‌شود"""
+
+    REAL = 555
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = database.DB_PATH
+        database.DB_PATH = os.path.join(self.tmp, 'test.db')
+        database.init_db()
+        conn = database.get_db_connection()
+        try:
+            self.pid = conn.execute("INSERT INTO portfolios (name, current_cash) VALUES ('test', 0)").lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+
+    def tearDown(self):
+        database.release_db_connection()
+        database.DB_PATH = self.db_path
+        shutil.rmtree(self.tmp)
+
+    def _query(self, sql, params=()):
+        conn = database.get_db_connection()
+        try:
+            return [tuple(r) for r in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    def test_rekey_after_first_market_refresh(self):
+        database.add_new_transaction({
+            'portfolio_id': self.pid, 'type': 'buy', 'symbol': 'نوري', 'quantity': 100, 'price': 1000,
+            'date': '2024-01-01', 'commission': 0,
+        })
+        [(provisional,)] = self._query("SELECT inscode FROM instruments")
+        self.assertLess(provisional, 0)
+        self.assertEqual(self._query("SELECT inscode FROM positions"), [(provisional,)])
+
+        conn = database.get_db_connection()
+        try:
+            asset_classifier.set_override(conn, provisional, asset_classifier.ETF_EQUITY)
+            conn.commit()
+            # «نوري» با ی عربی ثبت شده و در دیده‌بان «نوری» است؛ هر دو یک نماد یکسان‌سازی شده‌اند
+            tsetmc_service.store_market_rows(conn, [_row()._replace(inscode=self.REAL, symbol='نوری', close=1100)])
+        finally:
+            conn.close()
+
+        self.assertEqual(self._query("SELECT inscode FROM transactions"), [(self.REAL,)])
+        self.assertEqual(self._query("SELECT inscode, qty FROM positions"), [(self.REAL, 100.0)])
+        self.assertEqual(self._query("SELECT COUNT(*) FROM instruments WHERE inscode < 0"), [(0,)])
+        self.assertEqual(self._query("SELECT inscode, asset_class FROM asset_class_overrides"),
+                         [(self.REAL, asset_classifier.ETF_EQUITY)])
+        self.assertEqual(self._query("SELECT asset_type FROM instruments WHERE inscode = ?", (self.REAL,)),
+                         [(asset_classifier.ETF_EQUITY,)])
+
+        conn = database.get_db_connection()
+        try:
+            self.assertEqual(database.resolve_inscode(conn, 'نوری', create=False), self.REAL)
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import http_client
+import stub_server
+
+# =========================================================
+# تست درخواست موازی (hedged_fetch) در کنار ضبط پاسخ‌ها و سرور استاب
+#   python -m unittest test_http_client
+# =========================================================
+
+MIRRORS = ['http://mirror-a.test/data?x=1', 'http://mirror-b.test/data?x=1']
+
+def _parse(response):
+    return response.text if response.status_code == 200 else None
+
+class HedgedCaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        replay = os.path.join(self.tmp, 'replay')
+        for url in MIRRORS:
+            stub_server.write_capture(replay, url, 'ok ' + url)
+        self.server = stub_server.start(replay, latency=0.05)
+        http_client.set_stub_url(self.server.url)
+        self.captures = os.path.join(self.tmp, 'captures')
+        http_client.set_capture_dir(self.captures)
+        http_client.reset_host_stats()
+
+    def tearDown(self):
+        http_client.set_capture_dir(None)
+        http_client.set_stub_url(None)
+        self.server.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def test_only_winner_is_captured(self):
+        # delay=0: هر دو آینه همزمان درخواست می‌شوند
+        value, winner = http_client.hedged_fetch('test', [(u, _parse) for u in MIRRORS], delay=0)
+        self.assertEqual(value, 'ok ' + winner)
+        # بازنده هم پاسخ گرفته است؛ تا پایان کارش صبر می‌شود
+        deadline = time.time() + 5
+        while self.server.stats['served'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        captured = [f for f in os.listdir(self.captures) if f.endswith('.json')]
+        self.assertEqual(len(captured), 1)
+        by_key = stub_server.load_captures(self.captures)[0]
+        self.assertEqual(list(by_key), [http_client.capture_key(winner)])
+
+    def test_stats_and_breaker_use_original_hosts(self):
+        for url in MIRRORS:
+            http_client.get(url)
+        stats = http_client.get_host_stats()
+        self.assertIn('mirror-a.test', stats)
+        self.assertIn('mirror-b.test', stats)
+        self.assertNotIn(self.server.url.split('://', 1)[1], stats)
+        self.assertFalse(http_client.is_circuit_open(MIRRORS[0]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import database
+import migrations
+
+# =========================================================
+# تست اجرای مهاجرت‌ها روی دیتابیس نسخه پایه (user_version = 0، اسکیمای قبل از مهاجرت‌ها)
+#   python -m unittest test_migrations
+# =========================================================
+
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password TEXT NOT NULL,
+                        full_name TEXT, email TEXT, role TEXT DEFAULT 'manager');
+    CREATE TABLE portfolios (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, national_id TEXT, broker TEXT,
+                             manager_name TEXT, risk_level TEXT, initial_cash REAL, current_cash REAL DEFAULT 0,
+                             initial_stock_value REAL, initial_capital REAL, initial_index REAL, delivery_date TEXT,
+                             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, description TEXT, owner_id INTEGER);
+    CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, portfolio_id INTEGER, symbol TEXT, sector TEXT,
+                               transaction_type TEXT NOT NULL, quantity INTEGER, price REAL, amount REAL DEFAULT 0,
+                               asset_class TEXT DEFAULT 'Stock', date TEXT, commission REAL DEFAULT 0);
+    CREATE TABLE market_prices (symbol TEXT PRIMARY KEY, company_name TEXT, sector TEXT, asset_type TEXT,
+                                market_type TEXT DEFAULT 'TSE', last_price REAL, close_price_yesterday REAL,
+                                pe_ratio REAL, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    CREATE TABLE portfolio_history (id INTEGER PRIMARY KEY AUTOINCREMENT, portfolio_id INTEGER, record_date TEXT,
+                                    total_equity REAL);
+    CREATE TABLE model_configs (profile_name TEXT PRIMARY KEY, target_fixed_income REAL, target_gold REAL,
+                                target_equity REAL, description TEXT);
+    CREATE TABLE model_assets (id INTEGER PRIMARY KEY AUTOINCREMENT, profile_name TEXT, symbol TEXT,
+                               target_weight REAL, stop_loss REAL, target_short REAL, target_mid REAL,
+                               target_long REAL, note TEXT);
+    CREATE TABLE analysis_signals (id INTEGER PRIMARY KEY AUTOINCREMENT, symbol TEXT NOT NULL, target_buy_price REAL,
+                                   target_sell_price REAL, stop_loss_price REAL, analysis_note TEXT,
+                                   target_profile TEXT, asset_class TEXT, is_public INTEGER DEFAULT 1,
+                                   owner_id INTEGER, added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    CREATE TABLE calendar_events (id INTEGER PRIMARY KEY AUTOINCREMENT, portfolio_id INTEGER, title TEXT NOT NULL,
+                                  event_date TEXT NOT NULL, event_type TEXT, symbol TEXT, amount REAL DEFAULT 0,
+                                  is_processed INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    CREATE TABLE market_overview (id INTEGER PRIMARY KEY CHECK (id = 1), total_index REAL DEFAULT 0,
+                                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+
+    INSERT INTO portfolios (id, name, current_cash) VALUES (1, 'قدیمی', 0);
+    INSERT INTO market_prices (symbol, company_name, sector, asset_type, last_price, close_price_yesterday)
+        VALUES ('فولاد', 'فولاد مبارکه اصفهان', 'فلزات اساسی', 'Stock', 1100, 1090),
+               ('وبملتح', 'ح . بانک ملت', 'بانک‌ها', 'Stock', 300, 300),
+               ('زعفران', 'زعفران سحرخیز', 'صندوق', 'کالایی (Commodity)', 20000, 20000);
+    INSERT INTO transactions (portfolio_id, symbol, transaction_type, quantity, price, amount, date, commission)
+        VALUES (1, 'CASH', 'deposit', 1, 1000000, 1000000, '2024-01-01', 0),
+               (1, 'فولاد', 'buy', 100, 1000, 100500, '2024-01-10', 500),
+               (1, 'فولاد', 'sell', 40, 1200, 47800, '2024-01-20', 200),
+               (1, 'CASH', 'dividend', 1, 5000, 0, '2024-02-01', 0);
+    INSERT INTO calendar_events (portfolio_id, title, event_date) VALUES (1, 'مجمع', '2024-03-01');
+'''
+
+class BaselineMigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = database.DB_PATH
+        database.DB_PATH = os.path.join(self.tmp, 'test.db')
+        conn = sqlite3.connect(database.DB_PATH)
+        conn.executescript(BASELINE_SCHEMA)
+        conn.close()
+        migrations._current['done'] = False
+
+    def tearDown(self):
+        database.release_db_connection()
+        database.DB_PATH = self.db_path
+        migrations._current['done'] = False
+        shutil.rmtree(self.tmp)
+
+    def _query(self, sql, params=()):
+        conn = database.get_db_connection()
+        try:
+            return [tuple(r) for r in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    def _object_type(self, name):
+        rows = self._query("SELECT type FROM sqlite_master WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def test_baseline_to_latest(self):
+        applied = migrations.migrate()
+        self.assertEqual(applied, [number for number, _, _ in migrations.MIGRATIONS])
+        self.assertEqual(self._query("PRAGMA user_version"), [(migrations.SCHEMA_VERSION,)])
+
+        # market_prices قدیمی به instruments + instrument_prices منتقل و view شده است
+        self.assertEqual(self._object_type('market_prices'), 'view')
+        self.assertEqual(
+            self._query("SELECT symbol, last_price, asset_type FROM market_prices ORDER BY symbol"),
+            [('زعفران', 20000.0, 'ETF_Equity'), ('فولاد', 1100.0, 'Stock'), ('وبملتح', 300.0, 'Rights')]
+        )
+        # ستون‌های تازه با مقدار پیش‌فرض
+        self.assertEqual(self._query("SELECT priority FROM calendar_events"), [('medium',)])
+        self.assertIn('display_name', [r[1] for r in self._query("PRAGMA table_info(model_configs)")])
+
+        # دفتر نقدینگی و مانده‌ها از روی تاریخچه
+        self.assertEqual(self._query("SELECT current_cash FROM portfolios"), [(1000000 - 100500 + 47800 + 5000,)])
+        self.assertEqual(database.verify_portfolio_cash(), [])
+        self.assertEqual(self._query("SELECT symbol, qty FROM positions"), [('فولاد', 60.0)])
+        [(inscode,)] = self._query("SELECT DISTINCT inscode FROM transactions WHERE transaction_type = 'buy'")
+        self.assertEqual(self._query("SELECT inscode FROM positions"), [(inscode,)])
+
+        self.assertEqual(self._query("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'"), [(0,)])
+
+        # اجرای دوباره: کاری برای انجام نیست
+        migrations._current['done'] = False
+        self.assertEqual(migrations.migrate(), [])
+
+    def test_failed_migration_rolls_back_everything(self):
+        def fail(conn):
+            raise RuntimeError('boom')
+
+        broken = list(migrations.MIGRATIONS)
+        broken[2] = (3, 'broken', fail)
+        with mock.patch.object(migrations, 'MIGRATIONS', broken):
+            with self.assertRaises(RuntimeError):
+                migrations.migrate()
+
+        self.assertEqual(self._query("PRAGMA user_version"), [(0,)])
+        self.assertEqual(self._object_type('market_prices'), 'table')
+        self.assertIsNone(self._object_type('instruments'))
+        self.assertEqual(self._query("SELECT current_cash FROM portfolios"), [(0,)])
+
+if __name__ == "__main__":
+    unittest.main()
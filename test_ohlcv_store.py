@@ -0,0 +1,91 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import database
+import http_client
+import stub_server
+import ohlcv_store
+
+# =========================================================
+# تست دریافت تاریخچه روزانه (ohlcv_store) با سرور استاب به جای TSETMC
+# پاسخ‌ها به همان شکل http_client ضبط می‌شوند و stub_server آن‌ها را بازپخش می‌کند.
+#   python -m unittest test_ohlcv_store
+# =========================================================
+
+TRADED = 111
+EMPTY = 222
+
+def _bar(tarikh, close):
+    return {
+        'dEven': tarikh, 'priceFirst': close - 10, 'priceMax': close + 20, 'priceMin': close - 20,
+        'pClosing': close, 'pDrCotVal': close, 'qTotTran5J': 1000, 'qTotCap': close * 1000, 'zTotTran': 10,
+    }
+
+def _write_capture(directory, url, payload):
+    stub_server.write_capture(directory, url, json.dumps(payload), content_type='application/json')
+
+class DailyBarsStubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = database.DB_PATH
+        database.DB_PATH = os.path.join(self.tmp, 'test.db')
+        database.init_db()
+
+        captures = os.path.join(self.tmp, 'captures')
+        os.makedirs(captures)
+        _write_capture(captures, ohlcv_store.DAILY_BARS_URL.format(inscode=TRADED, days=0), {
+            'closingPriceDaily': [_bar(20240101, 1000), _bar(20240102, 1100), _bar(20240104, 1050)]
+        })
+        _write_capture(captures, ohlcv_store.DAILY_BARS_URL.format(inscode=EMPTY, days=0), {
+            'closingPriceDaily': []
+        })
+        self.server = stub_server.start(captures)
+        http_client.set_stub_url(self.server.url)
+
+    def tearDown(self):
+        http_client.set_stub_url(None)
+        self.server.shutdown()
+        database.release_db_connection()
+        database.DB_PATH = self.db_path
+        shutil.rmtree(self.tmp)
+
+    def _state(self):
+        conn = database.get_db_connection()
+        try:
+            return {r['inscode']: (r['status'], r['last_tarikh'])
+                    for r in conn.execute("SELECT inscode, status, last_tarikh FROM bar_backfill")}
+        finally:
+            conn.close()
+
+    def test_backfill_and_resume(self):
+        stats = ohlcv_store.backfill_daily_bars([TRADED, EMPTY], workers=2)
+        self.assertEqual((stats['done'], stats['failed'], stats['bars']), (2, 0, 3))
+        self.assertEqual(self._state(), {TRADED: ('done', 20240104), EMPTY: ('empty', None)})
+
+        # دور بعد: نماد کامل شده فقط روزهای جدید، نماد خالی اصلا درخواست نمی‌شود
+        conn = database.get_db_connection()
+        try:
+            plan = dict(ohlcv_store._plan_requests(conn, [TRADED, EMPTY]))
+        finally:
+            conn.close()
+        self.assertNotIn(EMPTY, plan)
+        self.assertGreater(plan[TRADED], 0)
+
+        stats = ohlcv_store.backfill_daily_bars([TRADED, EMPTY], workers=2)
+        self.assertEqual((stats['planned'], stats['done'], stats['failed']), (1, 1, 0))
+        self.assertEqual(self.server.stats['missing'], 0)
+
+    def test_close_matrix(self):
+        ohlcv_store.backfill_daily_bars([TRADED, EMPTY], workers=2)
+        dates, inscodes, matrix = ohlcv_store.get_close_matrix([TRADED, EMPTY], start=20240102)
+        self.assertEqual(list(dates), [20240102, 20240104])
+        self.assertEqual(inscodes, [TRADED, EMPTY])
+        self.assertEqual(list(matrix[:, 0]), [1100, 1050])
+        self.assertTrue(all(v != v for v in matrix[:, 1]))   # NaN
+
+if __name__ == "__main__":
+    unittest.main()
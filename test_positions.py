@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import database
+import analysis
+import positions
+
+# =========================================================
+# تست جدول positions: اعمال تدریجی هر تراکنش، تراکنش با تاریخ گذشته (بازسازی همان نماد)
+# و verify_positions در برابر بازپخش کامل تاریخچه
+#   python -m unittest test_positions
+# =========================================================
+
+class ApplyTradeTest(unittest.TestCase):
+
+    def test_weighted_average(self):
+        pos = [0.0, 0.0, 0.0]
+        positions.apply_trade(pos, 'buy', 100, 1000, 50)
+        positions.apply_trade(pos, 'buy', 100, 2000, 50)
+        self.assertEqual(pos, [200.0, 300100.0, 0.0])
+        positions.apply_trade(pos, 'sell', 50, 2500, 25)
+        # سود تحقق یافته: 50 × 2500 - 25 - 50 × میانگین (1500.5)
+        self.assertEqual(pos, [150.0, 225075.0, 49950.0])
+
+    def test_oversell_and_sell_without_position(self):
+        pos = [0.0, 0.0, 0.0]
+        positions.apply_trade(pos, 'sell', 10, 1000, 0)
+        self.assertEqual(pos, [0.0, 0.0, 0.0])
+        positions.apply_trade(pos, 'buy', 10, 1000, 0)
+        positions.apply_trade(pos, 'sell', 30, 1200, 0)
+        self.assertEqual(pos[:2], [0.0, 0.0])
+        self.assertEqual(pos[2], 30 * 1200 - 30 * 1000)
+
+class PositionsTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = database.DB_PATH
+        database.DB_PATH = os.path.join(self.tmp, 'test.db')
+        database.init_db()
+        conn = database.get_db_connection()
+        try:
+            self.pid = conn.execute("INSERT INTO portfolios (name, current_cash) VALUES ('test', 0)").lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+
+    def tearDown(self):
+        database.release_db_connection()
+        database.DB_PATH = self.db_path
+        shutil.rmtree(self.tmp)
+
+    def _trade(self, t_type, qty, price, date, symbol='فولاد'):
+        database.add_new_transaction({
+            'portfolio_id': self.pid, 'type': t_type, 'symbol': symbol, 'quantity': qty, 'price': price,
+            'date': date, 'commission': 0,
+        })
+
+    def _position(self, symbol='فولاد'):
+        conn = database.get_db_connection()
+        try:
+            row = conn.execute(
+                "SELECT qty, cost, realized_pnl, last_trade_date FROM positions WHERE portfolio_id = ? AND symbol = ?",
+                (self.pid, symbol)
+            ).fetchone()
+            return tuple(row) if row else None
+        finally:
+            conn.close()
+
+    def _verify(self):
+        conn = database.get_db_connection()
+        try:
+            return positions.verify_positions(conn)
+        finally:
+            conn.close()
+
+    def test_in_order_trades(self):
+        self._trade('buy', 100, 1000, '2024-01-10')
+        self._trade('sell', 40, 1500, '2024-01-20')
+        self.assertEqual(self._position(), (60.0, 60000.0, 20000.0, '2024-01-20'))
+        self.assertEqual(self._verify(), [])
+
+    def test_back_dated_trade_rebuilds_symbol(self):
+        self._trade('buy', 100, 1000, '2024-01-10')
+        self._trade('sell', 50, 1200, '2024-01-20')
+        # خرید با تاریخ قبل از فروش: میانگین موزون فروش باید با هر دو خرید حساب شود
+        self._trade('buy', 100, 500, '2024-01-05')
+        self.assertEqual(self._position(), (150.0, 112500.0, 50 * 1200 - 50 * 750.0, '2024-01-20'))
+        self.assertEqual(self._verify(), [])
+
+    def test_update_and_delete_refresh_position(self):
+        self._trade('buy', 100, 1000, '2024-01-10')
+        self._trade('buy', 100, 2000, '2024-01-12', symbol='شپنا')
+        conn = database.get_db_connection()
+        try:
+            ids = [r[0] for r in conn.execute("SELECT id FROM transactions ORDER BY id")]
+        finally:
+            conn.close()
+
+        analysis.update_transaction(ids[0], 'buy', 200, 1000, '2024-01-10')
+        self.assertEqual(self._position()[0], 200.0)
+        analysis.delete_transactions(ids)
+        self.assertIsNone(self._position())
+        self.assertIsNone(self._position('شپنا'))
+        self.assertEqual(self._verify(), [])
+
+    def test_verify_detects_and_rebuild_repairs(self):
+        self._trade('buy', 100, 1000, '2024-01-10')
+        conn = database.get_db_connection()
+        try:
+            conn.execute("UPDATE positions SET qty = 90")
+            conn.commit()
+            [(pid, symbol, have, want)] = positions.verify_positions(conn)
+            self.assertEqual((pid, symbol, have[0], want[0]), (self.pid, 'فولاد', 90.0, 100.0))
+
+            positions.rebuild_positions(conn)
+            conn.commit()
+            self.assertEqual(positions.verify_positions(conn), [])
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+import tsetmc_parser
+
+# =========================================================
+# تست پارسر MarketWatchPlus (ردیف کامل، ردیف تغییرات ۱۰ ستونی و بخش بهترین مظنه‌ها)
+# full_row / delta_row / market_watch پاسخ نمونه را به همان شکل TSETMC می‌سازند
+# (در تست poller هم برای ضبط پاسخ‌های stub_server استفاده می‌شوند).
+#   python -m unittest test_tsetmc_parser
+# =========================================================
+
+def full_row(inscode, symbol, last, close=None, heven=90000, yesterday=1000, trades=10, volume=1000,
+             name=None, sector_code=27):
+    close = last if close is None else close
+    cols = [
+        inscode, f'IRO1T{inscode:07d}', symbol, name or f'شرکت {symbol}', heven,
+        yesterday, close, last, trades, volume, volume * close, last - 10, last + 10, yesterday,
+        100, 1000, 0, 0, sector_code, int(yesterday * 1.05), int(yesterday * 0.95), 1000000, 0,
+    ]
+    return ','.join(str(c) for c in cols)
+
+def delta_row(inscode, last, close=None, heven=100000, trades=20, volume=2000):
+    close = last if close is None else close
+    cols = [inscode, heven, last, close, last, trades, volume, volume * close, last - 10, last + 10]
+    return ','.join(str(c) for c in cols)
+
+def limit_row(inscode, level, buy_price, sell_price, buy_volume=500, sell_volume=600):
+    return f"{inscode},{level},4,3,{buy_price},{sell_price},{buy_volume},{sell_volume}"
+
+def market_watch(rows=(), limits=(), refid=0):
+    """پاسخ MarketWatchPlus: وضعیت@اطلاعات بازار@نمادها@بهترین مظنه‌ها@RefID"""
+    return '@'.join(['0', 'market', ';'.join(rows), ';'.join(limits), str(refid)])
+
+class MarketWatchParserTest(unittest.TestCase):
+
+    def test_full_rows(self):
+        content = market_watch([full_row(111, 'فولاد', 1200, 1190), full_row(222, 'شپنا', 5000)])
+        rows = list(tsetmc_parser.iter_market_rows(content))
+        self.assertEqual([r.inscode for r in rows], [111, 222])
+        first = rows[0]
+        self.assertEqual((first.symbol, first.last, first.close, first.sector_code), ('فولاد', 1200.0, 1190.0, 27))
+        self.assertIsInstance(first.isin, str)
+        self.assertIsInstance(first.trades, int)
+
+    def test_persian_text_is_normalized(self):
+        content = market_watch([full_row(111, 'كاوه', 1200, name='فولاد كاوه جنوب كيش')])
+        row = next(tsetmc_parser.iter_market_rows(content))
+        self.assertEqual((row.symbol, row.name), ('کاوه', 'فولاد کاوه جنوب کیش'))
+
+    def test_delta_and_full_rows_are_told_apart(self):
+        content = market_watch([full_row(111, 'فولاد', 1200), delta_row(222, 5100), delta_row(333, 700)])
+
+        errors = {}
+        full = list(tsetmc_parser.iter_market_rows(content, errors=errors))
+        self.assertEqual([r.inscode for r in full], [111])
+        self.assertEqual(errors, {'column_count': 2})
+
+        errors = {}
+        deltas = list(tsetmc_parser.iter_market_rows(
+            content,
+            columns=tsetmc_parser.DELTA_ROW_COLUMNS,
+            min_columns=tsetmc_parser.DELTA_ROW_MIN_COLUMNS,
+            max_columns=tsetmc_parser.DELTA_ROW_MIN_COLUMNS,
+            errors=errors
+        ))
+        self.assertEqual([(r.inscode, r.heven, r.last) for r in deltas], [(222, 100000, 5100.0), (333, 100000, 700.0)])
+        self.assertEqual(errors, {'column_count': 1})
+        self.assertEqual(set(deltas[0]._fields), set(tsetmc_parser.DELTA_ROW_COLUMNS))
+
+    def test_best_limits_section(self):
+        content = market_watch(
+            [full_row(111, 'فولاد', 1200)],
+            [limit_row(111, 1, 1190, 1200), limit_row(111, 2, 1180, 1210, buy_volume=900)]
+        )
+        levels = list(tsetmc_parser.iter_market_rows(
+            content,
+            columns=tsetmc_parser.BEST_LIMIT_COLUMNS,
+            min_columns=tsetmc_parser.BEST_LIMIT_MIN_COLUMNS,
+            section=tsetmc_parser.SECTION_BEST_LIMITS
+        ))
+        self.assertEqual([(l.inscode, l.level) for l in levels], [(111, 1), (111, 2)])
+        self.assertEqual((levels[1].buy_price, levels[1].sell_price, levels[1].buy_volume), (1180.0, 1210.0, 900.0))
+        self.assertEqual((levels[0].sell_count, levels[0].buy_count), (4, 3))
+
+    def test_bad_and_missing_sections(self):
+        content = market_watch([full_row(111, 'فولاد', 1200).replace(',1200,', ',x,', 1), full_row(222, 'شپنا', 5000)])
+        errors = {}
+        rows = list(tsetmc_parser.iter_market_rows(content, errors=errors))
+        self.assertEqual([r.inscode for r in rows], [222])
+        self.assertEqual(errors, {'bad_number': 1})
+
+        errors = {}
+        self.assertEqual(list(tsetmc_parser.iter_market_rows('0@market', errors=errors)), [])
+        self.assertEqual(errors, {'missing_section': 1})
+        self.assertFalse(tsetmc_parser.has_section('0@market', tsetmc_parser.SECTION_INSTRUMENTS))
+
+    def test_refid_and_empty_rows(self):
+        content = market_watch([full_row(111, 'فولاد', 1200), ''], refid=98765)
+        self.assertEqual(tsetmc_parser.get_section(content, tsetmc_parser.SECTION_REFID), '98765')
+        self.assertEqual(len(list(tsetmc_parser.iter_market_rows(content))), 1)
+
+if __name__ == "__main__":
+    unittest.main()
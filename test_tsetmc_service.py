@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import database
+import http_client
+import stub_server
+import tsetmc_service
+from test_tsetmc_parser import full_row, delta_row, limit_row, market_watch
+
+# =========================================================
+# تست دریافت تدریجی دیده‌بان (MarketWatchPoller) با پاسخ‌های بازپخش شده stub_server
+# دور اول کل بازار (h=0&r=0)، دور دوم فقط تغییرات با نشانگرهای h/r همان پاسخ قبلی.
+#   python -m unittest test_tsetmc_service
+# =========================================================
+
+def _capture_all_mirrors(directory, content, h, r):
+    for url in tsetmc_service.MARKET_WATCH_URLS:
+        stub_server.write_capture(directory, url.format(h=h, r=r), content)
+
+class MarketWatchPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = database.DB_PATH
+        database.DB_PATH = os.path.join(self.tmp, 'test.db')
+        database.init_db()
+
+        captures = os.path.join(self.tmp, 'captures')
+        # دور اول: کل بازار
+        _capture_all_mirrors(captures, market_watch(
+            [full_row(111, 'فولاد', 1200, heven=90000), full_row(222, 'شپنا', 5000, heven=91000)],
+            [limit_row(111, 1, 1190, 1200)],
+            refid=500
+        ), h=0, r=0)
+        # دور دوم: ردیف تغییرات فولاد، ردیف کامل نماد تازه و تغییر نمادی که در جدول حافظه نیست
+        _capture_all_mirrors(captures, market_watch(
+            [delta_row(111, 1250, heven=100000), full_row(333, 'خودرو', 300, heven=95000), delta_row(999, 10)],
+            refid=501
+        ), h=91000, r=500)
+        # دور سوم: نشانگرها پذیرفته نشدند (پاسخ بدون بخش نمادها)
+        _capture_all_mirrors(captures, '0@market', h=100000, r=501)
+
+        self.server = stub_server.start(captures)
+        http_client.set_stub_url(self.server.url)
+        self.poller = tsetmc_service.MarketWatchPoller()
+
+    def tearDown(self):
+        http_client.set_stub_url(None)
+        self.server.shutdown()
+        database.release_db_connection()
+        database.DB_PATH = self.db_path
+        shutil.rmtree(self.tmp)
+
+    def _prices(self):
+        conn = database.get_db_connection()
+        try:
+            return {r[0]: r[1] for r in conn.execute("SELECT inscode, last_price FROM instrument_prices")}
+        finally:
+            conn.close()
+
+    def test_full_then_delta_merge(self):
+        stats = self.poller.poll()
+        self.assertEqual((stats['mode'], stats['inserted']), ('full', 2))
+        self.assertEqual((self.poller.heven, self.poller.refid), (91000, 500))
+        self.assertEqual(stats['order_books'], 1)
+
+        stats = self.poller.poll()
+        self.assertEqual(stats['mode'], 'delta')
+        self.assertEqual((stats['inserted'], stats['updated']), (1, 1))
+        self.assertEqual((self.poller.heven, self.poller.refid), (100000, 501))
+
+        # ردیف تغییرات فقط ستون‌های خودش را عوض می‌کند؛ نماد و نام از ردیف کامل قبلی می‌مانند
+        merged = self.poller.table[111]
+        self.assertEqual((merged.symbol, merged.last, merged.close, merged.heven), ('فولاد', 1250.0, 1250.0, 100000))
+        self.assertEqual(merged.sector_code, 27)
+        self.assertNotIn(999, self.poller.table)
+        self.assertEqual(self._prices(), {111: 1250.0, 222: 5000.0, 333: 300.0})
+        self.assertEqual(self.server.stats['missing'], 0)
+
+    def test_rejected_cursor_falls_back_to_full(self):
+        self.poller.poll()
+        self.poller.poll()
+        self.assertIsNone(self.poller.poll())
+        self.assertEqual((self.poller.table, self.poller.heven, self.poller.refid), ({}, 0, 0))
+
+        # دور بعد دوباره کل بازار
+        stats = self.poller.poll()
+        self.assertEqual(stats['mode'], 'full')
+
+if __name__ == "__main__":
+    unittest.main()
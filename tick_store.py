@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import threading
+
+from database import get_db_connection, resolve_inscode
+
+# =========================================================
+# تاریخچه لحظه‌ای قیمت‌ها (Tick Store)
+# هر دور دریافت دیده‌بان، فقط نمادهایی که قیمت/حجمشان تغییر کرده
+# یک ردیف (inscode, ts, last, close, volume) به جدول price_ticks اضافه می‌کنند.
+# داده‌های قدیمی فشرده (یک ردیف در هر بازه) و سپس حذف می‌شوند تا جدول محدود بماند.
+# =========================================================
+
+# ریز داده‌ها تا این تعداد روز کامل نگه داشته می‌شوند
+TICK_RAW_DAYS = int(os.environ.get('KINKO_TICK_RAW_DAYS', 5))
+# پس از آن فقط آخرین ردیف هر بازه (ثانیه) باقی می‌ماند
+TICK_COMPACT_BUCKET = int(os.environ.get('KINKO_TICK_COMPACT_BUCKET', 900))
+# داده‌های قدیمی‌تر از این تعداد روز کلا حذف می‌شوند
+TICK_RETENTION_DAYS = int(os.environ.get('KINKO_TICK_RETENTION_DAYS', 120))
+
+_lock = threading.Lock()
+_last_ticks = None   # inscode -> (last, close, volume) آخرین ردیف ذخیره شده
+
+def _load_last_ticks(conn):
+    """آخرین ردیف هر نماد از یک روز گذشته (برای جلوگیری از ثبت تکراری پس از راه‌اندازی مجدد)"""
+    since = int(time.time()) - 86400
+    rows = conn.execute('''
+        SELECT inscode, MAX(ts), last_price, close_price, volume
+        FROM price_ticks WHERE ts >= ? GROUP BY inscode
+    ''', (since,)).fetchall()
+    return {r[0]: (r[2], r[3], r[4]) for r in rows}
+
+def record_ticks(conn, rows, ts=None):
+    """
+    ثبت ردیف‌های دیده‌بان (هر شیء با inscode, last, close, volume) در price_ticks
+    ردیف‌هایی که نسبت به آخرین ثبت تغییری ندارند نادیده گرفته می‌شوند.
+    خروجی: تعداد ردیف‌های ثبت شده (commit با فراخواننده است؛ پس از rollback باید forget_last_ticks صدا زده شود)
+    """
+    global _last_ticks
+    ts = int(ts if ts is not None else time.time())
+
+    with _lock:
+        if _last_ticks is None:
+            _last_ticks = _load_last_ticks(conn)
+
+        new_ticks = []
+        for row in rows:
+            if row.last <= 0 and row.close <= 0:
+                continue
+            values = (row.last, row.close, row.volume)
+            if _last_ticks.get(row.inscode) == values:
+                continue
+            new_ticks.append((row.inscode, ts) + values)
+
+        if not new_ticks:
+            return 0
+
+        conn.executemany('''
+            INSERT OR REPLACE INTO price_ticks (inscode, ts, last_price, close_price, volume)
+            VALUES (?, ?, ?, ?, ?)
+        ''', new_ticks)
+
+        for inscode, _, last, close, volume in new_ticks:
+            _last_ticks[inscode] = (last, close, volume)
+    return len(new_ticks)
+
+def forget_last_ticks():
+    """کنار گذاشتن آخرین ردیف‌های حافظه (پس از لغو تراکنش)؛ در ثبت بعدی از دیتابیس خوانده می‌شوند"""
+    global _last_ticks
+    with _lock:
+        _last_ticks = None
+
+def _to_ts(value):
+    """پذیرش datetime یا عدد یونیکس"""
+    if hasattr(value, 'timestamp'):
+        return int(value.timestamp())
+    return int(value)
+
+def get_price_series(symbols, start, end, bucket=None):
+    """
+    سری قیمت نمادها بین start و end (datetime یا ثانیه یونیکس)
+    symbols: نماد نمایشی (از طریق instruments به inscode تبدیل می‌شود) یا خود inscode (عدد)
+    bucket: در صورت ارسال (ثانیه)، از هر بازه فقط آخرین ردیف برگردانده می‌شود.
+    خروجی: دیکشنری با همان کلیدهای ورودی -> لیست (ts, last, close, volume) به ترتیب زمان
+    (نماد ناشناخته: لیست خالی)
+    """
+    series = {s: [] for s in symbols}
+    if not series:
+        return series
+
+    conn = get_db_connection()
+    try:
+        keys = {}   # inscode -> کلیدهای ورودی
+        for s in series:
+            inscode = s if isinstance(s, int) else resolve_inscode(conn, s, create=False)
+            if inscode is not None:
+                keys.setdefault(inscode, []).append(s)
+        if keys:
+            for row in conn.execute(*_series_query(list(keys), start, end, bucket)):
+                for s in keys[row[0]]:
+                    series[s].append((row[1], row[2], row[3], row[4]))
+    finally:
+        conn.close()
+    return series
+
+def _series_query(inscodes, start, end, bucket):
+    placeholders = ','.join('?' * len(inscodes))
+    params = inscodes + [_to_ts(start), _to_ts(end)]
+    if bucket:
+        # ستون‌های بدون تابع تجمیعی در کنار MAX از همان ردیف بیشینه خوانده می‌شوند (رفتار SQLite)
+        sql = f'''
+            SELECT inscode, MAX(ts), last_price, close_price, volume FROM price_ticks
+            WHERE inscode IN ({placeholders}) AND ts BETWEEN ? AND ?
+            GROUP BY inscode, ts / ? ORDER BY inscode, 2
+        '''
+        params.append(int(bucket))
+    else:
+        sql = f'''
+            SELECT inscode, ts, last_price, close_price, volume FROM price_ticks
+            WHERE inscode IN ({placeholders}) AND ts BETWEEN ? AND ?
+            ORDER BY inscode, ts
+        '''
+    return sql, params
+
+def compact_ticks(now=None):
+    """
+    فشرده‌سازی: ردیف‌های قدیمی‌تر از TICK_RAW_DAYS به یک ردیف در هر TICK_COMPACT_BUCKET
+    کاهش می‌یابند و ردیف‌های قدیمی‌تر از TICK_RETENTION_DAYS حذف می‌شوند.
+    خروجی: (تعداد فشرده شده، تعداد حذف شده)
+    """
+    now = int(now if now is not None else time.time())
+    raw_cutoff = now - TICK_RAW_DAYS * 86400
+    retention_cutoff = now - TICK_RETENTION_DAYS * 86400
+
+    conn = get_db_connection()
+    try:
+        cur = conn.execute('''
+            DELETE FROM price_ticks
+            WHERE ts < ? AND EXISTS (
+                SELECT 1 FROM price_ticks AS later
+                WHERE later.inscode = price_ticks.inscode
+                  AND later.ts > price_ticks.ts
+                  AND later.ts < (price_ticks.ts / ? + 1) * ?
+            )
+        ''', (raw_cutoff, TICK_COMPACT_BUCKET, TICK_COMPACT_BUCKET))
+        compacted = cur.rowcount
+        cur = conn.execute("DELETE FROM price_ticks WHERE ts < ?", (retention_cutoff,))
+        removed = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return compacted, removed
+
+if __name__ == "__main__":
+    if '--compact' in sys.argv:
+        compacted, removed = compact_ticks()
+        print(f"Compacted {compacted} ticks, removed {removed} expired ticks.")
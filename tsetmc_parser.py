@@ -0,0 +1,169 @@
+from collections import namedtuple
+from database import normalize_text
+
+# =========================================================
+# پارسر جریانی (Streaming) پاسخ MarketWatchPlus
+# بخش‌ها با @، ردیف‌ها با ; و ستون‌ها با , جدا می‌شوند.
+# به جای split کل متن، مرز بخش/ردیف/ستون با find پیدا می‌شود
+# و فقط ستون‌های لازم از متن برداشته می‌شوند.
+# =========================================================
+
+SECTION_SEPARATOR = '@'
+ROW_SEPARATOR = ';'
+COLUMN_SEPARATOR = ','
+
+# شماره بخش‌ها در پاسخ MarketWatchPlus
+SECTION_INSTRUMENTS = 2
+SECTION_BEST_LIMITS = 3
+SECTION_REFID = 4
+
+# ستون‌های ردیف کامل دیده‌بان (حداقل ۲۳ ستون)
+FULL_ROW_COLUMNS = {
+    'inscode': 0,
+    'isin': 1,
+    'symbol': 2,
+    'name': 3,
+    'heven': 4,
+    'first': 5,
+    'close': 6,
+    'last': 7,
+    'trades': 8,
+    'volume': 9,
+    'value': 10,
+    'low': 11,
+    'high': 12,
+    'yesterday': 13,
+    'eps': 14,
+    'base_volume': 15,
+    'sector_code': 18,
+    'upper_limit': 19,
+    'lower_limit': 20,
+    'shares': 21,
+}
+FULL_ROW_MIN_COLUMNS = 23
+
+# ستون‌های ردیف تغییرات (پاسخ h/r غیر صفر)
+DELTA_ROW_COLUMNS = {
+    'inscode': 0,
+    'heven': 1,
+    'first': 2,
+    'close': 3,
+    'last': 4,
+    'trades': 5,
+    'volume': 6,
+    'value': 7,
+    'low': 8,
+    'high': 9,
+}
+DELTA_ROW_MIN_COLUMNS = 10
+
+# ستون‌های بخش بهترین مظنه‌ها (Best Limits)؛ هر ردیف یک سطح از صف خرید/فروش یک نماد
+BEST_LIMIT_COLUMNS = {
+    'inscode': 0,
+    'level': 1,
+    'sell_count': 2,
+    'buy_count': 3,
+    'buy_price': 4,
+    'sell_price': 5,
+    'buy_volume': 6,
+    'sell_volume': 7,
+}
+BEST_LIMIT_MIN_COLUMNS = 8
+
+# نوع داده هر ستون؛ ستون‌های ذکر نشده عدد اعشاری هستند
+TEXT_FIELDS = {'isin'}
+PERSIAN_TEXT_FIELDS = {'symbol', 'name'}
+INT_FIELDS = {'inscode', 'heven', 'trades', 'sector_code', 'level', 'sell_count', 'buy_count'}
+
+_row_types = {}
+
+def get_row_type(columns):
+    """ساخت (و کش) نوع رکورد namedtuple برای یک نقشه ستون"""
+    key = tuple(columns)
+    row_type = _row_types.get(key)
+    if row_type is None:
+        row_type = namedtuple('MarketRow', key)
+        _row_types[key] = row_type
+    return row_type
+
+def has_section(content, index):
+    """آیا پاسخ حداقل index+1 بخش دارد"""
+    return _section_bounds(content, index)[0] is not None
+
+def get_section(content, index):
+    """برگرداندن متن یک بخش (مناسب بخش‌های کوچک مثل RefID)"""
+    start, end = _section_bounds(content, index)
+    if start is None:
+        return None
+    return content[start:end]
+
+def _section_bounds(content, index):
+    start = 0
+    for _ in range(index):
+        pos = content.find(SECTION_SEPARATOR, start)
+        if pos < 0:
+            return None, None
+        start = pos + 1
+    end = content.find(SECTION_SEPARATOR, start)
+    if end < 0:
+        end = len(content)
+    return start, end
+
+def _convert(field, raw):
+    if field in PERSIAN_TEXT_FIELDS:
+        return normalize_text(raw)
+    if field in TEXT_FIELDS:
+        return raw
+    if field in INT_FIELDS:
+        return int(raw)
+    return float(raw)
+
+def iter_market_rows(content, columns=FULL_ROW_COLUMNS, min_columns=FULL_ROW_MIN_COLUMNS,
+                     max_columns=None, section=SECTION_INSTRUMENTS, errors=None):
+    """
+    پیمایش تدریجی ردیف‌های یک بخش و تولید رکوردهای تایپ‌دار
+    ردیف‌های کوتاه/بلند یا دارای عدد نامعتبر رد می‌شوند و در صورت ارسال errors
+    (دیکشنری/Counter) دلیل آن شمرده می‌شود.
+    """
+    start, end = _section_bounds(content, section)
+    if start is None:
+        if errors is not None:
+            errors['missing_section'] = errors.get('missing_section', 0) + 1
+        return
+
+    row_type = get_row_type(columns)
+    fields = list(columns)
+    wanted = sorted(columns.values())
+    last_wanted = wanted[-1]
+    positions = {idx: field for field, idx in columns.items()}
+
+    pos = start
+    while pos < end:
+        row_end = content.find(ROW_SEPARATOR, pos, end)
+        if row_end < 0:
+            row_end = end
+
+        if row_end > pos:
+            col_count = content.count(COLUMN_SEPARATOR, pos, row_end) + 1
+            if col_count < min_columns or (max_columns and col_count > max_columns):
+                if errors is not None:
+                    errors['column_count'] = errors.get('column_count', 0) + 1
+            else:
+                values = {}
+                col_start = pos
+                try:
+                    for col_index in range(last_wanted + 1):
+                        col_end = content.find(COLUMN_SEPARATOR, col_start, row_end)
+                        if col_end < 0:
+                            col_end = row_end
+                        field = positions.get(col_index)
+                        if field is not None:
+                            values[field] = _convert(field, content[col_start:col_end])
+                        col_start = col_end + 1
+                except ValueError:
+                    if errors is not None:
+                        errors['bad_number'] = errors.get('bad_number', 0) + 1
+                else:
+                    yield row_type(*(values[f] for f in fields))
+
+        pos = row_end + 1
@@ -1,21 +1,33 @@
-import requests
+import os
 import sqlite3
 import urllib3
 import re
 import time
+import threading
 import sys
 import jdatetime
-from datetime import datetime
-from database import DB_NAME, set_market_index, get_db_connection
+from datetime import datetime, timedelta
+from database import (DB_NAME, set_market_index, get_db_connection, get_stored_market_index,
+                      sync_instruments, rekey_synthetic_instruments, release_db_connection,
+                      bump_data_versions)
+import tsetmc_parser
+import http_client
+import asset_classifier
+import tick_store
+import market_breadth
+import order_book
+from refresh_metrics import RefreshRun, stage
 
 # غیرفعال کردن اخطار امنیتی SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # لیست آدرس‌های دیتای بورس
-URLS = [
-    "http://old.tsetmc.com/tsev2/data/MarketWatchPlus.aspx?h=0&r=0",
-    "http://members.tsetmc.com/tsev2/data/MarketWatchPlus.aspx?h=0&r=0"
+# پارامترهای h (HEven آخرین تغییر) و r (RefID) نشانگر دریافت تغییرات هستند؛ h=0&r=0 یعنی کل بازار
+MARKET_WATCH_URLS = [
+    "http://old.tsetmc.com/tsev2/data/MarketWatchPlus.aspx?h={h}&r={r}",
+    "http://members.tsetmc.com/tsev2/data/MarketWatchPlus.aspx?h={h}&r={r}"
 ]
+URLS = [u.format(h=0, r=0) for u in MARKET_WATCH_URLS]
 
 # هدرهای قوی برای شبیه‌سازی مرورگر واقعی
 GLOBAL_HEADERS = {
@@ -31,8 +43,7 @@ def log_debug(message):
     """چاپ پیام در لاگ‌های سرور (Standard Error)"""
     timestamp = datetime.now().strftime("%H:%M:%S")
     log_msg = f"[TSETMC {timestamp}] {message}"
-    print(log_msg, file=sys.stderr) # برای دیده شدن در لاگ‌های PythonAnywhere
-    print(log_msg)
+    print(log_msg, file=sys.stderr, flush=True) # برای دیده شدن در لاگ‌های PythonAnywhere
 
 def fix_persian_chars(text):
     if not text: return ""
@@ -40,136 +51,359 @@ def fix_persian_chars(text):
     return text.replace('ك', 'ک').replace('ي', 'ی').replace('ى', 'ی').strip()
 
 def get_asset_details(symbol, name):
-    """تشخیص نوع دارایی و بازار"""
-    symbol = fix_persian_chars(symbol)
-    name = fix_persian_chars(name)
-    asset_type = 'Stock'
-    market_type = 'TSE'
-    
-    if 'صندوق' in name or 'ETF' in name:
-        market_type = 'ETF' # نرخ ثابت
-        if any(x in name for x in ['طلا', 'زر', 'نابی', 'گنج', 'عیار', 'کهربا', 'آلتون', 'نفیس']):
-            asset_type = 'ETF_Gold'
-        elif any(x in name for x in ['درآمد ثابت', 'اعتماد', 'آفاق', 'تصمیم', 'کارا', 'افران', 'یاقوت']):
-            asset_type = 'ETF_Fixed'
-        else:
-            asset_type = 'ETF_Equity'
-            
-    elif symbol.startswith('اخزا') or symbol.startswith('اراد') or symbol.startswith('گام'):
-        asset_type = 'Bond'
-        market_type = 'IFB'
-    elif symbol.startswith('تسه') or symbol.startswith('تملی'):
-        asset_type = 'Housing'
-        market_type = 'IFB'
-    
-    return asset_type, market_type
-
-def fetch_market_data():
-    """دریافت قیمت‌ها و بروزرسانی دیتابیس"""
+    """تشخیص نوع دارایی (مقدار استاندارد) و بازار"""
+    return asset_classifier.classify(symbol, name)
+
+def _parse_market_watch(response):
+    """پاسخ معتبر MarketWatchPlus: وضعیت 200 و داشتن بخش نمادها"""
+    if response.status_code != 200:
+        log_debug(f"Failed with status: {response.status_code} ({response.url})")
+        return None
+    content = response.text
+    if not tsetmc_parser.has_section(content, tsetmc_parser.SECTION_INSTRUMENTS):
+        return None
+    return content
+
+def download_market_watch(h=0, r=0):
+    """
+    دریافت متن خام MarketWatchPlus (h و r برای حالت تغییرات)
+    آینه‌ها به صورت Hedged درخواست می‌شوند: اگر آینه اول تا HEDGE_DELAY جواب نداد
+    آینه دوم هم درخواست می‌شود و اولین پاسخ معتبر برنده است.
+    """
+    candidates = [(u.format(h=h, r=r), _parse_market_watch) for u in MARKET_WATCH_URLS]
+    content, winner = http_client.hedged_fetch(
+        'market_watch', candidates, headers=GLOBAL_HEADERS, timeout=20, verify=False
+    )
+    if content:
+        log_debug(f"Connection Successful: {winner}")
+    return content
+
+def fetch_market_data(run=None):
+    """
+    دریافت قیمت‌ها و بروزرسانی دیتابیس
+    run: آمار مراحل (RefreshRun)؛ اگر ارسال نشود ساخته و در پایان در refresh_runs ذخیره می‌شود
+    """
+    own_run = run is None
+    if own_run:
+        run = RefreshRun('full')
+    ok, message = _fetch_market_data(run)
+    if own_run:
+        run.save(ok, message)
+    return ok, message
+
+def _fetch_market_data(run):
     log_debug("--- Starting Market Data Update ---")
-    content = None
-    
-    for url in URLS:
-        try:
-            log_debug(f"Connecting to: {url}")
-            response = requests.get(url, headers=GLOBAL_HEADERS, timeout=20, verify=False)
-            
-            if response.status_code == 200:
-                content = response.text
-                log_debug("Connection Successful.")
-                break
-            else:
-                log_debug(f"Failed with status: {response.status_code}")
-        except Exception as e:
-            log_debug(f"Connection Error: {e}")
-            continue
+    with run.stage('network'):
+        content = download_market_watch()
 
     if not content:
         log_debug("All URLs failed to return data.")
+        run.error('network')
         return False, "خطای اتصال به سرور بورس"
+    run.count('bytes', len(content.encode('utf-8')))
 
     try:
-        parts = content.split('@')
-        if len(parts) < 3:
+        if not tsetmc_parser.has_section(content, tsetmc_parser.SECTION_INSTRUMENTS):
+            run.error('invalid_payload')
             return False, "فرمت دیتای دریافتی نامعتبر است."
-            
-        raw_data = parts[2]
-        rows = raw_data.split(';')
-        
+
+        with run.stage('parse'):
+            rows = list(tsetmc_parser.iter_market_rows(content, errors=run.errors))
+        run.count('rows', len(rows))
+
         conn = get_db_connection()
-        c = conn.cursor()
-        
-        updated_count = 0
-        
-        for row in rows:
-            cols = row.split(',')
-            if len(cols) > 22:
-                try:
-                    raw_symbol = cols[2]
-                    raw_name = cols[3]
-                    symbol = fix_persian_chars(raw_symbol)
-                    name = fix_persian_chars(raw_name)
-                    
-                    close_price = float(cols[6])
-                    last_trade = float(cols[7])
-                    final_price = close_price if close_price > 0 else last_trade
-                    
-                    if final_price > 0:
-                        asset_type, market_type = get_asset_details(symbol, name)
-                        
-                        # استفاده از REPLACE برای کدنویسی تمیزتر
-                        c.execute('''
-                            INSERT OR REPLACE INTO market_prices 
-                            (symbol, company_name, sector, asset_type, market_type, last_price, close_price_yesterday, updated_at)
-                            VALUES (?, ?, 'بازار بورس', ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                        ''', (symbol, name, asset_type, market_type, final_price, final_price))
-                        
-                        updated_count += 1
-                except:
-                    continue
+        try:
+            stats = store_market_rows(conn, rows, content=content, full=True, run=run)
+        finally:
+            conn.close()
 
-        conn.commit()
-        conn.close()
-        log_debug(f"Database updated: {updated_count} symbols.")
+        log_debug(
+            f"Database updated: {stats['inserted']} inserted, {stats['updated']} updated, "
+            f"{stats['unchanged']} unchanged in {stats['elapsed']:.2f}s"
+        )
         
         # پس از قیمت‌ها، شاخص را هم آپدیت می‌کنیم
-        get_market_index()
+        with run.stage('index'):
+            get_market_index()
         
-        return True, f"بروزرسانی موفق: {updated_count} نماد"
+        changed_count = stats['inserted'] + stats['updated']
+        return True, f"بروزرسانی موفق: {changed_count} نماد تغییر کرد ({stats['unchanged']} بدون تغییر)"
 
     except Exception as e:
         log_debug(f"Processing Error: {e}")
+        run.error(type(e).__name__)
         return False, f"خطا در پردازش: {str(e)}"
 
-def get_market_index():
-    """دریافت شاخص کل (لحظه‌ای)"""
-    log_debug(">>> Fetching Current Total Index...")
-    index_val = None
-
-    # روش 1: API
+def store_market_rows(conn, rows, market=None, content=None, full=False, run=None):
+    """
+    ذخیره ردیف‌های دیده‌بان: فهرست نمادها (instruments، طبقه‌بندی فقط برای نمادهای جدید)،
+    قیمت‌ها (instrument_prices)، جایگزینی کدهای موقت، تاریخچه لحظه‌ای، آمار کلی بازار و دفتر سفارش‌ها
+    همه در یک تراکنش (BEGIN IMMEDIATE ... COMMIT)؛ خطا در هر مرحله کل دور را لغو می‌کند.
+    market: کل ردیف‌های بازار برای آمار کلی (پیش‌فرض همان rows)
+    content: پاسخ خام برای بخش بهترین مظنه‌ها (اختیاری)؛ full: پاسخ کامل (غیر تدریجی)
+    run: آمار مراحل (RefreshRun، اختیاری)
+    خروجی: آمار upsert_market_batch به‌علاوه ticks، breadth و order_books
+    """
+    rows = list(rows)
+    classify = run.timed(get_asset_details, 'classify') if run is not None else get_asset_details
+    rekeyed = 0
     try:
-        url_api = "http://cdn.tsetmc.com/api/MarketData/GetMarketOverview/1"
-        resp = requests.get(url_api, headers=GLOBAL_HEADERS, timeout=10, verify=False)
-        if resp.status_code == 200:
-            data = resp.json()
-            if 'marketOverview' in data and 'indexLastValue' in data['marketOverview']:
-                index_val = float(data['marketOverview']['indexLastValue'])
-                log_debug(f"API Success: {index_val}")
-    except Exception as e:
-        log_debug(f"API Failed: {e}")
+        conn.execute("BEGIN IMMEDIATE")
+        with stage(run, 'db_write'):
+            instruments_changed = sync_instruments(conn, rows, classify=classify)
+
+        with stage(run, 'batch'):
+            batch = _batch_from_rows(rows)
+        stats = upsert_market_batch(conn, batch, run=run)
+
+        if instruments_changed:
+            with stage(run, 'db_write'):
+                rekeyed = rekey_synthetic_instruments(conn)
+                # طبقه‌بندی دستی بر تشخیص خودکار نمادهای تازه ثبت شده اولویت دارد
+                asset_classifier.apply_overrides(conn)
 
-    # روش 2: HTML Scraping
-    if not index_val:
+        with stage(run, 'ticks'):
+            stats['ticks'] = tick_store.record_ticks(conn, rows)
+        with stage(run, 'breadth'):
+            stats['breadth'] = market_breadth.record_breadth(conn, rows if market is None else market)
+        if content is not None:
+            with stage(run, 'order_book'):
+                stats['order_books'] = order_book.ingest_best_limits(conn, content, full=full)
+        with stage(run, 'commit'):
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        tick_store.forget_last_ticks()
+        raise
+
+    if rekeyed:
+        log_debug(f"Re-keyed {rekeyed} provisional instruments")
+    if run is not None:
+        run.count('instruments_changed', instruments_changed)
+        for key in ('inserted', 'updated', 'unchanged', 'ticks'):
+            run.count(key, stats[key])
+    return stats
+
+def parse_market_batch(content):
+    """
+    تبدیل بخش نمادهای MarketWatchPlus به یک دسته (batch) آماده برای ذخیره
+    خروجی: دیکشنری inscode -> final_price
+    """
+    return _batch_from_rows(tsetmc_parser.iter_market_rows(content))
+
+def _batch_from_rows(rows):
+    batch = {}
+    for row in rows:
+        final_price = row.close if row.close > 0 else row.last
+        if final_price > 0 and row.symbol:
+            batch[row.inscode] = final_price
+    return batch
+
+def upsert_market_batch(conn, batch, run=None):
+    """
+    ذخیره یک دسته قیمت در instrument_prices فقط برای ردیف‌های تغییر کرده
+    دسته با قیمت‌های فعلی دیتابیس مقایسه می‌شود و همه تغییرات با یک executemany
+    نوشته می‌شوند (commit با فراخواننده است؛ store_market_rows کل دور را یک‌جا commit می‌کند).
+    """
+    started = time.perf_counter()
+
+    current = {
+        r[0]: (r[1], r[2]) for r in conn.execute(
+            "SELECT inscode, last_price, close_price_yesterday FROM instrument_prices"
+        )
+    }
+
+    changes = []
+    inserted = 0
+    unchanged = 0
+
+    for inscode, price in batch.items():
+        row = current.get(inscode)
+        if row is None:
+            inserted += 1
+        elif row == (price, price):
+            unchanged += 1
+            continue
+        changes.append((inscode, price, price))
+
+    if changes:
+        with stage(run, 'db_write'):
+            conn.executemany('''
+                INSERT INTO instrument_prices (inscode, last_price, close_price_yesterday, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(inscode) DO UPDATE SET
+                    last_price = excluded.last_price,
+                    close_price_yesterday = excluded.close_price_yesterday,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', changes)
+            bump_data_versions(conn, 'prices')
+
+    return {
+        'inserted': inserted,
+        'updated': len(changes) - inserted,
+        'unchanged': unchanged,
+        'elapsed': time.perf_counter() - started
+    }
+
+class MarketWatchPoller:
+    """
+    دریافت تدریجی (Delta) دیده‌بان بازار با نگهداری نشانگرهای h/r
+    اولین فراخوانی کل بازار را می‌گیرد، فراخوانی‌های بعدی فقط نمادهای تغییر کرده را
+    در جدول حافظه ادغام می‌کنند و همان‌ها را در دیتابیس ذخیره می‌کنند.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.heven = 0
+        self.refid = 0
+        self.table = {}  # inscode -> MarketRow
+        self.day = None
+
+    def poll(self, run=None):
+        """
+        یک دور دریافت و ذخیره؛ خروجی مشابه upsert_market_batch به‌علاوه حالت (full/delta)
+        run: آمار مراحل (RefreshRun)؛ اگر ارسال نشود ساخته و در پایان در refresh_runs ذخیره می‌شود
+        """
+        own_run = run is None
+        if own_run:
+            run = RefreshRun('delta')
         try:
-            url_html = "http://old.tsetmc.com/Loader.aspx?ParTree=15"
-            resp = requests.get(url_html, headers=GLOBAL_HEADERS, timeout=15, verify=False)
-            if resp.status_code == 200:
-                match = re.search(r'شاخص کل.*?<div[^>]*>([\d,]+)</div>', resp.text, re.DOTALL)
-                if match:
-                    index_val = float(match.group(1).replace(',', ''))
-                    log_debug(f"HTML Success: {index_val}")
+            stats = self._poll(run)
         except Exception as e:
-            log_debug(f"HTML Failed: {e}")
+            run.error(type(e).__name__)
+            if own_run:
+                run.save(False, str(e))
+            raise
+        if own_run:
+            run.save(stats is not None, stats and stats['mode'])
+        return stats
+
+    def _poll(self, run):
+        today = datetime.now().date()
+        if self.day != today:
+            # نشانگرها فقط در طول یک روز معاملاتی معتبرند
+            self.reset()
+            self.day = today
+
+        mode = 'delta' if self.table else 'full'
+        with run.stage('network'):
+            content = download_market_watch(self.heven, self.refid)
+        # download_market_watch پاسخ بدون بخش نمادها را هم None برمی‌گرداند؛ در حالت تغییرات
+        # ممکن است نشانگرها دیگر پذیرفته نشوند، پس دور بعد کل بازار گرفته می‌شود
+        if not content or not tsetmc_parser.has_section(content, tsetmc_parser.SECTION_INSTRUMENTS):
+            run.error('network' if not content else 'invalid_payload')
+            if mode == 'delta':
+                log_debug("Delta response rejected, falling back to full snapshot.")
+                run.error('delta_rejected')
+                self.reset()
+                self.day = today
+            return None
+        run.count('bytes', len(content.encode('utf-8')))
+
+        with run.stage('parse'):
+            changed = self._merge_rows(content, errors=run.errors)
+        run.count('rows', len(changed))
+        refid = (tsetmc_parser.get_section(content, tsetmc_parser.SECTION_REFID) or '').strip()
+        if refid.isdigit():
+            self.refid = int(refid)
+
+        conn = get_db_connection()
+        try:
+            if not changed:
+                # فقط صف‌ها ممکن است تغییر کرده باشند
+                with run.stage('order_book'):
+                    conn.execute("BEGIN IMMEDIATE")
+                    books = order_book.ingest_best_limits(conn, content, full=(mode == 'full'))
+                    conn.commit()
+                return {'mode': mode, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'elapsed': 0.0, 'ticks': 0,
+                        'order_books': books}
+            stats = store_market_rows(
+                conn, (self.table[inscode] for inscode in changed), market=self.table.values(),
+                content=content, full=(mode == 'full'), run=run
+            )
+        finally:
+            conn.close()
+        stats['mode'] = mode
+        log_debug(f"Poll ({mode}): {len(changed)} changed instruments, h={self.heven} r={self.refid}")
+        return stats
+
+    def _merge_rows(self, content, errors=None):
+        """
+        ادغام ردیف‌های کامل و ردیف‌های تغییرات در جدول حافظه؛ خروجی: inscode های تغییر کرده
+        errors: شمارنده ردیف‌های رد شده به تفکیک دلیل (اختیاری)
+        """
+        changed = set()
+        # در پاسخ ترکیبی، ردیف‌های کامل و تغییرات ستون‌های متفاوتی دارند و هر پیمایش
+        # ردیف‌های نوع دیگر را با دلیل column_count رد می‌کند؛ این دلیل شمرده نمی‌شود.
+        skipped = {}
+
+        for row in tsetmc_parser.iter_market_rows(content, errors=skipped):
+            if self.table.get(row.inscode) != row:
+                self.table[row.inscode] = row
+                changed.add(row.inscode)
+            self.heven = max(self.heven, row.heven)
+
+        delta_rows = tsetmc_parser.iter_market_rows(
+            content,
+            columns=tsetmc_parser.DELTA_ROW_COLUMNS,
+            min_columns=tsetmc_parser.DELTA_ROW_MIN_COLUMNS,
+            max_columns=tsetmc_parser.DELTA_ROW_MIN_COLUMNS,
+            errors=skipped
+        )
+        for delta in delta_rows:
+            current = self.table.get(delta.inscode)
+            if current is None:
+                continue
+            merged = current._replace(**delta._asdict())
+            if merged != current:
+                self.table[delta.inscode] = merged
+                changed.add(delta.inscode)
+            self.heven = max(self.heven, delta.heven)
+
+        if errors is not None:
+            for reason, value in skipped.items():
+                if reason != 'column_count':
+                    errors[reason] = errors.get(reason, 0) + value
+        return changed
+
+_market_poller = MarketWatchPoller()
+
+def poll_market_delta(run=None):
+    """دریافت تدریجی با نمونه مشترک poller (برای اجرای دوره‌ای در یک پروسه ماندگار)"""
+    return _market_poller.poll(run)
+
+def _parse_index_api(response):
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    if 'marketOverview' in data and 'indexLastValue' in data['marketOverview']:
+        return float(data['marketOverview']['indexLastValue']) or None
+    return None
+
+def _parse_index_html(response):
+    if response.status_code != 200:
+        return None
+    match = re.search(r'شاخص کل.*?<div[^>]*>([\d,]+)</div>', response.text, re.DOTALL)
+    if match:
+        return float(match.group(1).replace(',', '')) or None
+    return None
+
+def get_market_index():
+    """دریافت شاخص کل (لحظه‌ای)"""
+    log_debug(">>> Fetching Current Total Index...")
+
+    # روش 1: API و روش 2: HTML Scraping به صورت Hedged (منبع برنده دفعه بعد اول امتحان می‌شود)
+    candidates = [
+        ("http://cdn.tsetmc.com/api/MarketData/GetMarketOverview/1", _parse_index_api),
+        ("http://old.tsetmc.com/Loader.aspx?ParTree=15", _parse_index_html),
+    ]
+    index_val, winner = http_client.hedged_fetch(
+        'market_index', candidates, headers=GLOBAL_HEADERS, timeout=15, verify=False
+    )
+    if index_val:
+        log_debug(f"Index Success: {index_val} ({winner})")
 
     # ذخیره در دیتابیس
     if index_val:
@@ -183,9 +417,136 @@ def get_market_index():
 
     return index_val
 
+# شاخص ذخیره شده قدیمی‌تر از این مدت (دقیقه) کهنه محسوب می‌شود
+INDEX_MAX_AGE_MINUTES = 30
+
+_index_refresh_lock = threading.Lock()
+_index_refreshing = False
+
+def _refresh_index_in_background():
+    global _index_refreshing
+    try:
+        get_market_index()
+    finally:
+        release_db_connection()
+        with _index_refresh_lock:
+            _index_refreshing = False
+
+def get_cached_market_index():
+    """
+    شاخص کل برای ارزش‌گذاری، فقط از دیتابیس (بدون انتظار برای شبکه)
+    خروجی: (مقدار یا 0، وضعیت: fresh / stale / unknown)
+    اگر شاخص کهنه یا نامشخص باشد، یک بروزرسانی پس‌زمینه (فقط یکی در هر لحظه) شروع می‌شود.
+    """
+    global _index_refreshing
+    value, updated_at = get_stored_market_index()
+
+    status = 'unknown'
+    if value:
+        status = 'stale'
+        try:
+            age = datetime.utcnow() - datetime.strptime(str(updated_at), '%Y-%m-%d %H:%M:%S')
+            if age <= timedelta(minutes=INDEX_MAX_AGE_MINUTES):
+                status = 'fresh'
+        except ValueError:
+            pass
+
+    if status != 'fresh':
+        with _index_refresh_lock:
+            start = not _index_refreshing
+            _index_refreshing = True
+        if start:
+            threading.Thread(target=_refresh_index_in_background, daemon=True).start()
+
+    return value or 0, status
+
+# آدرس پایه API جدید TSETMC (قابل تغییر برای سرور آزمایشی محلی)
+CDN_BASE_URL = os.environ.get('KINKO_TSETMC_CDN', 'http://cdn.tsetmc.com').rstrip('/')
+
+INDEX_HISTORY_URL = CDN_BASE_URL + "/api/MarketData/GetOverallIndexHistory/{days}"
+INDEX_HISTORY_BACKFILL_DAYS = 600
+# حداکثر فاصله مجاز تا نزدیک‌ترین روز معاملاتی قبلی (تعطیلات)
+INDEX_HISTORY_MAX_GAP_DAYS = 6
+# فاصله تلاش دوباره برای تاریخی که هنوز داده ندارد (امروز پیش از پایان بازار، تعطیلات)
+INDEX_HISTORY_RETRY_SECONDS = int(os.environ.get('KINKO_INDEX_HISTORY_RETRY', 1800))
+
+_history_attempts = {}     # تاریخ هدف (YYYYMMDD) -> زمان آخرین تلاش دریافت
+_history_attempts_lock = threading.Lock()
+
+def _history_refresh_due(target_int_date):
+    """آیا برای این تاریخ (جدیدتر از آخرین روز ذخیره شده) باید دوباره از شبکه دریافت شود"""
+    today = int(datetime.now().strftime('%Y%m%d'))
+    if target_int_date > today:
+        # تاریخ آینده هیچ‌وقت در پاسخ نیست
+        return False
+    now = time.time()
+    with _history_attempts_lock:
+        last = _history_attempts.get(target_int_date)
+        if last is not None and now - last < INDEX_HISTORY_RETRY_SECONDS:
+            return False
+        for day in [d for d, t in _history_attempts.items() if now - t >= INDEX_HISTORY_RETRY_SECONDS]:
+            del _history_attempts[day]
+        _history_attempts[target_int_date] = now
+    return True
+
+def refresh_index_history(conn=None):
+    """
+    بروزرسانی جدول index_history؛ بار اول ۶۰۰ روز (backfill) و پس از آن فقط
+    روزهای بعد از آخرین تاریخ ذخیره شده درخواست می‌شود.
+    خروجی: تعداد ردیف‌های ذخیره شده (یا None در صورت خطا)
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT MAX(tarikh) AS last_day FROM index_history").fetchone()
+        last_day = row['last_day'] if row else None
+
+        if last_day:
+            last_date = datetime.strptime(str(last_day), '%Y%m%d').date()
+            gap = (datetime.now().date() - last_date).days
+            if gap <= 0:
+                return 0
+            # تعداد روزهای معاملاتی کمتر از روزهای تقویمی است؛ چند روز اضافه برای اطمینان
+            days = min(INDEX_HISTORY_BACKFILL_DAYS, gap + 5)
+        else:
+            days = INDEX_HISTORY_BACKFILL_DAYS
+
+        # هدر Referer برای عبور از برخی فایروال‌ها
+        headers = GLOBAL_HEADERS.copy()
+        headers['Referer'] = 'http://cdn.tsetmc.com'
+
+        resp = http_client.get(INDEX_HISTORY_URL.format(days=days), headers=headers, timeout=15, verify=False)
+        if resp.status_code != 200:
+            log_debug(f"History API status: {resp.status_code}")
+            return None
+
+        history = resp.json().get('marketOverviewHistory') or []
+        rows = [
+            (int(day['tarikh']), float(day['indexLastValue']))
+            for day in history
+            if day.get('tarikh') and day.get('indexLastValue')
+        ]
+        conn.executemany(
+            "INSERT OR REPLACE INTO index_history (tarikh, index_value) VALUES (?, ?)", rows
+        )
+        conn.commit()
+        log_debug(f"Index history stored: {len(rows)} days (requested {days})")
+        return len(rows)
+
+    except Exception as e:
+        log_debug(f"History Fetch Error: {e}")
+        return None
+    finally:
+        if own_conn:
+            conn.close()
+
 def get_index_history_by_date(jalali_date_str):
     """
-    دریافت شاخص کل تاریخی برای یک روز خاص
+    دریافت شاخص کل تاریخی برای یک روز خاص از جدول index_history
+    (نزدیک‌ترین روز معاملاتی در همان روز یا قبل از آن)
+    شبکه فقط وقتی استفاده می‌شود که تاریخ خواسته شده از آخرین تاریخ ذخیره شده جدیدتر باشد،
+    و برای هر تاریخ حداکثر یک بار در هر INDEX_HISTORY_RETRY_SECONDS (پاسخ خالی تعطیلات یا امروز).
     ورودی: 1402/05/10
     """
     log_debug(f"Fetching History for: {jalali_date_str}")
@@ -195,39 +556,33 @@ def get_index_history_by_date(jalali_date_str):
         jy, jm, jd = map(int, j_date_str.split('-'))
         g_date = jdatetime.date(jy, jm, jd).togregorian()
         target_int_date = int(g_date.strftime('%Y%m%d'))
-        
-        url = "http://cdn.tsetmc.com/api/MarketData/GetOverallIndexHistory/600"
-        
-        # هدر Referer برای عبور از برخی فایروال‌ها
-        headers = GLOBAL_HEADERS.copy()
-        headers['Referer'] = 'http://cdn.tsetmc.com'
+        floor_int_date = int((g_date - timedelta(days=INDEX_HISTORY_MAX_GAP_DAYS)).strftime('%Y%m%d'))
+    except Exception as e:
+        log_debug(f"History Date Error: {e}")
+        return None
 
-        resp = requests.get(url, headers=headers, timeout=15, verify=False)
-        
-        if resp.status_code == 200:
-            data = resp.json()
-            if 'marketOverviewHistory' in data:
-                history = data['marketOverviewHistory']
-                
-                # جستجوی دقیق
-                for day in history:
-                    if day['tarikh'] == target_int_date:
-                        log_debug(f"History Found (Exact): {day['indexLastValue']}")
-                        return day['indexLastValue']
-                        
-                # جستجوی روزهای قبل (اگر تعطیل بوده)
-                for i in range(1, 7):
-                    target_backup = target_int_date - i
-                    for day in history:
-                        if day['tarikh'] == target_backup:
-                            log_debug(f"History Found (Backup -{i} days): {day['indexLastValue']}")
-                            return day['indexLastValue']
-                            
-        log_debug(f"History API status: {resp.status_code}")
-        
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT MAX(tarikh) AS last_day FROM index_history").fetchone()
+        last_day = row['last_day'] if row else None
+        if (last_day is None or target_int_date > last_day) and _history_refresh_due(target_int_date):
+            refresh_index_history(conn)
+
+        # جستجو با کلید اصلی (tarikh) به جای پیمایش خطی
+        found = conn.execute('''
+            SELECT tarikh, index_value FROM index_history
+            WHERE tarikh <= ? AND tarikh >= ?
+            ORDER BY tarikh DESC LIMIT 1
+        ''', (target_int_date, floor_int_date)).fetchone()
+
+        if found:
+            log_debug(f"History Found ({found['tarikh']}): {found['index_value']}")
+            return found['index_value']
     except Exception as e:
-        log_debug(f"History Fetch Error: {e}")
-        
+        log_debug(f"History Lookup Error: {e}")
+    finally:
+        conn.close()
+
     return None
 
 if __name__ == "__main__":